@@ -1,4 +1,5 @@
 import sqlalchemy as sa
+from flask import g
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app import db
 from app.models import User
@@ -20,9 +21,17 @@ def basic_auth_error(status):
     return error_response(status)
 
 
+def token_user(token):
+    """Return the user of a valid token, looked up once per request."""
+    if g.get('token') != token:
+        g.token = token
+        g.token_user = User.check_token(token)
+    return g.token_user
+
+
 @token_auth.verify_token
 def verify_token(token):
-    return User.check_token(token) if token else None
+    return token_user(token) if token else None
 
 
 @token_auth.error_handler
@@ -0,0 +1,223 @@
+import codecs
+from datetime import datetime, timedelta, timezone
+import json
+import re
+import sqlalchemy as sa
+from flask import current_app, request
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import LimitedStream
+from app import db, explorefeed
+from app.models import Post
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request, error_response
+from app.search import bulk_index
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+# how far the clock of a client may be ahead, and how old a post may be to
+# still be pushed to the explore feed buffer
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+
+def iter_ndjson(stream, max_item_size):
+    """Yield (item, error) for each line of a newline-delimited JSON body."""
+    for line in iter(lambda: stream.readline(max_item_size + 1), b''):
+        if len(line) > max_item_size and not line.endswith(b'\n'):
+            # skip the rest of the line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(64 * 1024)
+            yield None, f'items must be at most {max_item_size} bytes'
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield current_app.json.loads(line), None
+        except ValueError:
+            yield None, 'invalid JSON'
+
+
+def iter_json_array(stream, max_item_size, chunk_size=64 * 1024):
+    """Yield (item, error) for each item of a JSON array body, reading the
+    body a chunk at a time. A syntax error or an item larger than
+    max_item_size ends the array."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buffer, pos, eof, state = '', 0, False, 'start'
+    while True:
+        pos = WHITESPACE.match(buffer, pos).end()
+        if pos == len(buffer) or state == 'item':
+            if pos == len(buffer) and eof:
+                yield None, 'unexpected end of the JSON array'
+                return
+            if state == 'item':
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError:
+                    item = end = None
+                # a number or literal that ends the buffer may be cut short
+                if end is not None and (end < len(buffer) or eof or
+                                        isinstance(item, (dict, list, str))):
+                    pos, state = end, 'separator'
+                    yield item, None
+                    continue
+                if eof:
+                    yield None, 'invalid JSON'
+                    return
+                if len(buffer) - pos > max_item_size:
+                    # the item would be parsed again for every chunk
+                    yield None, f'items must be at most {max_item_size} bytes'
+                    return
+            chunk = stream.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + utf8.decode(chunk, final=eof), 0
+        elif state == 'start':
+            if buffer[pos] != '[':
+                yield None, 'expected a JSON array'
+                return
+            pos, state = pos + 1, 'first'
+        elif buffer[pos] == ']':
+            return
+        elif state == 'first':
+            state = 'item'
+        elif buffer[pos] == ',':
+            pos, state = pos + 1, 'item'
+        else:
+            yield None, 'invalid JSON'
+            return
+
+
+def validate_post(item, author):
+    """Return the row to insert for an item, or an error message."""
+    if not isinstance(item, dict):
+        return None, 'each post must be an object'
+    body = item.get('body')
+    if not isinstance(body, str) or not body.strip():
+        return None, 'body is required'
+    if len(body) > 140:
+        return None, 'body must be at most 140 characters'
+    language = item.get('language')
+    if language is not None and \
+            (not isinstance(language, str) or len(language) > 5):
+        return None, 'language must be a language code'
+    timestamp = datetime.now(timezone.utc)
+    if item.get('timestamp') is not None:
+        try:
+            timestamp = datetime.fromisoformat(item['timestamp'])
+        except (TypeError, ValueError):
+            return None, 'timestamp must be an ISO 8601 date and time'
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        timestamp = timestamp.astimezone(timezone.utc)
+        # a post from the future would stay at the top of every feed
+        if timestamp > datetime.now(timezone.utc) + MAX_CLOCK_SKEW:
+            return None, 'timestamp must not be in the future'
+    return {'body': body, 'user_id': author.id, 'language': language,
+            'timestamp': timestamp}, None
+
+
+def detect_languages(rows):
+    from langdetect import detect, LangDetectException
+    for row in rows:
+        if row['language'] is None:
+            try:
+                row['language'] = detect(row['body'])
+            except LangDetectException:
+                row['language'] = ''
+
+
+def _insert_rows(rows):
+    """Insert post rows and return their ids, in the order of the rows."""
+    if not db.session.connection().dialect.insert_executemany_returning:
+        # no multi-row RETURNING (MySQL), one INSERT per row
+        return [db.session.execute(sa.insert(Post), row)
+                .inserted_primary_key[0] for row in rows]
+    # one multi-row INSERT where the database can return the ids in the
+    # order of the rows (PostgreSQL), one per row otherwise (SQLite)
+    return db.session.scalars(
+        sa.insert(Post).returning(Post.id, sort_by_parameter_order=True),
+        rows).all()
+
+
+def insert_batch(batch, author):
+    """Insert a batch of (index, row) in one transaction and return the
+    result of each item.
+
+    The bulk insert bypasses the ORM events of single posts, so the
+    explore feed and the search index are updated here, once per batch.
+    Backdated posts do not go to the head of the explore feed buffer, which
+    is rebuilt instead.
+    """
+    rows = [row for _, row in batch]
+    detect_languages(rows)
+    try:
+        ids = _insert_rows(rows)
+        recent = datetime.now(timezone.utc) - MAX_CLOCK_SKEW
+        for id, row in sorted(zip(ids, rows),
+                              key=lambda id_row: id_row[1]['timestamp']):
+            if row['timestamp'] >= recent:
+                explorefeed.record(db.session, id)
+            else:
+                explorefeed.invalidate(db.session)
+        db.session.commit()
+    except sa.exc.SQLAlchemyError as e:
+        db.session.rollback()
+        current_app.logger.error(f'Bulk insert of {len(rows)} posts failed: {e}')
+        return [{'index': index, 'status': 500, 'error': 'database error'}
+                for index, _ in batch]
+    bulk_index(Post.__tablename__, {
+        id: Post.build_document(row['body'], row['timestamp'], row['language'],
+                                author) for id, row in zip(ids, rows)})
+    return [{'index': index, 'status': 201, 'id': id}
+            for (index, _), id in zip(batch, ids)]
+
+
+@bp.route('/posts/bulk', methods=['POST'])
+@token_auth.login_required
+def bulk_create_posts():
+    max_size = current_app.config['BULK_POSTS_MAX_SIZE']
+    max_item_size = current_app.config['BULK_POSTS_MAX_ITEM_SIZE']
+    if request.content_length is not None and \
+            request.content_length > max_size:
+        return error_response(413, f'the body must be at most {max_size} '
+                                   'bytes')
+    stream = LimitedStream(request.stream, max_size, is_max=True)
+    if request.mimetype in NDJSON_MIMETYPES:
+        items = iter_ndjson(stream, max_item_size)
+    elif request.mimetype == 'application/json':
+        items = iter_json_array(stream, max_item_size)
+    else:
+        return bad_request('send posts as a JSON array or as NDJSON')
+    author = token_auth.current_user()
+    batch_size = current_app.config['BULK_POSTS_BATCH_SIZE']
+    max_items = current_app.config['BULK_POSTS_MAX_ITEMS']
+    results = []
+    batch = []
+    try:
+        for index, (item, error) in enumerate(items):
+            if index >= max_items:
+                results.append({
+                    'index': index, 'status': 413,
+                    'error': f'at most {max_items} posts per request'})
+                break
+            row = None
+            if error is None:
+                row, error = validate_post(item, author)
+            if error is not None:
+                results.append({'index': index, 'status': 400,
+                                'error': error})
+                continue
+            batch.append((index, row))
+            if len(batch) >= batch_size:
+                results.extend(insert_batch(batch, author))
+                batch = []
+    except RequestEntityTooLarge:
+        # a streamed body without Content-Length went over the limit
+        results.append({'index': len(results) + len(batch), 'status': 413,
+                        'error': f'the body must be at most {max_size} bytes'})
+    if batch:
+        results.extend(insert_batch(batch, author))
+    results.sort(key=lambda result: result['index'])
+    created = sum(1 for result in results if result['status'] == 201)
+    return {'items': results, 'created': created,
+            'errors': created < len(results)}
@@ -5,41 +5,92 @@ from app.models import User
 from app.api import bp
 from app.api.auth import token_auth
 from app.api.errors import bad_request
+from app.replicas import use_replica
+
+# most users that can be requested with ids=
+MAX_BATCH_IDS = 100
+
+
+def requested_fields():
+    """Return the set of fields named by the fields argument, or None when
+    all the fields are wanted."""
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    return {field.strip() for field in fields.split(',') if field.strip()}
 
 
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
+@use_replica
 def get_user(id):
-    return db.get_or_404(User, id).to_dict()
+    return db.get_or_404(User, id).to_dict(fields=requested_fields())
 
 
 @bp.route('/users', methods=['GET'])
 @token_auth.login_required
+@use_replica
 def get_users():
+    if 'ids' in request.args:
+        return get_users_by_id(request.args['ids'])
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     return User.to_collection_dict(sa.select(User), page, per_page,
-                                   'api.get_users')
+                                   'api.get_users', fields=requested_fields())
+
+
+def get_users_by_id(ids):
+    """Return the users with the given comma separated ids, in the order
+    requested, loaded with a single query. Unknown ids are left out."""
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids.split(',')
+                                 if id.strip()))
+    except ValueError:
+        return bad_request('ids must be a comma separated list of user ids')
+    if len(ids) > MAX_BATCH_IDS:
+        return bad_request(f'at most {MAX_BATCH_IDS} ids can be requested')
+    fields = requested_fields()
+    users = {user.id: user for user in db.session.scalars(
+        sa.select(User).where(User.id.in_(ids)))} if ids else {}
+    return {'items': [users[id].to_dict(fields=fields)
+                      for id in ids if id in users]}
 
 
 @bp.route('/users/<int:id>/followers', methods=['GET'])
 @token_auth.login_required
+@use_replica
 def get_followers(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     return User.to_collection_dict(user.followers.select(), page, per_page,
-                                   'api.get_followers', id=id)
+                                   'api.get_followers',
+                                   fields=requested_fields(), id=id)
 
 
 @bp.route('/users/<int:id>/following', methods=['GET'])
 @token_auth.login_required
+@use_replica
 def get_following(id):
     user = db.get_or_404(User, id)
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     return User.to_collection_dict(user.following.select(), page, per_page,
-                                   'api.get_following', id=id)
+                                   'api.get_following',
+                                   fields=requested_fields(), id=id)
+
+
+@bp.route('/users/<int:id>/suggestions', methods=['GET'])
+@token_auth.login_required
+@use_replica
+def get_suggestions(id):
+    if token_auth.current_user().id != id:
+        abort(403)
+    user = db.get_or_404(User, id)
+    limit = min(request.args.get('limit', 10, type=int), 100)
+    fields = requested_fields()
+    return {'items': [suggested.to_dict(fields=fields)
+                      for suggested in user.follow_suggestions(limit)]}
 
 
 @bp.route('/users', methods=['POST'])
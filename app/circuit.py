@@ -0,0 +1,202 @@
+"""Circuit breakers for the external services.
+
+Each service (Elasticsearch, Redis, the translator) has a breaker with a
+latency budget. Calls that raise one of the service's errors, or that take
+longer than the budget, are failures; error responses only count when they
+say the service is unwell (a 5xx or a 429, not a 404). After ``CIRCUIT_FAILURE_THRESHOLD``
+consecutive failures the circuit opens, and calls fail immediately with
+``CircuitOpenError`` instead of tying up the worker. After
+``CIRCUIT_RESET_TIMEOUT`` seconds one trial call is let through, which
+closes the circuit if it succeeds and opens it again if it fails.
+
+The budget is also meant to be the timeout given to the client, so that a
+single call cannot take much longer than it.
+
+``guarded`` raises the errors of a service as ``ServiceError``, of which
+``CircuitOpenError`` is a subclass, so callers handle an unavailable
+service without importing its client library. The exception classes are
+given by name and imported on first use, for the same reason.
+"""
+from contextlib import contextmanager
+from importlib import import_module
+import threading
+from time import monotonic, perf_counter
+from flask import current_app
+from app.metrics import record_circuit_rejection, record_circuit_state, \
+    track_call
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def server_error(e):
+    """Return True for errors that say the service is unwell: those without
+    a response, and 5xx and 429 responses, but not bad requests or missing
+    documents."""
+    status = getattr(e, 'status_code', None)
+    return status is None or status >= 500 or status == 429
+
+
+# exceptions that count as failures of each service, the setting with its
+# latency budget, and a test of which of those exceptions count
+SERVICES = {
+    'elasticsearch': (('elasticsearch.exceptions:TransportError',
+                       'elasticsearch:ApiError'),
+                      'ELASTICSEARCH_TIMEOUT', server_error),
+    'redis': (('redis.exceptions:RedisError',), 'REDIS_TIMEOUT', None),
+    'translator': (('requests:RequestException',), 'TRANSLATOR_TIMEOUT',
+                   None),
+}
+
+
+class ServiceError(Exception):
+    pass
+
+
+class CircuitOpenError(ServiceError):
+    pass
+
+
+def _resolve(exception):
+    if isinstance(exception, str):
+        module, _, name = exception.partition(':')
+        return getattr(import_module(module), name)
+    return exception
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 timeout=None, exceptions=(Exception,), logger=None,
+                 is_failure=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        self._exceptions = exceptions
+        self.logger = logger
+        self.is_failure = is_failure
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def exceptions(self):
+        """The exceptions that count as failures, with the ones given as
+        'module:name' imported."""
+        if any(isinstance(e, str) for e in self._exceptions):
+            self._exceptions = tuple(_resolve(e) for e in self._exceptions)
+        return self._exceptions
+
+    def counts(self, e):
+        """Return True if an exception is a failure of the service."""
+        return isinstance(e, self.exceptions) and \
+            (self.is_failure is None or self.is_failure(e))
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        record_circuit_state(self.name, state)
+        if self.logger is not None:
+            if state == OPEN:
+                self.logger.warning(
+                    'Circuit for %s opened after %d failures, retrying in '
+                    '%ss', self.name, self.failures, self.reset_timeout)
+            else:
+                self.logger.info('Circuit for %s is %s', self.name,
+                                 state.replace('_', '-'))
+
+    def allow(self):
+        """Return True if a call can be made now."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and \
+                    monotonic() - self.opened_at >= self.reset_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set_state(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or \
+                    self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+                self._set_state(OPEN)
+
+    @contextmanager
+    def call(self):
+        """Run the block through the breaker.
+
+        Raises CircuitOpenError without running the block while the circuit
+        is open.
+        """
+        if not self.allow():
+            record_circuit_rejection(self.name)
+            raise CircuitOpenError(f'circuit for {self.name} is open')
+        start = perf_counter()
+        try:
+            yield self
+        except BaseException as e:
+            if self.counts(e):
+                self.failure()
+                raise
+            # other errors say nothing about the health of the service, but
+            # a trial call must not keep the circuit half-open forever
+            with self._lock:
+                self._trial = False
+            raise
+        if self.timeout is not None and \
+                perf_counter() - start > self.timeout:
+            self.failure()
+        else:
+            self.success()
+
+
+def breaker(service):
+    return current_app.extensions['circuit_breakers'][service]
+
+
+def timeout(service):
+    """Return the latency budget of service, to use as client timeout."""
+    return breaker(service).timeout
+
+
+@contextmanager
+def guarded(service, operation):
+    """Time a call to service through its circuit breaker.
+
+    Errors of the service are raised as ServiceError.
+    """
+    service_breaker = breaker(service)
+    try:
+        with service_breaker.call(), track_call(service, operation):
+            yield
+    except ServiceError:
+        raise
+    except Exception as e:
+        if service_breaker.counts(e):
+            raise ServiceError(f'{type(e).__name__}: {e}') from e
+        raise
+
+
+def init_app(app):
+    app.extensions['circuit_breakers'] = {
+        service: CircuitBreaker(
+            service, app.config['CIRCUIT_FAILURE_THRESHOLD'],
+            app.config['CIRCUIT_RESET_TIMEOUT'], app.config[setting],
+            exceptions, app.logger, is_failure)
+        for service, (exceptions, setting, is_failure) in SERVICES.items()}
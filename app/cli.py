@@ -1,6 +1,9 @@
 import os
-from flask import Blueprint
+from wsgiref.simple_server import make_server
+from flask import Blueprint, current_app
 import click
+from prometheus_client import make_wsgi_app
+from app import metrics, profiling, seed as seeding, suggestions, workers
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -38,3 +41,88 @@ def compile():
     """Compile all languages."""
     if os.system('pybabel compile -d app/translations'):
         raise RuntimeError('compile command failed')
+
+
+@bp.cli.command('metrics-exporter')
+@click.option('--host', default='0.0.0.0', help='Interface to listen on.')
+@click.option('--port', default=9101, help='Port to listen on.')
+def metrics_exporter(host, port):
+    """Serve the metrics recorded by RQ workers to Prometheus.
+
+    Workers must run with the same PROMETHEUS_MULTIPROC_DIR as this command,
+    as each job runs in a short-lived process that leaves its samples there.
+    """
+    registry = metrics.make_registry(current_app._get_current_object())
+    httpd = make_server(host, port, make_wsgi_app(registry))
+    click.echo(f'Serving worker metrics on http://{host}:{port}/metrics')
+    httpd.serve_forever()
+
+
+@bp.cli.command('profile-token')
+@click.argument('admin')
+def profile_token(admin):
+    """Generate a token that profiles the requests it is attached to.
+
+    Send it in the X-Profile-Token header or the _profile query string
+    argument. Profiles are saved to PROFILE_DIR.
+    """
+    click.echo(profiling.generate_profile_token(
+        current_app._get_current_object(), admin))
+
+
+@bp.cli.command()
+@click.option('--users', default=1000, help='Number of users to create.')
+@click.option('--posts-per-user', default=20,
+              help='Average number of posts per user.')
+@click.option('--follows-per-user', default=30,
+              help='Average number of users each user follows.')
+@click.option('--messages-per-user', default=5,
+              help='Private messages received by each user.')
+@click.option('--batch-size', default=10000,
+              help='Rows inserted per transaction.')
+@click.option('--seed', 'random_seed', default=42,
+              help='Random seed, the same seed gives the same data.')
+@click.option('--index/--no-index', default=False,
+              help='Add the new posts to the search index.')
+def seed(users, posts_per_user, follows_per_user, messages_per_user,
+         batch_size, random_seed, index):
+    """Bulk-insert a synthetic dataset."""
+    def report(table, count, elapsed):
+        rate = count / elapsed if elapsed else 0
+        click.echo(f'{table}: {count} rows in {elapsed:.1f}s '
+                   f'({rate:,.0f} rows/s)')
+
+    seeding.generate(seed=random_seed, batch_size=batch_size, index=index,
+                     report=report, users=users,
+                     posts_per_user=posts_per_user,
+                     follows_per_user=follows_per_user,
+                     messages_per_user=messages_per_user)
+
+
+@bp.cli.command('suggestions')
+@click.option('--queue', 'use_queue', is_flag=True,
+              help='Run the refresh as a background job.')
+def refresh_suggestions(use_queue):
+    """Recompute the follow suggestions of all active users."""
+    if use_queue:
+        current_app.task_queues['bulk'].enqueue(
+            'app.tasks.refresh_suggestions')
+        click.echo('Suggestions refresh queued')
+        return
+
+    def progress(done, total):
+        click.echo(f'{done}/{total} users')
+
+    suggestions.refresh_all(progress=progress)
+
+
+@bp.cli.command()
+@click.option('--processes', default=4, help='Number of worker processes.')
+@click.option('--bulk-processes', default=1,
+              help='How many of the processes also run bulk jobs.')
+@click.option('--max-jobs', type=int,
+              help='Replace each process after this many jobs.')
+def worker(processes, bulk_processes, max_jobs):
+    """Run a pool of warm workers for the background job queues."""
+    workers.run_pool(processes, min(bulk_processes, processes), max_jobs,
+                     current_app.logger)
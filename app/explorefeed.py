@@ -0,0 +1,138 @@
+"""Ring buffer of the latest post ids, for the explore page.
+
+Every visitor of the explore page sees the same posts, so the ids of the
+latest ``EXPLORE_BUFFER_SIZE`` posts are kept in a capped Redis list,
+newest first. New posts are pushed to it when they are committed. Pages
+within the buffer are loaded by id, without the ``ORDER BY ... OFFSET``
+and ``COUNT(*)`` over the whole posts table. Pages beyond it, and all
+pages when Redis is unavailable, are paginated in the database as before.
+
+The buffer follows commit order, which matches timestamp order for posts
+written through the application. Backdated posts, from the bulk API,
+invalidate the buffer instead. It is rebuilt from the database when it is
+missing, and it expires after ``EXPLORE_BUFFER_TTL`` seconds to drop
+anything it may have missed.
+"""
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.circuit import CircuitOpenError, ServiceError, guarded
+from app.metrics import record_cache
+
+KEY = 'explore:posts'
+
+
+class Page:
+    """A page of posts with the navigation interface of a Pagination."""
+    def __init__(self, items, page, has_next):
+        self.items = items
+        self.page = page
+        self.has_next = has_next
+        self.has_prev = page > 1
+        self.next_num = page + 1 if has_next else None
+        self.prev_num = page - 1 if self.has_prev else None
+
+
+def _rebuild(redis, size):
+    from app.models import Post
+    # on the primary, as the posts a lagging replica misses would be left
+    # out of the buffer until it expires
+    with db.engine.connect() as conn:
+        ids = conn.scalars(sa.select(Post.id).order_by(
+            Post.timestamp.desc()).limit(size)).all()
+    if ids:
+        pipe = redis.pipeline()
+        pipe.delete(KEY)
+        pipe.rpush(KEY, *ids)
+        pipe.expire(KEY, current_app.config['EXPLORE_BUFFER_TTL'])
+        pipe.execute()
+    return ids
+
+
+def _buffered_ids(start, stop):
+    """Return the buffered ids from start to stop, or None if the range is
+    not in the buffer."""
+    size = current_app.config['EXPLORE_BUFFER_SIZE']
+    if not size or start >= size:
+        return None
+    redis = current_app.redis
+    try:
+        with guarded('redis', 'explore_feed'):
+            pipe = redis.pipeline(transaction=False)
+            pipe.llen(KEY)
+            pipe.lrange(KEY, start, stop - 1)
+            length, ids = pipe.execute()
+            record_cache('explore_feed', length > 0)
+            if not length:
+                rebuilt = _rebuild(redis, size)
+                length = len(rebuilt)
+                ids = rebuilt[start:stop]
+    except CircuitOpenError:
+        return None
+    except ServiceError as e:
+        current_app.logger.warning('Explore feed buffer unavailable: %s', e)
+        return None
+    # a buffer that is not full holds every post
+    if stop > length and length >= size:
+        return None
+    return [int(i) for i in ids]
+
+
+def explore_page(page, per_page):
+    from app.models import Post
+    start = (page - 1) * per_page
+    # one more id than needed tells whether there is a next page
+    ids = _buffered_ids(start, start + per_page + 1)
+    if ids is None:
+        return db.paginate(Post.explore_posts(), page=page,
+                           per_page=per_page, error_out=False)
+    has_next = len(ids) > per_page
+    ids = ids[:per_page]
+    posts = {}
+    if ids:
+        posts = {post.id: post for post in db.session.scalars(
+            Post.load_related(sa.select(Post).where(Post.id.in_(ids))))}
+    # posts that are not visible to this session yet are skipped
+    return Page([posts[i] for i in ids if i in posts], page, has_next)
+
+
+def record(session, post_id):
+    session.info.setdefault('new_posts', []).append(post_id)
+
+
+def invalidate(session):
+    """Have the buffer rebuilt after the commit, for posts that do not
+    belong at its head."""
+    session.info['explore_stale'] = True
+
+
+def after_commit(session):
+    ids = session.info.pop('new_posts', None)
+    stale = session.info.pop('explore_stale', False)
+    size = current_app.config['EXPLORE_BUFFER_SIZE'] if ids or stale else 0
+    if not size:
+        return
+    redis = current_app.redis
+    try:
+        with guarded('redis', 'explore_feed'):
+            pipe = redis.pipeline()
+            if stale:
+                pipe.delete(KEY)
+            else:
+                # LPUSHX does nothing if the buffer is missing, in which
+                # case it is rebuilt with these posts on the next read
+                pipe.lpushx(KEY, *ids)
+                pipe.ltrim(KEY, 0, size - 1)
+            pipe.execute()
+    except ServiceError as e:
+        current_app.logger.warning('Could not update the explore feed '
+                                   'buffer: %s', e)
+
+
+def after_rollback(session):
+    session.info.pop('new_posts', None)
+    session.info.pop('explore_stale', None)
+
+
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
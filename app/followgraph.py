@@ -0,0 +1,230 @@
+"""Cache of the follow graph in Redis sets.
+
+``following:<id>`` holds the ids of the users that <id> follows and
+``followers:<id>`` the ids of the users that follow <id>. A set is loaded
+from the database the first time it is needed and is then kept in sync
+with the follows and unfollows committed by the session. Every cached set
+contains the sentinel member 0, so that a cached empty set can be told
+apart from one that is not cached.
+
+Sets are only loaded with committed rows, read from the primary on a
+connection of their own, and not while the session has follows or
+unfollows that are not committed yet. Each change also bumps a counter of
+the set, and a load whose read is older than the last change is dropped,
+so that a slow load cannot undo a change committed meanwhile.
+
+The lookup functions return None when the cache is disabled or Redis is
+unavailable, and the callers then query the database instead. Calls go
+through the Redis circuit breaker, so an outage costs a few failed calls
+and then none until Redis is tried again.
+"""
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.circuit import CircuitOpenError, ServiceError, guarded
+from app.metrics import record_cache
+
+SENTINEL = 0
+
+# apply a change only to sets that are cached, as adding a member to a
+# missing key would create an incomplete set, and bump the change counter
+# of the set in KEYS[2]
+_APPLY_SCRIPT = """
+redis.call('incr', KEYS[2])
+redis.call('expire', KEYS[2], ARGV[3])
+if redis.call('exists', KEYS[1]) == 1 then
+    return redis.call(ARGV[1], KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# load the members in ARGV[3:] into the set in KEYS[1], unless it is cached
+# already or its change counter in KEYS[2] moved on from ARGV[1]
+_LOAD_SCRIPT = """
+if redis.call('exists', KEYS[1]) == 1 or
+        (redis.call('get', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+for i = 3, #ARGV, 1000 do
+    redis.call('sadd', KEYS[1], unpack(ARGV, i, math.min(i + 999, #ARGV)))
+end
+redis.call('expire', KEYS[1], ARGV[2])
+return 1
+"""
+# how long change counters outlive the last change, which is more than a
+# load takes
+CHANGE_COUNTER_TTL = 60
+
+
+def _key(kind, user_id):
+    return f'{kind}:{user_id}'
+
+
+def _changes_key(kind, user_id):
+    return f'{kind}:{user_id}:changes'
+
+
+def _columns(kind):
+    from app.models import followers
+    if kind == 'following':
+        return followers.c.follower_id, followers.c.followed_id
+    return followers.c.followed_id, followers.c.follower_id
+
+
+def _client():
+    if not current_app.config['FOLLOW_GRAPH_CACHE']:
+        return None
+    return current_app.redis
+
+
+def _unavailable(e):
+    if not isinstance(e, CircuitOpenError):
+        current_app.logger.warning('Follow graph cache unavailable: %s', e)
+
+
+def _can_load():
+    # the session would see its own uncommitted follows
+    return not db.session.info.get('follow_changes')
+
+
+def _load(redis, kind, user_id):
+    """Load a set with the committed rows of the primary and return them."""
+    owner, member = _columns(kind)
+    counter = redis.get(_changes_key(kind, user_id))
+    with db.engine.connect() as conn:
+        ids = conn.scalars(sa.select(member).where(owner == user_id)).all()
+    redis.register_script(_LOAD_SCRIPT)(
+        keys=[_key(kind, user_id), _changes_key(kind, user_id)],
+        args=[counter or b'', current_app.config['FOLLOW_GRAPH_TTL'],
+              SENTINEL, *ids])
+    return set(ids)
+
+
+def _ensure_cached(redis, *sets):
+    """Load the (kind, user_id) sets that are not cached yet. Return False
+    if some could not be loaded."""
+    pipe = redis.pipeline(transaction=False)
+    for kind, user_id in sets:
+        pipe.exists(_key(kind, user_id))
+    for (kind, user_id), exists in zip(sets, pipe.execute()):
+        record_cache('follow_graph', exists)
+        if not exists:
+            if not _can_load():
+                return False
+            _load(redis, kind, user_id)
+    return True
+
+
+def is_member(kind, user_id, member_id):
+    """Return True if member_id is in the set, or None if not available."""
+    redis = _client()
+    if redis is None:
+        return None
+    key = _key(kind, user_id)
+    try:
+        with guarded('redis', 'follow_graph'):
+            pipe = redis.pipeline(transaction=False)
+            pipe.exists(key)
+            pipe.sismember(key, member_id)
+            exists, member = pipe.execute()
+            record_cache('follow_graph', exists)
+            if not exists:
+                if not _can_load():
+                    return None
+                return member_id in _load(redis, kind, user_id)
+            return bool(member)
+    except ServiceError as e:
+        _unavailable(e)
+
+
+def count(kind, user_id):
+    """Return the size of the set, or None if not available."""
+    redis = _client()
+    if redis is None:
+        return None
+    try:
+        with guarded('redis', 'follow_graph'):
+            if not _ensure_cached(redis, (kind, user_id)):
+                return None
+            return redis.scard(_key(kind, user_id)) - 1
+    except ServiceError as e:
+        _unavailable(e)
+
+
+def known_followers(viewer_id, user_id):
+    """Return the ids of the users followed by viewer_id that follow
+    user_id, or None if not available."""
+    redis = _client()
+    if redis is None:
+        return None
+    try:
+        with guarded('redis', 'follow_graph'):
+            if not _ensure_cached(redis, ('following', viewer_id),
+                                  ('followers', user_id)):
+                return None
+            ids = redis.sinter(_key('following', viewer_id),
+                               _key('followers', user_id))
+    except ServiceError as e:
+        _unavailable(e)
+        return None
+    return sorted(int(i) for i in ids if int(i) != SENTINEL)
+
+
+def record(session, op, follower_id, followed_id):
+    """Remember a follow ('add') or unfollow ('remove') made by session."""
+    session.info.setdefault('follow_changes', []).append(
+        (op, follower_id, followed_id))
+
+
+def pending_state(session, follower_id, followed_id):
+    """Return the follow state set by uncommitted changes, if any."""
+    for op, follower, followed in reversed(
+            session.info.get('follow_changes', ())):
+        if (follower, followed) == (follower_id, followed_id):
+            return op == 'add'
+
+
+def pending_delta(session, kind, user_id):
+    """Return how much uncommitted changes add to the size of a set."""
+    column = 1 if kind == 'following' else 2
+    return sum(1 if change[0] == 'add' else -1
+               for change in session.info.get('follow_changes', ())
+               if change[column] == user_id)
+
+
+def apply_changes(changes):
+    if not current_app.config['FOLLOW_GRAPH_CACHE']:
+        return
+    redis = current_app.redis
+    script = redis.register_script(_APPLY_SCRIPT)
+    try:
+        with guarded('redis', 'follow_graph'):
+            pipe = redis.pipeline(transaction=False)
+            for op, follower_id, followed_id in changes:
+                command = 'sadd' if op == 'add' else 'srem'
+                script(keys=[_key('following', follower_id),
+                             _changes_key('following', follower_id)],
+                       args=[command, followed_id, CHANGE_COUNTER_TTL],
+                       client=pipe)
+                script(keys=[_key('followers', followed_id),
+                             _changes_key('followers', followed_id)],
+                       args=[command, follower_id, CHANGE_COUNTER_TTL],
+                       client=pipe)
+            pipe.execute()
+    except ServiceError as e:
+        # the cached sets may now be stale, until they expire
+        _unavailable(e)
+
+
+def after_commit(session):
+    changes = session.info.pop('follow_changes', None)
+    if changes:
+        apply_changes(changes)
+
+
+def after_rollback(session):
+    session.info.pop('follow_changes', None)
+
+
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
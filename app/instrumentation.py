@@ -0,0 +1,196 @@
+import re
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+import sqlalchemy as sa
+from flask import before_render_template, g, request, template_rendered
+
+_recorder = ContextVar('query_recorder', default=None)
+_timings = ContextVar('server_timings', default=None)
+_in_list = re.compile(r'\(\s*(?:\?|%s|%\(\w+\)s|:\w+)'
+                      r'(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)')
+_whitespace = re.compile(r'\s+')
+
+
+def statement_shape(statement):
+    """Reduce a statement to its shape so repeated queries can be grouped.
+
+    Parameters are already bound by SQLAlchemy, so only expanded IN lists
+    and whitespace need to be normalized."""
+    return _whitespace.sub(' ', _in_list.sub('(?)', statement)).strip()
+
+
+class QueryRecorder:
+    def __init__(self, slow_threshold=None, parent=None):
+        self.slow_threshold = slow_threshold
+        self.parent = parent
+        self.count = 0
+        self.duration = 0.0
+        self.statements = []
+        self.slow = []
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.statements.append(statement)
+        self.shapes[statement_shape(statement)] += 1
+        if self.slow_threshold is not None and \
+                duration >= self.slow_threshold:
+            self.slow.append((duration, statement))
+        if self.parent is not None:
+            self.parent.record(statement, duration)
+
+    def repeated(self, threshold):
+        """Return the statement shapes executed at least threshold times."""
+        return {shape: count for shape, count in self.shapes.items()
+                if count >= threshold}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _recorder.get() is not None:
+        context._query_start = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    recorder = _recorder.get()
+    start = getattr(context, '_query_start', None)
+    if recorder is not None and start is not None:
+        recorder.record(statement, perf_counter() - start)
+
+
+sa.event.listen(sa.engine.Engine, 'before_cursor_execute',
+                _before_cursor_execute)
+sa.event.listen(sa.engine.Engine, 'after_cursor_execute',
+                _after_cursor_execute)
+
+
+@contextmanager
+def recording(slow_threshold=None):
+    """Record every statement executed inside the block."""
+    recorder = QueryRecorder(slow_threshold, parent=_recorder.get())
+    token = _recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _recorder.reset(token)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fail with an AssertionError if the block runs more than max_queries.
+
+    Intended for tests, e.g. ``with query_budget(5): client.get('/explore')``.
+    """
+    with recording() as recorder:
+        yield recorder
+    if recorder.count > max_queries:
+        raise AssertionError(
+            '{} queries executed, budget is {}:\n{}'.format(
+                recorder.count, max_queries, '\n'.join(recorder.statements)))
+
+
+def current_recorder():
+    return _recorder.get()
+
+
+def add_timing(phase, duration):
+    """Add time spent in a phase to the current request's Server-Timing."""
+    timings = _timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + duration
+
+
+def server_timing_header(timings, recorder=None, total=None):
+    metrics = []
+    if recorder is not None:
+        metrics.append('db;dur={:.1f};desc="{} queries"'.format(
+            recorder.duration * 1000, recorder.count))
+    for phase, duration in timings.items():
+        metrics.append('{};dur={:.1f}'.format(phase, duration * 1000))
+    if total is not None:
+        metrics.append('total;dur={:.1f}'.format(total * 1000))
+    return ', '.join(metrics)
+
+
+def _start_template_timer(app, template, context, **extra):
+    if _timings.get() is not None:
+        g.setdefault('_template_starts', []).append(perf_counter())
+
+
+def _stop_template_timer(app, template, context, **extra):
+    starts = g.get('_template_starts')
+    if starts:
+        add_timing('template', perf_counter() - starts.pop())
+
+
+def init_app(app):
+    if app.debug or app.config['SERVER_TIMING']:
+        _init_server_timing(app)
+    if not app.config['SQL_INSTRUMENTATION']:
+        return
+    debug_header = app.debug or app.config['SQL_DEBUG_HEADER']
+
+    @app.before_request
+    def start_query_recording():
+        recorder = QueryRecorder(app.config['SQL_SLOW_QUERY_THRESHOLD'],
+                                 parent=_recorder.get())
+        g._query_recorder_token = _recorder.set(recorder)
+        g.query_recorder = recorder
+
+    @app.after_request
+    def report_query_recording(response):
+        recorder = g.get('query_recorder')
+        if recorder is None:
+            return response
+        for duration, statement in recorder.slow:
+            app.logger.warning('Slow query (%.1f ms) in %s: %s',
+                               duration * 1000, request.endpoint,
+                               statement_shape(statement))
+        repeated = recorder.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        for shape, count in repeated.items():
+            app.logger.warning('Possible N+1 in %s: %d x %s',
+                               request.endpoint, count, shape)
+        app.logger.debug('%s %s: %d queries in %.1f ms', request.method,
+                         request.path, recorder.count,
+                         recorder.duration * 1000)
+        if debug_header:
+            response.headers['X-DB-Queries'] = \
+                'count={}; time={:.1f}ms; repeated={}; slow={}'.format(
+                    recorder.count, recorder.duration * 1000, len(repeated),
+                    len(recorder.slow))
+        return response
+
+    @app.teardown_request
+    def stop_query_recording(exc):
+        token = g.pop('_query_recorder_token', None)
+        if token is not None:
+            _recorder.reset(token)
+
+
+def _init_server_timing(app):
+    before_render_template.connect(_start_template_timer, app)
+    template_rendered.connect(_stop_template_timer, app)
+
+    @app.before_request
+    def start_server_timing():
+        g._server_timing_start = perf_counter()
+        g._server_timing_token = _timings.set({})
+
+    @app.after_request
+    def add_server_timing_header(response):
+        timings = _timings.get()
+        if timings is not None and '_server_timing_start' in g:
+            response.headers['Server-Timing'] = server_timing_header(
+                timings, g.get('query_recorder'),
+                perf_counter() - g._server_timing_start)
+        return response
+
+    @app.teardown_request
+    def stop_server_timing(exc):
+        token = g.pop('_server_timing_token', None)
+        if token is not None:
+            _timings.reset(token)
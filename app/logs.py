@@ -0,0 +1,287 @@
+"""Logging that does not block the requests.
+
+Records of the app logger are put on a queue by a ``QueueHandler`` and
+written by a ``QueueListener`` thread, so requests never wait for the log
+file or the console. ``LOG_FORMAT`` selects JSON lines (the default) or
+plain text, and every record carries the id of the request that logged it.
+The id comes from the ``X-Request-ID`` header when the proxy sets one, and
+is sent back in the same header.
+
+The listener thread does not survive a fork, so forked processes (gunicorn
+and RQ workers) start their own. Queued records are written before the
+process exits, by an ``atexit`` hook or by ``stop()``.
+
+Errors are mailed to the admins by ``DigestMailHandler``, which groups them
+by where they were logged and mails a digest at most every
+``LOG_MAIL_INTERVAL`` seconds, and at most ``LOG_MAIL_MAX_PER_HOUR`` times
+an hour, from a thread of its own. Each process has its own digest and cap,
+so a server with four workers can send up to four times as many mails.
+Stopping a pipeline closes its handlers, which mails the pending errors.
+"""
+import atexit
+from collections import deque
+import copy
+from datetime import datetime, timezone
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import os
+import queue
+import sys
+import threading
+from time import monotonic
+import uuid
+import orjson
+from flask import g, has_request_context, request
+from flask.logging import default_handler
+
+TEXT_FORMAT = ('%(asctime)s %(levelname)s [%(request_id)s]: %(message)s '
+               '[in %(pathname)s:%(lineno)d]')
+
+# pipelines started in this process
+_pipelines = []
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = g.get('request_id') \
+            if has_request_context() else None
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(
+                record.created, timezone.utc).isoformat(
+                    timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'request_id': getattr(record, 'request_id', None),
+            'pid': record.process,
+            'location': f'{record.pathname}:{record.lineno}',
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class RecordQueueHandler(QueueHandler):
+    """Queue handler that keeps the message and the traceback apart, for
+    the formatter of the listener."""
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_type = record.exc_info[0].__name__
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class DigestMailHandler(logging.Handler):
+    """Mail the errors logged over an interval as one digest.
+
+    Errors are grouped by logger, location and exception type, so an outage
+    that fails every request makes one entry with a count. Logging an error
+    only updates the buffer; mails are sent by a background thread.
+    """
+    def __init__(self, app, interval=60, max_per_hour=10, max_kinds=50):
+        super().__init__(logging.ERROR)
+        self.app = app
+        self.interval = interval
+        self.max_per_hour = max_per_hour
+        self.max_kinds = max_kinds
+        self.errors = {}
+        self.dropped = 0
+        self.sent = deque()
+        self.setFormatter(logging.Formatter(TEXT_FORMAT,
+                                            defaults={'request_id': None}))
+        self._thread_pid = None
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def signature(record):
+        exc_type = getattr(record, 'exc_type', None)
+        if exc_type is None and record.exc_info:
+            exc_type = record.exc_info[0].__name__
+        return record.name, record.pathname, record.lineno, exc_type
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if self._thread_pid != os.getpid():
+            # the thread does not survive a fork
+            self._thread_pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True,
+                             name='error-digest').start()
+        key = self.signature(record)
+        if key in self.errors:
+            error = self.errors[key]
+            error['count'] += 1
+            error['last'] = record.created
+            error['text'] = text
+        elif len(self.errors) < self.max_kinds:
+            self.errors[key] = {'count': 1, 'first': record.created,
+                                'last': record.created, 'text': text}
+        else:
+            self.dropped += 1
+
+    def _run(self):
+        pid = os.getpid()
+        while self._thread_pid == pid and \
+                not self._stopped.wait(self.interval):
+            self.flush()
+
+    def flush(self, force=False):
+        """Mail the buffered errors, unless the hourly cap is reached, in
+        which case they keep adding up until the next digest."""
+        now = monotonic()
+        while self.sent and now - self.sent[0] > 3600:
+            self.sent.popleft()
+        self.acquire()
+        try:
+            if not self.errors or \
+                    (len(self.sent) >= self.max_per_hour and not force):
+                return
+            errors, dropped = self.errors, self.dropped
+            self.errors, self.dropped = {}, 0
+        finally:
+            self.release()
+        self.sent.append(now)
+        try:
+            self.send(errors, dropped)
+        except Exception as e:
+            # logging it would only add another error to the next digest
+            print(f'Could not mail the error digest: {e}', file=sys.stderr)
+
+    def send(self, errors, dropped):
+        from app.email import send_email
+        total = sum(error['count'] for error in errors.values()) + dropped
+        parts = []
+        for error in sorted(errors.values(), key=lambda e: -e['count']):
+            first, last = (datetime.fromtimestamp(error[t], timezone.utc)
+                           .strftime('%H:%M:%S') for t in ('first', 'last'))
+            parts.append(f'{error["count"]} times from {first} to {last} '
+                         f'UTC, last one:\n\n{error["text"]}')
+        if dropped:
+            parts.append(f'{dropped} more errors of other kinds')
+        with self.app.app_context():
+            send_email(f'Microblog Failure: {total} errors',
+                       sender='no-reply@' + self.app.config['MAIL_SERVER'],
+                       recipients=self.app.config['ADMINS'],
+                       text_body=('\n\n' + '-' * 70 + '\n\n').join(parts),
+                       html_body=None, sync=True)
+
+    def close(self):
+        self._stopped.set()
+        self.flush(force=True)
+        super().close()
+
+    def after_fork(self):
+        # the errors logged so far are the parent's to mail
+        self.errors, self.dropped = {}, 0
+        self.sent.clear()
+        self._stopped = threading.Event()
+
+
+class LogPipeline:
+    def __init__(self, handlers):
+        self.queue = queue.SimpleQueue()
+        self.handler = RecordQueueHandler(self.queue)
+        self.handler.addFilter(RequestIdFilter())
+        self.listener = QueueListener(self.queue, *handlers,
+                                      respect_handler_level=True)
+
+    def start(self):
+        self.listener.start()
+        _pipelines.append(self)
+
+    def stop(self):
+        """Write the queued records, stop the listener and close the
+        handlers."""
+        if self.listener._thread is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+        if self in _pipelines:
+            _pipelines.remove(self)
+
+    def _restart_in_child(self):
+        # the records queued before the fork belong to the parent
+        self.queue = self.handler.queue = self.listener.queue = \
+            queue.SimpleQueue()
+        for handler in self.listener.handlers:
+            if isinstance(handler, DigestMailHandler):
+                handler.after_fork()
+        self.listener._thread = None
+        self.listener.start()
+
+
+def stop():
+    """Stop the pipelines of this process, for processes that exit with
+    os._exit() and so skip the atexit hooks."""
+    for pipeline in list(_pipelines):
+        pipeline.stop()
+
+
+def _after_fork():
+    for pipeline in _pipelines:
+        pipeline._restart_in_child()
+
+
+atexit.register(stop)
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def set_request_id():
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+
+def add_request_id_header(response):
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+def make_handlers(app):
+    if app.config['LOG_TO_STDOUT']:
+        handler = logging.StreamHandler()
+    else:
+        os.makedirs('logs', exist_ok=True)
+        handler = RotatingFileHandler(
+            'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUP_COUNT'])
+    if app.config['LOG_FORMAT'] == 'json':
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            TEXT_FORMAT, defaults={'request_id': None}))
+    handler.setLevel(logging.INFO)
+    handlers = [handler]
+    if app.config['MAIL_SERVER']:
+        handlers.append(DigestMailHandler(
+            app, app.config['LOG_MAIL_INTERVAL'],
+            app.config['LOG_MAIL_MAX_PER_HOUR']))
+    return handlers
+
+
+def init_app(app):
+    app.before_request(set_request_id)
+    app.after_request(add_request_id_header)
+    if app.debug or app.testing:
+        return
+    pipeline = LogPipeline(make_handlers(app))
+    pipeline.start()
+    app.extensions['log_pipeline'] = pipeline
+    # records are written by the pipeline alone, not also to stderr from
+    # the request thread
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(pipeline.handler)
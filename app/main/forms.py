@@ -48,6 +48,14 @@ class SearchForm(FlaskForm):
 
 
 class MessageForm(FlaskForm):
+    recipient = StringField(_l('To'), validators=[DataRequired()])
     message = TextAreaField(_l('Message'), validators=[
         DataRequired(), Length(min=1, max=140)])
     submit = SubmitField(_l('Submit'))
+
+    def validate_recipient(self, recipient):
+        user = db.session.scalar(sa.select(User).where(
+            User.username == recipient.data))
+        if user is None:
+            raise ValidationError(_('User %(username)s not found.',
+                                    username=recipient.data))
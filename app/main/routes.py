@@ -4,12 +4,15 @@ from flask import render_template, flash, redirect, url_for, request, g, \
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
 import sqlalchemy as sa
-from langdetect import detect, LangDetectException
-from app import db
+from app import db, usernames
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
     MessageForm
 from app.models import User, Post, Message, Notification
+from app.explorefeed import explore_page
+from app.suggestions import schedule_refresh
 from app.translate import translate
+from app.workers import TaskLimitError
+from app.replicas import use_primary, use_replica
 from app.main import bp
 
 
@@ -28,6 +31,7 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
+        from langdetect import detect, LangDetectException
         try:
             language = detect(form.post.data)
         except LangDetectException:
@@ -53,12 +57,10 @@ def index():
 
 @bp.route('/explore')
 @login_required
+@use_replica
 def explore():
     page = request.args.get('page', 1, type=int)
-    query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
+    posts = explore_page(page, current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.explore', page=posts.next_num) \
         if posts.has_next else None
     prev_url = url_for('main.explore', page=posts.prev_num) \
@@ -70,11 +72,11 @@ def explore():
 
 @bp.route('/user/<username>')
 @login_required
+@use_replica
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
     page = request.args.get('page', 1, type=int)
-    query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
+    posts = db.paginate(user.user_posts(), page=page,
                         per_page=current_app.config['POSTS_PER_PAGE'],
                         error_out=False)
     next_url = url_for('main.user', username=user.username,
@@ -88,6 +90,7 @@ def user(username):
 
 @bp.route('/user/<username>/popup')
 @login_required
+@use_replica
 def user_popup(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
     form = EmptyForm()
@@ -96,6 +99,7 @@ def user_popup(username):
 
 @bp.route('/edit_profile', methods=['GET', 'POST'])
 @login_required
+@use_primary
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
@@ -124,8 +128,9 @@ def follow(username):
         if user == current_user:
             flash(_('You cannot follow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.follow(user)
-        db.session.commit()
+        if current_user.follow(user):
+            db.session.commit()
+            schedule_refresh(current_user)
         flash(_('You are following %(username)s!', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -145,8 +150,9 @@ def unfollow(username):
         if user == current_user:
             flash(_('You cannot unfollow yourself!'))
             return redirect(url_for('main.user', username=username))
-        current_user.unfollow(user)
-        db.session.commit()
+        if current_user.unfollow(user):
+            db.session.commit()
+            schedule_refresh(current_user)
         flash(_('You are not following %(username)s.', username=username))
         return redirect(url_for('main.user', username=username))
     else:
@@ -164,26 +170,32 @@ def translate_text():
 
 @bp.route('/search')
 @login_required
+@use_replica
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
+    cursor = request.args.get('cursor')
+    posts, total, next_cursor = Post.search_page(
+        g.search_form.q.data, current_app.config['POSTS_PER_PAGE'], cursor,
+        from_source=current_app.config['SEARCH_FROM_SOURCE'])
+    next_url = url_for('main.search', q=g.search_form.q.data,
+                       cursor=next_cursor) if next_cursor else None
+    # cursors only lead forward, so this goes back to the first page
+    prev_url = url_for('main.search', q=g.search_form.q.data) \
+        if cursor else None
     return render_template('search.html', title=_('Search'), posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
+@bp.route('/send_message', methods=['GET', 'POST'],
+          defaults={'recipient': None})
 @bp.route('/send_message/<recipient>', methods=['GET', 'POST'])
 @login_required
 def send_message(recipient):
-    user = db.first_or_404(sa.select(User).where(User.username == recipient))
     form = MessageForm()
     if form.validate_on_submit():
+        user = db.session.scalar(sa.select(User).where(
+            User.username == form.recipient.data))
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
@@ -191,9 +203,25 @@ def send_message(recipient):
                               user.unread_message_count())
         db.session.commit()
         flash(_('Your message has been sent.'))
-        return redirect(url_for('main.user', username=recipient))
+        return redirect(url_for('main.user', username=user.username))
+    elif request.method == 'GET' and recipient is not None:
+        db.first_or_404(sa.select(User).where(User.username == recipient))
+        form.recipient.data = recipient
     return render_template('send_message.html', title=_('Send Message'),
-                           form=form, recipient=recipient)
+                           form=form)
+
+
+@bp.route('/usernames')
+@login_required
+def complete_usernames():
+    prefix = request.args.get('prefix', '').strip()
+    limit = request.args.get(
+        'limit', current_app.config['USERNAME_SUGGESTIONS'], type=int)
+    users = usernames.complete(prefix, max(1, min(limit, 20)))
+    return {'users': [
+        {'username': username, 'followers': followers,
+         'url': url_for('main.user', username=username)}
+        for username, user_id, followers in users]}
 
 
 @bp.route('/messages')
@@ -222,8 +250,11 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
-        db.session.commit()
+        try:
+            current_user.launch_task('export_posts', _('Exporting posts...'))
+            db.session.commit()
+        except TaskLimitError:
+            flash(_('Please wait for your other tasks to complete'))
     return redirect(url_for('main.user', username=current_user.username))
 
 
@@ -236,6 +267,6 @@ def notifications():
     notifications = db.session.scalars(query)
     return [{
         'name': n.name,
-        'data': n.get_data(),
+        'data': n.raw_data(),
         'timestamp': n.timestamp
     } for n in notifications]
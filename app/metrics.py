@@ -0,0 +1,189 @@
+import os
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+from flask import Response, g, request
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, \
+    CollectorRegistry, Counter, Gauge, Histogram, generate_latest, \
+    multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from app.instrumentation import add_timing
+
+# When PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py) every process
+# writes its samples to a memory-mapped file in that directory and a scrape
+# aggregates all of them, so any gunicorn worker can answer /metrics.
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+REQUEST_LATENCY = Histogram(
+    'microblog_request_duration_seconds', 'HTTP request latency.',
+    ['endpoint', 'method', 'status'])
+POOL_CHECKOUT = Histogram(
+    'microblog_db_pool_checkout_seconds',
+    'Time spent waiting for a database connection from the pool.',
+    buckets=(.0005, .001, .005, .01, .05, .1, .5, 1, 5))
+EXTERNAL_LATENCY = Histogram(
+    'microblog_external_call_duration_seconds',
+    'Latency of calls to Redis, Elasticsearch, the translator and SMTP.',
+    ['service', 'operation'])
+EXTERNAL_ERRORS = Counter(
+    'microblog_external_call_errors_total',
+    'Failed calls to Redis, Elasticsearch, the translator and SMTP.',
+    ['service', 'operation'])
+JOB_DURATION = Histogram(
+    'microblog_job_duration_seconds', 'Background job duration.',
+    ['task', 'status'], buckets=(.1, .5, 1, 5, 10, 30, 60, 300, 900, 3600))
+CACHE_REQUESTS = Counter(
+    'microblog_cache_requests_total',
+    'Cache lookups, by cache and result (hit or miss).',
+    ['cache', 'result'])
+CIRCUIT_STATE = Gauge(
+    'microblog_circuit_state',
+    'Circuit breaker state: 0 closed, 1 half-open, 2 open.', ['service'],
+    multiprocess_mode='max')
+CIRCUIT_REJECTIONS = Counter(
+    'microblog_circuit_rejections_total',
+    'Calls rejected without trying because the circuit was open.',
+    ['service'])
+RATE_LIMITED = Counter(
+    'microblog_rate_limited_total',
+    'Requests rejected for going over a rate limit.', ['scope'])
+_CIRCUIT_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+# Server-Timing phase names for each external service
+_TIMING_PHASES = {'elasticsearch': 'search', 'translator': 'translate'}
+
+
+@contextmanager
+def track_call(service, operation):
+    """Time a call to an external service and count it if it raises."""
+    start = perf_counter()
+    try:
+        yield
+    except Exception:
+        EXTERNAL_ERRORS.labels(service, operation).inc()
+        raise
+    finally:
+        duration = perf_counter() - start
+        EXTERNAL_LATENCY.labels(service, operation).observe(duration)
+        add_timing(_TIMING_PHASES.get(service, service), duration)
+
+
+def record_error(service, operation):
+    """Count a failure that was reported without raising an exception."""
+    EXTERNAL_ERRORS.labels(service, operation).inc()
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def record_circuit_state(service, state):
+    CIRCUIT_STATE.labels(service).set(_CIRCUIT_STATES[state])
+
+
+def record_circuit_rejection(service):
+    CIRCUIT_REJECTIONS.labels(service).inc()
+
+
+def record_rate_limited(scope):
+    RATE_LIMITED.labels(scope).inc()
+
+
+def track_job(f):
+    """Record the duration of an RQ task function."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        start = perf_counter()
+        status = 'failed'
+        try:
+            rv = f(*args, **kwargs)
+            status = 'finished'
+            return rv
+        finally:
+            JOB_DURATION.labels(f.__name__, status).observe(
+                perf_counter() - start)
+    return wrapped
+
+
+class QueueDepthCollector:
+    """Report the length of the RQ queues at scrape time."""
+    def __init__(self, app):
+        self.app = app
+
+    def collect(self):
+        depth = GaugeMetricFamily('microblog_rq_queue_depth',
+                                  'Jobs waiting in the RQ queue.',
+                                  labels=['queue'])
+        try:
+            with track_call('redis', 'queue_depth'):
+                for queue in self.app.task_queues.values():
+                    depth.add_metric([queue.name], queue.count)
+        except Exception:
+            pass
+        yield depth
+
+
+def _instrument_engine(engine):
+    # the pool has no "checkout started" event, so time the call that
+    # blocks on it instead
+    if getattr(engine, '_checkout_timed', False):
+        return
+    raw_connection = engine.raw_connection
+
+    def timed_raw_connection():
+        start = perf_counter()
+        try:
+            return raw_connection()
+        finally:
+            POOL_CHECKOUT.observe(perf_counter() - start)
+
+    engine.raw_connection = timed_raw_connection
+    engine._checkout_timed = True
+
+
+class _ProcessCollector:
+    def collect(self):
+        return REGISTRY.collect()
+
+
+def make_registry(app):
+    """Build the registry served to Prometheus by this process."""
+    registry = CollectorRegistry()
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(_ProcessCollector())
+    registry.register(QueueDepthCollector(app))
+    return registry
+
+
+def init_app(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+    from app import db
+    with app.app_context():
+        engines = list(db.engines.values()) + \
+            app.extensions.get('replicas', [])
+        for engine in engines:
+            _instrument_engine(engine)
+    registry = make_registry(app)
+
+    @app.before_request
+    def start_request_timer():
+        g._request_start = perf_counter()
+
+    @app.after_request
+    def observe_request_latency(response):
+        start = g.pop('_request_start', None)
+        if start is not None:
+            REQUEST_LATENCY.labels(
+                request.endpoint or 'unmatched', request.method,
+                response.status_code).observe(perf_counter() - start)
+        return response
+
+    def metrics():
+        return Response(generate_latest(registry),
+                        mimetype=CONTENT_TYPE_LATEST)
+
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -1,47 +1,89 @@
 from datetime import datetime, timezone, timedelta
 from hashlib import md5
-import json
 import secrets
 from time import time
 from typing import Optional
 import sqlalchemy as sa
 import sqlalchemy.orm as so
+from sqlalchemy.dialects import postgresql, sqlite
 from flask import current_app, url_for
 from flask_login import UserMixin
+from markupsafe import Markup
 from werkzeug.security import generate_password_hash, check_password_hash
-import jwt
-import redis
-import rq
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import db, explorefeed, followgraph, login, usernames, workers
+from app.circuit import ServiceError, guarded
+from app.metrics import track_call
+from app.serializers import RawJSON
+from app.search import add_to_index, remove_from_index, query_index, \
+    search_index, update_documents
 
 
 class SearchableMixin:
+    @classmethod
+    def load_related(cls, query):
+        return query
+
+    def search_document(self):
+        """Return the document of this object in the search index."""
+        return {field: getattr(self, field) for field in self.__searchable__}
+
+    @classmethod
+    def load_ids(cls, ids):
+        """Return the objects with the given ids, in the same order."""
+        if not ids:
+            return []
+        when = []
+        for i in range(len(ids)):
+            when.append((ids[i], i))
+        
+        query = cls.load_related(sa.select(cls).where(
+            cls.id.in_(ids)).order_by(db.case(*when, value=cls.id)))
+        return db.session.scalars(query)
+
     @classmethod
     def search(cls, expression, page, per_page):
         try:
             ids, total = query_index(cls.__tablename__, expression, page, per_page)
             if total == 0:
                 return db.session.scalars(sa.select(cls).where(False)), 0
-            
-            when = []
-            for i in range(len(ids)):
-                when.append((ids[i], i))
-            
-            query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-                db.case(*when, value=cls.id))
-            return db.session.scalars(query), total
+            return cls.load_ids(ids), total
         except Exception as e:
             # Log the error and return empty results
             current_app.logger.error(f'Error in search for {cls.__tablename__}: {e}')
             return db.session.scalars(sa.select(cls).where(False)), 0
 
+    @classmethod
+    def search_page(cls, expression, per_page, cursor=None,
+                    from_source=False):
+        """Return a page of results, the total and the cursor of the next
+        page, see search_index().
+
+        With from_source the results are built from the documents stored
+        in the index, with the matches highlighted, by the from_document()
+        class method of the model, and the database is not queried.
+        """
+        if from_source and not hasattr(cls, 'from_document'):
+            raise TypeError(f'{cls.__name__} results cannot be built from '
+                            'the search index')
+        hits, total, cursor = search_index(
+            cls.__tablename__, expression, cls.__searchable__, per_page,
+            cursor, source=from_source,
+            highlight=cls.__searchable__ if from_source else ())
+        if from_source:
+            return [cls.from_document(int(hit['_id']), hit['_source'],
+                                      hit.get('highlight', {}))
+                    for hit in hits], total, cursor
+        return cls.load_ids([int(hit['_id']) for hit in hits]), total, cursor
+
     @classmethod
     def before_commit(cls, session):
         session._changes = {
             'add': list(session.new),
             'update': list(session.dirty),
-            'delete': list(session.deleted)
+            'delete': list(session.deleted),
+            # the posts of a user store the username and avatar
+            'authors': [obj for obj in session.dirty
+                        if isinstance(obj, User) and obj.author_changed()]
         }
 
     @classmethod
@@ -56,6 +98,9 @@ class SearchableMixin:
             for obj in session._changes['delete']:
                 if isinstance(obj, SearchableMixin):
                     remove_from_index(obj.__tablename__, obj)
+            for user in session._changes['authors']:
+                update_documents(Post.__tablename__, {'user_id': user.id},
+                                 {'author': user.search_author()})
         except Exception as e:
             current_app.logger.error(f'Error in after_commit: {e}')
         finally:
@@ -83,11 +128,15 @@ db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 class PaginatedAPIMixin(object):
     @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    def to_collection_dict(query, page, per_page, endpoint, fields=None,
+                           **kwargs):
         resources = db.paginate(query, page=page, per_page=per_page,
                                 error_out=False)
+        if fields is not None:
+            kwargs['fields'] = ','.join(sorted(fields))
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': [item.to_dict(fields=fields)
+                      for item in resources.items],
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -112,10 +161,32 @@ followers = sa.Table(
     sa.Column('follower_id', sa.Integer, sa.ForeignKey('user.id'),
               primary_key=True),
     sa.Column('followed_id', sa.Integer, sa.ForeignKey('user.id'),
-              primary_key=True)
+              primary_key=True),
+    sa.Index('ix_followers_followed_id_follower_id', 'followed_id',
+             'follower_id')
 )
 
 
+def insert_ignore(table, **values):
+    """Return an INSERT of one row that does nothing if the row exists."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).values(**values) \
+            .on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(table).values(**values).on_conflict_do_nothing()
+    if dialect in ('mysql', 'mariadb'):
+        return sa.insert(table).values(**values).prefix_with('IGNORE')
+    exists = sa.select(table).filter_by(**values).exists()
+    return sa.insert(table).from_select(
+        list(values), sa.select(*map(sa.literal, values.values()))
+        .where(~exists))
+
+
+def gravatar(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
+
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     username: so.Mapped[str] = so.mapped_column(sa.String(64), index=True,
@@ -158,54 +229,117 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    def avatar_digest(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return gravatar(self.avatar_digest(), size)
+
+    def search_author(self):
+        """Return the author fields stored with the user's posts in the
+        search index."""
+        return {'username': self.username, 'avatar': self.avatar_digest()}
+
+    def author_changed(self):
+        state = sa.inspect(self)
+        return state.attrs.username.history.has_changes() or \
+            state.attrs.email.history.has_changes()
 
     def follow(self, user):
-        if not self.is_following(user):
-            self.following.add(user)
+        """Follow user. Returns False if user was already followed.
+
+        This is a single statement that ignores duplicates, so concurrent
+        requests to follow the same user cannot fail or insert twice."""
+        if self.id is None or user.id is None:
+            db.session.flush()
+        result = db.session.execute(insert_ignore(
+            followers, follower_id=self.id, followed_id=user.id))
+        if result.rowcount:
+            followgraph.record(db.session, 'add', self.id, user.id)
+            db.session.execute(sa.delete(Suggestion).where(
+                Suggestion.user_id == self.id,
+                Suggestion.suggested_id == user.id))
+        return result.rowcount > 0
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.following.remove(user)
+        """Unfollow user. Returns False if user was not followed."""
+        result = db.session.execute(followers.delete().where(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))
+        if result.rowcount:
+            followgraph.record(db.session, 'remove', self.id, user.id)
+        return result.rowcount > 0
 
     def is_following(self, user):
-        query = self.following.select().where(User.id == user.id)
-        return db.session.scalar(query) is not None
+        following = followgraph.pending_state(db.session, self.id, user.id)
+        if following is None:
+            following = followgraph.is_member('following', self.id, user.id)
+        if following is None:
+            query = self.following.select().where(User.id == user.id)
+            following = db.session.scalar(query) is not None
+        return following
+
+    def _follow_count(self, kind):
+        count = followgraph.count(kind, self.id)
+        if count is None:
+            query = sa.select(sa.func.count()).select_from(
+                getattr(self, kind).select().subquery())
+            return db.session.scalar(query)
+        return count + followgraph.pending_delta(db.session, kind, self.id)
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self._follow_count('followers')
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self._follow_count('following')
+
+    def known_followers(self, user, limit=3):
+        """Return users followed by this user that also follow user."""
+        ids = followgraph.known_followers(self.id, user.id)
+        if ids is not None:
+            if not ids:
+                return []
+            query = sa.select(User).where(User.id.in_(ids[:limit]))
+        else:
+            followed = sa.select(followers.c.followed_id).where(
+                followers.c.follower_id == self.id)
+            query = user.followers.select().where(
+                User.id.in_(followed)).limit(limit)
+        return db.session.scalars(query.order_by(User.username)).all()
 
     def following_posts(self):
-        Author = so.aliased(User)
-        Follower = so.aliased(User)
-        return (
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        return Post.load_related(
             sa.select(Post)
-            .join(Post.author.of_type(Author))
-            .join(Author.followers.of_type(Follower), isouter=True)
             .where(sa.or_(
-                Follower.id == self.id,
-                Author.id == self.id,
+                Post.user_id.in_(followed),
+                Post.user_id == self.id,
             ))
-            .group_by(Post)
             .order_by(Post.timestamp.desc())
         )
 
+    def follow_suggestions(self, limit=5):
+        query = sa.select(User).join(
+            Suggestion, Suggestion.suggested_id == User.id).where(
+                Suggestion.user_id == self.id).order_by(
+                    Suggestion.score.desc(), Suggestion.suggested_id).limit(
+                        limit)
+        return db.session.scalars(query).all()
+
+    def user_posts(self):
+        return Post.load_related(
+            self.posts.select().order_by(Post.timestamp.desc()))
+
     def get_reset_password_token(self, expires_in=600):
+        import jwt
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
             current_app.config['SECRET_KEY'], algorithm='HS256')
 
     @staticmethod
     def verify_reset_password_token(token):
+        import jwt
         try:
             id = jwt.decode(token, current_app.config['SECRET_KEY'],
                             algorithms=['HS256'])['reset_password']
@@ -223,13 +357,20 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def add_notification(self, name, data):
         db.session.execute(self.notifications.delete().where(
             Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=current_app.json.dumps(data),
+                         user=self)
         db.session.add(n)
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
+        if name in workers.HEAVY_TASKS and self.heavy_tasks_in_progress() >= \
+                current_app.config['HEAVY_TASKS_PER_USER']:
+            raise workers.TaskLimitError(
+                f'{self.username} has too many tasks in progress')
+        queue = current_app.task_queues[workers.queue_for(name)]
+        with track_call('redis', 'enqueue'):
+            rq_job = queue.enqueue(f'app.tasks.{name}', self.id, *args,
+                                   **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description,
                     user=self)
         db.session.add(task)
@@ -239,6 +380,12 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         query = self.tasks.select().where(Task.complete == False)
         return db.session.scalars(query)
 
+    def heavy_tasks_in_progress(self):
+        query = sa.select(sa.func.count()).select_from(Task).where(
+            Task.user_id == self.id, Task.complete == False,
+            Task.name.in_(workers.HEAVY_TASKS))
+        return db.session.scalar(query)
+
     def get_task_in_progress(self, name):
         query = self.tasks.select().where(Task.name == name,
                                           Task.complete == False)
@@ -249,24 +396,37 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             self.posts.select().subquery())
         return db.session.scalar(query)
 
-    def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.replace(
-                tzinfo=timezone.utc).isoformat(),
-            'about_me': self.about_me,
-            'post_count': self.posts_count(),
-            'follower_count': self.followers_count(),
-            'following_count': self.following_count(),
-            '_links': {
+    def to_dict(self, include_email=False, fields=None):
+        """Return the API representation of the user.
+
+        With fields, a set of field names, only those fields and the id are
+        included, and the counts and links that were not requested are not
+        computed."""
+        def wanted(field):
+            return fields is None or field in fields
+
+        data = {'id': self.id}
+        if wanted('username'):
+            data['username'] = self.username
+        if wanted('last_seen'):
+            data['last_seen'] = self.last_seen.replace(
+                tzinfo=timezone.utc).isoformat()
+        if wanted('about_me'):
+            data['about_me'] = self.about_me
+        if wanted('post_count'):
+            data['post_count'] = self.posts_count()
+        if wanted('follower_count'):
+            data['follower_count'] = self.followers_count()
+        if wanted('following_count'):
+            data['following_count'] = self.following_count()
+        if wanted('_links'):
+            data['_links'] = {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
                 'following': url_for('api.get_following', id=self.id),
                 'avatar': self.avatar(128)
             }
-        }
-        if include_email:
+        if include_email and wanted('email'):
             data['email'] = self.email
         return data
 
@@ -300,6 +460,17 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return user
 
 
+@db.event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, user):
+    usernames.record(so.object_session(user), user.id, user.username)
+
+
+@db.event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, user):
+    if sa.inspect(user).attrs.username.history.has_changes():
+        usernames.record(so.object_session(user), user.id, user.username)
+
+
 @login.user_loader
 def load_user(id):
     return db.session.get(User, int(id))
@@ -307,12 +478,14 @@ def load_user(id):
 
 class Post(SearchableMixin, db.Model):
     __searchable__ = ['body']
+    __table_args__ = (
+        sa.Index('ix_post_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=lambda: datetime.now(timezone.utc))
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                               index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     language: so.Mapped[Optional[str]] = so.mapped_column(sa.String(5))
 
     author: so.Mapped[User] = so.relationship(back_populates='posts')
@@ -320,13 +493,76 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @classmethod
+    def load_related(cls, query):
+        # _post.html only needs the author's username and the email that
+        # feeds the avatar, so fetch those for the whole page in one query
+        return query.options(so.selectinload(cls.author).load_only(
+            User.username, User.email))
+
+    @classmethod
+    def explore_posts(cls):
+        return cls.load_related(
+            sa.select(cls).order_by(cls.timestamp.desc()))
+
+    @staticmethod
+    def build_document(body, timestamp, language, author):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        # the author is stored as well, for search pages rendered from the
+        # index alone
+        return {'body': body, 'timestamp': timestamp.isoformat(),
+                'language': language, 'user_id': author.id,
+                'author': author.search_author()}
+
+    def search_document(self):
+        return self.build_document(self.body, self.timestamp, self.language,
+                                   self.author)
+
+    @classmethod
+    def from_document(cls, id, document, highlight):
+        """Return the post to render for a document of the search index
+        and its highlighted fields."""
+        return IndexedPost(id, document, highlight.get('body', [None])[0])
+
+
+class IndexedAuthor:
+    def __init__(self, username, avatar):
+        self.username = username
+        self.avatar_digest = avatar
+
+    def avatar(self, size):
+        return gravatar(self.avatar_digest, size)
+
+
+class IndexedPost:
+    """A post as stored in the search index, with what _post.html needs.
+
+    highlight is the body with the matches in <mark> tags, escaped by
+    Elasticsearch."""
+    def __init__(self, id, document, highlight=None):
+        self.id = id
+        self.body = document['body']
+        self.timestamp = datetime.fromisoformat(document['timestamp'])
+        self.language = document.get('language')
+        self.author = IndexedAuthor(**document['author'])
+        self.highlight = Markup(highlight) if highlight else None
+
+
+@db.event.listens_for(Post, 'after_insert')
+def _post_inserted(mapper, connection, post):
+    explorefeed.record(so.object_session(post), post.id)
+
 
 class Message(db.Model):
+    __table_args__ = (
+        sa.Index('ix_message_recipient_id_timestamp', 'recipient_id',
+                 'timestamp'),
+    )
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     sender_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
                                                  index=True)
-    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                                    index=True)
+    recipient_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     body: so.Mapped[str] = so.mapped_column(sa.String(140))
     timestamp: so.Mapped[datetime] = so.mapped_column(
         index=True, default=lambda: datetime.now(timezone.utc))
@@ -343,20 +579,43 @@ class Message(db.Model):
 
 
 class Notification(db.Model):
+    __table_args__ = (
+        sa.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+        sa.Index('ix_notification_user_id_name', 'user_id', 'name'),
+    )
     id: so.Mapped[int] = so.mapped_column(primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
-    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
-                                               index=True)
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     timestamp: so.Mapped[float] = so.mapped_column(index=True, default=time)
     payload_json: so.Mapped[str] = so.mapped_column(sa.Text)
 
     user: so.Mapped[User] = so.relationship(back_populates='notifications')
 
     def get_data(self):
-        return json.loads(str(self.payload_json))
+        return current_app.json.loads(self.payload_json)
+
+    def raw_data(self):
+        """The payload as stored, to include in a response unparsed."""
+        return RawJSON(self.payload_json)
+
+
+class Suggestion(db.Model):
+    __table_args__ = (
+        sa.Index('ix_suggestion_user_id_score', 'user_id', 'score'),
+    )
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
+                                               primary_key=True)
+    suggested_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
+                                                    primary_key=True)
+    score: so.Mapped[int]
+
+    suggested: so.Mapped[User] = so.relationship(foreign_keys=suggested_id)
 
 
 class Task(db.Model):
+    __table_args__ = (
+        sa.Index('ix_task_user_id_complete', 'user_id', 'complete'),
+    )
     id: so.Mapped[str] = so.mapped_column(sa.String(36), primary_key=True)
     name: so.Mapped[str] = so.mapped_column(sa.String(128), index=True)
     description: so.Mapped[Optional[str]] = so.mapped_column(sa.String(128))
@@ -366,9 +625,12 @@ class Task(db.Model):
     user: so.Mapped[User] = so.relationship(back_populates='tasks')
 
     def get_rq_job(self):
+        import rq
         try:
-            rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
+            with guarded('redis', 'fetch_job'):
+                rq_job = rq.job.Job.fetch(self.id,
+                                          connection=current_app.redis)
+        except (ServiceError, rq.exceptions.NoSuchJobError):
             return None
         return rq_job
 
@@ -0,0 +1,70 @@
+"""Production settings for SQLite databases.
+
+SQLite's defaults suit a single process: a rollback journal, under which a
+writer blocks every reader, a 2 MB page cache, no memory mapping, and no
+waiting at all for a lock, so concurrent gunicorn workers get "database is
+locked" errors. Every new connection to a SQLite file is set up with:
+
+- ``journal_mode=WAL``: readers do not block the writer or each other
+- ``synchronous=NORMAL``: no fsync per commit, which is safe with WAL; a
+  power loss can lose the last commits but not corrupt the database
+- ``busy_timeout``: wait up to ``SQLITE_BUSY_TIMEOUT`` ms for a lock
+- ``cache_size`` and ``mmap_size``: ``SQLITE_CACHE_SIZE`` and
+  ``SQLITE_MMAP_SIZE`` bytes, shared by the processes through the page
+  cache for the memory map
+- ``temp_store=MEMORY``: temporary tables and indexes for sorts in memory
+
+Set ``SQLITE_TUNING=0`` to keep the defaults. In-memory databases are left
+alone.
+"""
+from functools import partial
+from sqlalchemy import event
+
+
+def is_file_database(url):
+    return url.startswith('sqlite') and \
+        url.split('?')[0] not in ('sqlite://', 'sqlite:///:memory:')
+
+
+def configure(app):
+    """Set the engine options, before the engines are created.
+
+    Each process keeps a few connections; a writer holds the single write
+    lock for the length of its transaction anyway, so more connections
+    only wait longer.
+    """
+    if not app.config['SQLITE_TUNING'] or \
+            not is_file_database(app.config['SQLALCHEMY_DATABASE_URI']):
+        return
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_size', app.config['SQLITE_POOL_SIZE'])
+    options.setdefault('max_overflow', 0)
+    options.setdefault('pool_timeout', 30)
+    # the Python driver's own wait for a lock, in seconds
+    options.setdefault('connect_args', {}).setdefault(
+        'timeout', app.config['SQLITE_BUSY_TIMEOUT'] / 1000)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+
+def apply_pragmas(dbapi_connection, connection_record, config):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA busy_timeout={int(config["SQLITE_BUSY_TIMEOUT"])}')
+    # a negative cache_size is in KiB
+    cursor.execute(
+        f'PRAGMA cache_size=-{int(config["SQLITE_CACHE_SIZE"]) // 1024}')
+    cursor.execute(f'PRAGMA mmap_size={int(config["SQLITE_MMAP_SIZE"])}')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
+
+def init_app(app):
+    if not app.config['SQLITE_TUNING']:
+        return
+    with app.app_context():
+        engines = list(app.extensions['sqlalchemy'].engines.values())
+    for engine in engines + app.extensions.get('replicas', []):
+        if is_file_database(str(engine.url)):
+            event.listen(engine, 'connect',
+                         partial(apply_pragmas, config=app.config))
@@ -0,0 +1,84 @@
+import cProfile
+import os
+import re
+import time
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from werkzeug.wrappers import Request
+
+_unsafe = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def _serializer(app):
+    return URLSafeTimedSerializer(app.config['SECRET_KEY'],
+                                  salt='request-profile')
+
+
+def generate_profile_token(app, admin):
+    """Return a token that enables profiling of a request for admin."""
+    return _serializer(app).dumps(admin)
+
+
+def verify_profile_token(app, token):
+    try:
+        return _serializer(app).loads(
+            token, max_age=app.config['PROFILE_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return None
+
+
+class ProfilerMiddleware:
+    """Profile single requests that carry a signed profiling token.
+
+    The token is given in the ``X-Profile-Token`` header or the ``_profile``
+    query string argument. Profiles are written in pstats format to the
+    configured directory, so they can be opened with ``python -m pstats`` or
+    a viewer such as snakeviz. Requests without a token only pay for a
+    dictionary lookup and a substring test.
+    """
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if 'HTTP_X_PROFILE_TOKEN' not in environ and \
+                '_profile=' not in environ.get('QUERY_STRING', ''):
+            return self.wsgi_app(environ, start_response)
+        request = Request(environ)
+        token = request.headers.get('X-Profile-Token') or \
+            request.args.get('_profile')
+        admin = verify_profile_token(self.app, token)
+        if admin is None:
+            return self.wsgi_app(environ, start_response)
+
+        profiler = cProfile.Profile()
+        start = time.time()
+        profiler.enable()
+        try:
+            # consume the response inside the profiler so that streamed
+            # bodies and lazily rendered templates are included
+            response = self.wsgi_app(environ, start_response)
+            try:
+                body = b''.join(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        finally:
+            profiler.disable()
+            self.save(profiler, request, admin, time.time() - start)
+        return [body]
+
+    def save(self, profiler, request, admin, elapsed):
+        directory = self.app.config['PROFILE_DIR']
+        os.makedirs(directory, exist_ok=True)
+        filename = '{}.{}.{}.{:.0f}ms.prof'.format(
+            time.strftime('%Y%m%d-%H%M%S'), request.method,
+            _unsafe.sub('_', request.path.strip('/')) or 'root',
+            elapsed * 1000)
+        path = os.path.join(directory, filename)
+        profiler.dump_stats(path)
+        self.app.logger.info('Request profile for %s saved to %s', admin,
+                             path)
+
+
+def init_app(app):
+    app.wsgi_app = ProfilerMiddleware(app.wsgi_app, app)
@@ -0,0 +1,171 @@
+"""Token bucket rate limiting for the expensive endpoints.
+
+``RATE_LIMITS`` maps an endpoint (``main.search``) or a blueprint (``api``)
+to a limit such as ``'30/minute'``, and the most specific match applies.
+Each client has a bucket per limit, holding up to the number of requests of
+the limit and refilled at its rate, so short bursts are allowed while the
+average stays under the limit. Clients are told apart by their API token,
+their login, or otherwise their IP address.
+
+Buckets are kept in Redis and updated by a Lua script, so that all the
+workers share them and a check is a single round trip. While Redis is
+unavailable every process falls back to buckets of its own.
+
+Responses of limited endpoints carry ``RateLimit-Limit``,
+``RateLimit-Remaining`` and ``RateLimit-Reset`` headers, and requests over
+the limit get a 429 with ``Retry-After``.
+"""
+from hashlib import sha256
+from math import ceil
+import threading
+from time import monotonic
+from flask import abort, current_app, g, request
+from flask_login import current_user
+from app.circuit import CircuitOpenError, ServiceError, guarded
+from app.metrics import record_rate_limited
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+# take a token from the bucket in KEYS[1] if there is one; ARGV holds the
+# capacity and the refill rate in tokens per second
+_TAKE_SCRIPT = """
+redis.replicate_commands()
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated',
+           tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000))
+return {allowed, tostring(tokens)}
+"""
+
+
+def parse_limit(limit):
+    """Return the capacity and the rate per second of a 'N/period' limit."""
+    count, _, period = limit.partition('/')
+    count = int(count)
+    return count, count / PERIODS[period.strip().rstrip('s')]
+
+
+class LocalBuckets:
+    """Token buckets in process memory, for when Redis is unavailable."""
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, capacity, rate):
+        now = monotonic()
+        with self.lock:
+            tokens, updated, _ = self.buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            if key not in self.buckets and \
+                    len(self.buckets) >= self.max_size:
+                self._prune(now)
+            self.buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+        return allowed, tokens
+
+    def _prune(self, now):
+        # buckets that are full again are the same as missing ones
+        self.buckets = {key: bucket for key, bucket in self.buckets.items()
+                        if bucket[2] > now}
+        if len(self.buckets) >= self.max_size:
+            self.buckets.clear()
+
+
+class RateLimiter:
+    def __init__(self, app):
+        self.limits = {scope: parse_limit(limit)
+                       for scope, limit in app.config['RATE_LIMITS'].items()}
+        self.storage = app.config['RATE_LIMIT_STORAGE']
+        self.local = LocalBuckets()
+        self._script = None
+
+    def limit_for(self, endpoint, blueprint):
+        """Return the scope and the limit that apply to an endpoint."""
+        for scope in (endpoint, blueprint):
+            if scope in self.limits:
+                return scope, self.limits[scope]
+        return None, None
+
+    def take(self, key, capacity, rate):
+        """Take a token from a bucket, return whether there was one and the
+        tokens left."""
+        if self.storage == 'redis':
+            if self._script is None:
+                self._script = current_app.redis.register_script(
+                    _TAKE_SCRIPT)
+            try:
+                with guarded('redis', 'rate_limit'):
+                    allowed, tokens = self._script(keys=[key],
+                                                   args=[capacity, rate])
+                return bool(allowed), float(tokens)
+            except ServiceError as e:
+                if not isinstance(e, CircuitOpenError):
+                    current_app.logger.warning(
+                        'Rate limiting without Redis: %s', e)
+        return self.local.take(key, capacity, rate)
+
+
+def client_identity():
+    """Return the API token, user or IP address the request comes from.
+
+    Invalid tokens count as the IP address, or a client could get a new
+    bucket for every request by making up tokens. The token's user is
+    looked up once per request, for the API's authentication as well."""
+    from app.api.auth import token_user
+    auth = request.authorization
+    if auth is not None and auth.type == 'bearer' and auth.token and \
+            token_user(auth.token) is not None:
+        return 'token:' + sha256(auth.token.encode()).hexdigest()[:32]
+    if current_user.is_authenticated:
+        return f'user:{current_user.id}'
+    return f'ip:{request.remote_addr}'
+
+
+def check_rate_limit():
+    g.pop('rate_limit', None)
+    if not current_app.config['RATE_LIMITING']:
+        return
+    limiter = current_app.extensions['rate_limiter']
+    scope, limit = limiter.limit_for(request.endpoint, request.blueprint)
+    if limit is None:
+        return
+    capacity, rate = limit
+    allowed, tokens = limiter.take(
+        f'ratelimit:{scope}:{client_identity()}', capacity, rate)
+    g.rate_limit = (capacity, rate, tokens)
+    if not allowed:
+        record_rate_limited(scope)
+        abort(429)
+
+
+def add_rate_limit_headers(response):
+    if 'rate_limit' in g:
+        capacity, rate, tokens = g.rate_limit
+        response.headers['RateLimit-Limit'] = str(capacity)
+        response.headers['RateLimit-Remaining'] = str(int(tokens))
+        response.headers['RateLimit-Reset'] = str(
+            ceil((capacity - tokens) / rate))
+        if response.status_code == 429:
+            response.headers['Retry-After'] = str(ceil((1 - tokens) / rate))
+    return response
+
+
+def init_app(app):
+    app.extensions['rate_limiter'] = RateLimiter(app)
+    app.before_request(check_rate_limit)
+    app.after_request(add_rate_limit_headers)
@@ -0,0 +1,110 @@
+"""Routing of read-only queries to database replicas.
+
+Reads go to a replica, unless the session has already written in the
+current request, in which case they stay on the primary so the request
+sees its own writes. Views can override this with ``use_primary`` and
+``use_replica``. Replicas that lag behind the primary by more than
+``REPLICA_MAX_LAG`` seconds are skipped.
+"""
+from functools import wraps
+import random
+from time import monotonic
+import sqlalchemy as sa
+from flask import current_app
+from flask_sqlalchemy.session import Session
+
+LAG_QUERIES = {
+    'postgresql': 'SELECT COALESCE(EXTRACT(EPOCH FROM now() - '
+                  'pg_last_xact_replay_timestamp()), 0)',
+}
+_lag_checks = {}
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None:
+            if self._is_write(clause):
+                self.info['db_pinned'] = True
+            elif self._can_use_replica(clause):
+                replica = choose_replica()
+                if replica is not None:
+                    return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind,
+                                **kwargs)
+
+    def _is_write(self, clause):
+        return self._flushing or isinstance(clause, sa.sql.dml.UpdateBase) \
+            or getattr(clause, '_for_update_arg', None) is not None
+
+    def _can_use_replica(self, clause):
+        if self.info.get('db_primary') or self.info.get('db_pinned'):
+            return False
+        return isinstance(clause, (sa.Select, sa.CompoundSelect))
+
+
+def replica_lag(engine):
+    """Return how many seconds the replica is behind its primary."""
+    query = current_app.config['REPLICA_LAG_QUERY'] or \
+        LAG_QUERIES.get(engine.dialect.name)
+    if query is None:
+        return 0
+    with engine.connect() as conn:
+        return float(conn.exec_driver_sql(query).scalar() or 0)
+
+
+def _is_fresh(engine):
+    now = monotonic()
+    checked = _lag_checks.get(engine)
+    if checked is not None and checked[0] > now:
+        return checked[1]
+    try:
+        fresh = replica_lag(engine) <= current_app.config['REPLICA_MAX_LAG']
+    except sa.exc.SQLAlchemyError as e:
+        current_app.logger.warning('Replica lag check failed: %s', e)
+        fresh = False
+    _lag_checks[engine] = (
+        now + current_app.config['REPLICA_LAG_CHECK_INTERVAL'], fresh)
+    return fresh
+
+
+def choose_replica():
+    """Return a replica engine that is fresh enough, or None."""
+    engines = current_app.extensions.get('replicas')
+    if not engines:
+        return None
+    fresh = [engine for engine in engines if _is_fresh(engine)]
+    return random.choice(fresh) if fresh else None
+
+
+def use_primary(f):
+    """Run all the queries of a view on the primary."""
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        from app import db
+        db.session.info['db_primary'] = True
+        return f(*args, **kwargs)
+    return wrapped
+
+
+def use_replica(f):
+    """Send the reads of a view to a replica even if the request has written.
+
+    Bookkeeping writes made before the view runs, such as the last_seen
+    update, then do not pin its reads to the primary. Writes made by the
+    view itself still do.
+    """
+    @wraps(f)
+    def wrapped(*args, **kwargs):
+        from app import db
+        db.session.info['db_pinned'] = False
+        return f(*args, **kwargs)
+    return wrapped
+
+
+def init_app(app):
+    # the replicas are not binds, as binds get their own metadata and
+    # create_all() would then try to create the tables on them
+    options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+    app.extensions['replicas'] = [
+        sa.create_engine(uri, **options)
+        for uri in app.config['SQLALCHEMY_REPLICA_URIS']]
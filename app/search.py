@@ -1,31 +1,135 @@
+import base64
+import json
+import os
+import threading
+import time
 from flask import current_app
-from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, NotFoundError
+from app.circuit import CircuitOpenError, ServiceError, guarded, timeout
 import logging
 
+
+class LazyElasticsearch:
+    """Elasticsearch client that connects on first use.
+
+    Creating the app makes no requests to Elasticsearch, so startup does not
+    wait for it. The first use starts a background thread that pings the
+    cluster every ELASTICSEARCH_PROBE_INTERVAL seconds and logs the cluster
+    info once it is reachable. The object is false while the last probe
+    failed, so the search functions skip Elasticsearch instead of waiting
+    for it to time out. Other attributes are those of the client.
+
+    The elasticsearch package is only imported on first use as well, as it
+    takes a large part of the startup time of the CLI and the workers.
+    """
+    def __init__(self, app, url):
+        self.app = app
+        self.url = url
+        self.healthy = True
+        self._client = None
+        self._probe_pid = None
+        self._logged_info = False
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None or self._probe_pid != os.getpid():
+            with self._lock:
+                if self._client is None:
+                    from elasticsearch import Elasticsearch
+                    self._client = Elasticsearch(
+                        [self.url],
+                        verify_certs=False,  # Disable SSL verification for simplicity
+                        max_retries=3,
+                        retry_on_timeout=True,
+                        request_timeout=10  # 10 second timeout
+                    )
+                # the probe thread does not survive a fork, so check the
+                # process as well
+                if self._probe_pid != os.getpid():
+                    self._probe_pid = os.getpid()
+                    threading.Thread(target=self._probe_loop, daemon=True,
+                                     name='elasticsearch-probe').start()
+        return self._client
+
+    def reset(self):
+        """Forget the client, for a process forked after it was created."""
+        self._client = None
+        self._probe_pid = None
+
+    def __bool__(self):
+        self.client
+        return self.healthy
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def probe(self):
+        """Check that the cluster is reachable and update healthy."""
+        client = self._client.options(
+            request_timeout=self.app.config['ELASTICSEARCH_PROBE_TIMEOUT'],
+            max_retries=0)
+        try:
+            healthy = client.ping()
+            if healthy and not self._logged_info:
+                info = client.info()
+                self._logged_info = True
+                self.app.logger.info(
+                    'Connected to Elasticsearch %s, cluster %s',
+                    info.get('version', {}).get('number', 'unknown'),
+                    info.get('cluster_name'))
+        except Exception as e:
+            self.app.logger.debug('Elasticsearch probe failed: %s', e)
+            healthy = False
+        if healthy != self.healthy:
+            log = self.app.logger.info if healthy else self.app.logger.warning
+            log('Elasticsearch at %s is %s', self.url,
+                'reachable' if healthy else 'unreachable')
+        self.healthy = healthy
+        return healthy
+
+    def _probe_loop(self):
+        pid = os.getpid()
+        while self._probe_pid == pid:
+            self.probe()
+            time.sleep(self.app.config['ELASTICSEARCH_PROBE_INTERVAL'])
+
+def _client():
+    """Return the client with the latency budget as timeout.
+
+    Retries are left to the circuit breaker."""
+    return current_app.elasticsearch.options(
+        request_timeout=timeout('elasticsearch'), max_retries=0)
+
+
 def ensure_index_exists(index):
     """Create index if it doesn't exist"""
     if not current_app.elasticsearch:
         return False
     
     try:
-        if not current_app.elasticsearch.indices.exists(index=index):
+        with guarded('elasticsearch', 'index_exists'):
+            exists = _client().indices.exists(index=index)
+        if not exists:
             # Create index with basic mapping
-            current_app.elasticsearch.indices.create(
-                index=index,
-                body={
-                    "settings": {
-                        "number_of_shards": 1,
-                        "number_of_replicas": 0
-                    },
-                    "mappings": {
-                        "properties": {
-                            "body": {"type": "text"}
+            with guarded('elasticsearch', 'create_index'):
+                _client().indices.create(
+                    index=index,
+                    body={
+                        "settings": {
+                            "number_of_shards": 1,
+                            "number_of_replicas": 0
+                        },
+                        "mappings": {
+                            "properties": {
+                                "body": {"type": "text"}
+                            }
                         }
                     }
-                }
-            )
+                )
             current_app.logger.info(f'Created Elasticsearch index: {index}')
         return True
+    except CircuitOpenError:
+        return False
     except Exception as e:
         current_app.logger.error(f'Error ensuring index {index} exists: {e}')
         return False
@@ -38,31 +142,72 @@ def add_to_index(index, model):
     if not ensure_index_exists(index):
         return
     
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
+    payload = model.search_document()
     
     try:
-        current_app.elasticsearch.index(index=index, id=model.id, document=payload)
-    except ConnectionTimeout as e:
-        current_app.logger.error(f'Elasticsearch timeout while indexing {index}/{model.id}: {e}')
-    except ConnectionError as e:
+        with guarded('elasticsearch', 'index'):
+            _client().index(index=index, id=model.id, document=payload)
+    except CircuitOpenError:
+        current_app.logger.debug(f'Elasticsearch circuit open, not indexing {index}/{model.id}')
+    except ServiceError as e:
         current_app.logger.error(f'Elasticsearch connection error while indexing {index}/{model.id}: {e}')
     except Exception as e:
         current_app.logger.error(f'Elasticsearch error while indexing {index}/{model.id}: {e}')
 
+def bulk_index(index, documents):
+    """Index a dict of documents by id with a single bulk request."""
+    if not documents or not current_app.elasticsearch:
+        return
+    if not ensure_index_exists(index):
+        return
+    operations = []
+    for id, document in documents.items():
+        operations.append({'index': {'_index': index, '_id': id}})
+        operations.append(document)
+    try:
+        with guarded('elasticsearch', 'bulk_index'):
+            result = _client().bulk(operations=operations)
+        if result.get('errors'):
+            failed = sum(1 for item in result['items']
+                         if item['index'].get('error'))
+            current_app.logger.error(f'Elasticsearch failed to index {failed} of {len(documents)} documents in {index}')
+    except CircuitOpenError:
+        current_app.logger.debug(f'Elasticsearch circuit open, not indexing {len(documents)} documents in {index}')
+    except ServiceError as e:
+        current_app.logger.error(f'Elasticsearch connection error while bulk indexing {index}: {e}')
+    except Exception as e:
+        current_app.logger.error(f'Elasticsearch error while bulk indexing {index}: {e}')
+
+def update_documents(index, term, changes):
+    """Set fields of the documents that match a term, in the background."""
+    if not current_app.elasticsearch:
+        return
+    try:
+        with guarded('elasticsearch', 'update_by_query'):
+            _client().update_by_query(
+                index=index, query={'term': term}, conflicts='proceed',
+                wait_for_completion=False,
+                script={'source': 'ctx._source.putAll(params.changes)',
+                        'params': {'changes': changes}})
+    except CircuitOpenError:
+        current_app.logger.debug(f'Elasticsearch circuit open, not updating documents of {index} with {term}')
+    except Exception as e:
+        current_app.logger.error(f'Elasticsearch error while updating documents of {index} with {term}: {e}')
+
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
+    from elasticsearch.exceptions import NotFoundError
     
     try:
-        current_app.elasticsearch.delete(index=index, id=model.id)
+        with guarded('elasticsearch', 'delete'):
+            _client().delete(index=index, id=model.id)
     except NotFoundError:
         # Document doesn't exist, which is fine for deletion
         pass
-    except ConnectionTimeout as e:
-        current_app.logger.error(f'Elasticsearch timeout while deleting {index}/{model.id}: {e}')
-    except ConnectionError as e:
+    except CircuitOpenError:
+        current_app.logger.debug(f'Elasticsearch circuit open, not deleting {index}/{model.id}')
+    except ServiceError as e:
         current_app.logger.error(f'Elasticsearch connection error while deleting {index}/{model.id}: {e}')
     except Exception as e:
         current_app.logger.error(f'Elasticsearch error while deleting {index}/{model.id}: {e}')
@@ -84,15 +229,18 @@ def query_index(index, query, page, per_page):
             'size': per_page
         }
         
-        search = current_app.elasticsearch.search(
-            index=index,
-            body=search_body
-        )
+        with guarded('elasticsearch', 'search'):
+            search = _client().search(
+                index=index,
+                body=search_body
+            )
         
         ids = [int(hit['_id']) for hit in search['hits']['hits']]
         total = search['hits']['total']['value']
         return ids, total
-        
+
+    except CircuitOpenError:
+        return [], 0
     except Exception as e:
         # If index doesn't exist, try to create it
         if "index_not_found_exception" in str(e):
@@ -100,10 +248,11 @@ def query_index(index, query, page, per_page):
             if ensure_index_exists(index):
                 # Try search again after creating index
                 try:
-                    search = current_app.elasticsearch.search(
-                        index=index,
-                        body=search_body
-                    )
+                    with guarded('elasticsearch', 'search'):
+                        search = _client().search(
+                            index=index,
+                            body=search_body
+                        )
                     ids = [int(hit['_id']) for hit in search['hits']['hits']]
                     total = search['hits']['total']['value']
                     return ids, total
@@ -112,4 +261,118 @@ def query_index(index, query, page, per_page):
                     return [], 0
         
         current_app.logger.error(f'Elasticsearch error while querying {index}: {e}')
-        return [], 0
\ No newline at end of file
+        return [], 0
+
+def encode_cursor(pit_id, search_after, offset=None):
+    data = json.dumps([pit_id, search_after, offset]).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the point in time, the sort values and the offset of a
+    cursor, or None if it is not one.
+
+    A cursor has either a point in time and the sort values of the last hit
+    of the previous page, or only the offset of the next page when no point
+    in time is open yet."""
+    try:
+        pit_id, search_after, offset = json.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        return None
+    if pit_id is None:
+        if not isinstance(offset, int) or isinstance(offset, bool) or \
+                offset < 0:
+            return None
+        return None, None, offset
+    if not isinstance(pit_id, str) or not isinstance(search_after, list):
+        return None
+    return pit_id, search_after, None
+
+
+def _close_point_in_time(pit_id):
+    try:
+        with guarded('elasticsearch', 'close_pit'):
+            _client().close_point_in_time(id=pit_id)
+    except Exception as e:
+        # it expires on its own anyway
+        current_app.logger.debug(f'Could not close a point in time: {e}')
+
+
+def search_index(index, query, fields, size, cursor=None, source=False,
+                 highlight=()):
+    """Return a page of hits, the total and the cursor of the next page.
+
+    The first page is a plain search, as most searches end there. Following
+    its cursor opens a point in time of the index, which the next cursors
+    carry along, and reads the pages after the sort values of the last hit
+    of the previous page. Deep pages then cost the same as the first one,
+    are not capped by the result window, and do not shift while someone
+    pages through them. The point in time is closed after the last page,
+    and an expired one starts the search over.
+
+    Hits have the stored document in ``_source`` when source is true, and
+    the fields in highlight with the matches in ``<mark>`` tags, HTML
+    escaped, in ``highlight``.
+    """
+    if not current_app.elasticsearch:
+        return [], 0, None
+    from elasticsearch import NotFoundError
+
+    keep_alive = current_app.config['SEARCH_PIT_KEEP_ALIVE']
+    position = decode_cursor(cursor) if cursor else None
+    pit_id, search_after, offset = position or (None, None, None)
+    options = {
+        'query': {'multi_match': {'query': query, 'fields': list(fields)}},
+        # one more hit than the page tells whether there is a next page
+        'size': size + 1,
+        'source': source,
+    }
+    if highlight:
+        options['highlight'] = {
+            'fields': {field: {'number_of_fragments': 0}
+                       for field in highlight},
+            'encoder': 'html', 'pre_tags': ['<mark>'],
+            'post_tags': ['</mark>']}
+    try:
+        if position is None:
+            with guarded('elasticsearch', 'search'):
+                result = _client().search(index=index, **options)
+        else:
+            if pit_id is None:
+                with guarded('elasticsearch', 'open_pit'):
+                    pit_id = _client().open_point_in_time(
+                        index=index, keep_alive=keep_alive)['id']
+                options['from_'] = offset
+            else:
+                options['search_after'] = search_after
+            with guarded('elasticsearch', 'search'):
+                result = _client().search(
+                    pit={'id': pit_id, 'keep_alive': keep_alive},
+                    sort=[{'_score': 'desc'}, {'_shard_doc': 'asc'}],
+                    **options)
+    except NotFoundError as e:
+        if search_after is not None:
+            current_app.logger.info(f'Search cursor of {index} expired, starting over: {e}')
+            return search_index(index, query, fields, size, None, source,
+                                highlight)
+        current_app.logger.info(f'Index {index} not found: {e}')
+        return [], 0, None
+    except CircuitOpenError:
+        return [], 0, None
+    except Exception as e:
+        current_app.logger.error(f'Elasticsearch error while querying {index}: {e}')
+        return [], 0, None
+
+    hits = result['hits']['hits']
+    total = result['hits']['total']['value']
+    more = len(hits) > size
+    hits = hits[:size]
+    if pit_id is None:
+        return hits, total, encode_cursor(None, None, size) if more else None
+    # the id of the point in time can change between searches
+    pit_id = result.get('pit_id', pit_id)
+    if more:
+        return hits, total, encode_cursor(pit_id, hits[-1]['sort'])
+    _close_point_in_time(pit_id)
+    return hits, total, None
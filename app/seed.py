@@ -0,0 +1,156 @@
+"""Bulk generation of synthetic data, for load testing and benchmarks.
+
+Rows are written with core ``executemany`` inserts in chunked transactions,
+which bypasses the ORM unit of work and the ``SearchableMixin`` commit
+hooks. Follow targets are drawn from a Zipf distribution over the users,
+which gives the heavy-tailed follower counts of a real social network.
+Users and posts are given their ids, so that later rows can refer to them
+without reading them back; with ``index``, each batch of posts is sent to
+Elasticsearch in one bulk request.
+"""
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import json
+import random
+from time import perf_counter, time
+import sqlalchemy as sa
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post, Message, Notification, followers
+from app.search import bulk_index
+
+PASSWORD = 'password'
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _next_id(model):
+    return (db.session.scalar(sa.select(sa.func.max(model.id))) or 0) + 1
+
+
+def _advance_sequence(model):
+    """Move the id sequence of a Postgres table past the ids inserted by
+    the seeder, so that rows added later do not reuse them. MySQL and
+    SQLite do this on their own."""
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    table = db.session.get_bind().dialect.identifier_preparer.format_table(
+        model.__table__)
+    db.session.execute(sa.select(sa.func.setval(
+        sa.func.pg_get_serial_sequence(table, 'id'),
+        sa.select(sa.func.coalesce(sa.func.max(model.id), 0) + 1)
+        .scalar_subquery(), False)))
+    db.session.commit()
+
+
+class Seeder:
+    def __init__(self, seed=42, batch_size=10000, index=False, report=None):
+        self.rng = random.Random(seed)
+        self.batch_size = batch_size
+        self.index = index
+        self.report = report
+        self.counts = {}
+
+    def insert(self, table, rows, after_batch=None):
+        start = perf_counter()
+        count = 0
+        for batch in _batches(rows, self.batch_size):
+            db.session.execute(sa.insert(table), batch)
+            db.session.commit()
+            if after_batch:
+                after_batch(batch)
+            count += len(batch)
+        elapsed = perf_counter() - start
+        self.counts[table.name] = self.counts.get(table.name, 0) + count
+        if self.report:
+            self.report(table.name, count, elapsed)
+        return count
+
+    def run(self, users=1000, posts_per_user=20, follows_per_user=30,
+            messages_per_user=5, zipf_exponent=1.1, days=365):
+        """Insert a synthetic dataset and return the number of rows per table.
+
+        Every new user has password ``PASSWORD``.
+        """
+        rng = self.rng
+        now = datetime.now(timezone.utc)
+        seconds = days * 24 * 3600
+        first = _next_id(User)
+        ids = list(range(first, first + users))
+        # hashing is deliberately slow, so all users share one hash
+        password_hash = generate_password_hash(PASSWORD)
+
+        self.insert(User.__table__, ({
+            'id': i,
+            'username': f'user{i}',
+            'email': f'user{i}@example.com',
+            'password_hash': password_hash,
+            'about_me': f'Synthetic user number {i}',
+            'last_seen': now - timedelta(seconds=rng.randrange(seconds)),
+        } for i in ids))
+        _advance_sequence(User)
+
+        popular = ids[:]
+        rng.shuffle(popular)
+        cum_weights = list(accumulate(1 / rank ** zipf_exponent
+                                      for rank in range(1, users + 1)))
+
+        def follow_edges():
+            for follower in ids:
+                degree = min(int(rng.expovariate(1 / follows_per_user)) + 1,
+                             users - 1)
+                targets = set(rng.choices(popular, cum_weights=cum_weights,
+                                          k=degree))
+                targets.discard(follower)
+                for followed in targets:
+                    yield {'follower_id': follower, 'followed_id': followed}
+
+        self.insert(followers, follow_edges())
+
+        post_ids = iter(range(_next_id(Post), 2 ** 62))
+        self.insert(Post.__table__, ({
+            'id': next(post_ids),
+            'body': f'Post {n} from user {user} #{rng.randrange(10 ** 6)}',
+            'timestamp': now - timedelta(seconds=rng.randrange(seconds)),
+            'user_id': user,
+            'language': 'en',
+        } for user in ids for n in range(rng.randrange(
+            2 * posts_per_user + 1))),
+            after_batch=self.index_posts if self.index else None)
+        _advance_sequence(Post)
+
+        self.insert(Message.__table__, ({
+            'sender_id': rng.choice(ids),
+            'recipient_id': user,
+            'body': f'Message {n} for user {user}',
+            'timestamp': now - timedelta(seconds=rng.randrange(seconds)),
+        } for user in ids for n in range(messages_per_user)))
+
+        self.insert(Notification.__table__, ({
+            'name': 'unread_message_count',
+            'user_id': user,
+            'timestamp': time(),
+            'payload_json': json.dumps(messages_per_user),
+        } for user in ids))
+        return self.counts
+
+    def index_posts(self, batch):
+        authors = {user.id: user for user in db.session.scalars(
+            sa.select(User).where(User.id.in_(
+                {row['user_id'] for row in batch})))}
+        bulk_index(Post.__tablename__, {row['id']: Post.build_document(
+            row['body'], row['timestamp'], row['language'],
+            authors[row['user_id']]) for row in batch})
+
+
+def generate(seed=42, batch_size=10000, index=False, report=None, **kwargs):
+    return Seeder(seed, batch_size, index, report).run(**kwargs)
@@ -0,0 +1,107 @@
+"""JSON providers and MessagePack responses.
+
+``JSON_PROVIDER`` selects the provider behind ``app.json``, which Flask
+uses for ``jsonify``, for dicts and lists returned by views and for
+``request.get_json``:
+
+- ``orjson`` (default): serializes with orjson, several times faster than
+  the stdlib json module on API payloads
+- ``stdlib``: Flask's provider, based on the json module
+
+Both send MessagePack instead of JSON when the request prefers
+``application/msgpack`` in its Accept header, and both splice ``RawJSON``
+values into the output as they are, so JSON stored in the database does
+not need to be parsed to be sent.
+"""
+import json
+import orjson
+from flask import has_request_context, request
+from flask.json.provider import DefaultJSONProvider
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+
+
+class RawJSON:
+    """A value that is already serialized as JSON."""
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def wants_msgpack():
+    return request.accept_mimetypes.best_match(
+        ['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE
+
+
+class JSONProvider(DefaultJSONProvider):
+    """The stdlib provider, with MessagePack negotiation."""
+    @staticmethod
+    def default(o):
+        if isinstance(o, RawJSON):
+            return json.loads(o.text)
+        return DefaultJSONProvider.default(o)
+
+    def _json_response(self, obj):
+        return super().response(obj)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if not has_request_context():
+            return self._json_response(obj)
+        if wants_msgpack():
+            import msgpack
+            response = self._app.response_class(
+                msgpack.packb(obj, default=self.default),
+                mimetype=MSGPACK_MIMETYPE)
+        else:
+            response = self._json_response(obj)
+        response.vary.add('Accept')
+        return response
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson.
+
+    Dates are formatted as HTTP dates and keys are sorted as with the
+    stdlib provider, so both send the same documents.
+    """
+    @staticmethod
+    def _orjson_default(o):
+        if isinstance(o, RawJSON):
+            return orjson.Fragment(o.text)
+        return DefaultJSONProvider.default(o)
+
+    def _options(self, indent=False):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self._orjson_default,
+                            option=self._options(kwargs.get('indent'))
+                            ).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def _json_response(self, obj):
+        indent = self.compact is False or \
+            (self.compact is None and self._app.debug)
+        return self._app.response_class(
+            orjson.dumps(obj, default=self._orjson_default,
+                         option=self._options(indent)) + b'\n',
+            mimetype=self.mimetype)
+
+
+PROVIDERS = {
+    'orjson': OrjsonProvider,
+    'stdlib': JSONProvider,
+}
+
+
+def init_app(app):
+    app.json = PROVIDERS[app.config['JSON_PROVIDER']](app)
@@ -0,0 +1,107 @@
+"""Precomputed "who to follow" suggestions.
+
+Users are suggested the users followed by the people they follow, ranked
+by how many of the people they follow follow them, which is the size of
+the intersection of their following set with the candidate's followers.
+The lists are computed by a batch job over the follow graph, a chunk of
+users at a time, and stored in the ``suggestion`` table, from which pages
+read the top K with a single indexed query. A follow refreshes the
+suggestions of the follower in the background.
+"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from flask import current_app
+import sqlalchemy as sa
+from app import db
+from app.circuit import ServiceError, guarded
+from app.models import Suggestion, User, followers
+
+# ids per IN clause when loading the follow graph
+_IN_LIMIT = 500
+
+
+def _chunks(ids, size):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def load_following(user_ids):
+    """Return a dictionary with the set of users each user follows."""
+    following = {user_id: set() for user_id in user_ids}
+    for chunk in _chunks(user_ids, _IN_LIMIT):
+        for follower, followed in db.session.execute(
+                sa.select(followers.c.follower_id, followers.c.followed_id)
+                .where(followers.c.follower_id.in_(chunk))):
+            following[follower].add(followed)
+    return following
+
+
+def rank(user_id, following, k):
+    """Return the top k (suggested_id, score) pairs for a user.
+
+    following must contain the following sets of the user and of everyone
+    the user follows.
+    """
+    followed = following[user_id]
+    scores = Counter()
+    for friend in followed:
+        scores.update(following[friend] - followed)
+    scores.pop(user_id, None)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def refresh(user_ids, k=None):
+    """Recompute and store the suggestions of the given users."""
+    k = k or current_app.config['SUGGESTIONS_PER_USER']
+    following = load_following(user_ids)
+    friends = set().union(*following.values()) - following.keys()
+    following.update(load_following(friends))
+    rows = [{'user_id': user_id, 'suggested_id': suggested_id, 'score': score}
+            for user_id in user_ids
+            for suggested_id, score in rank(user_id, following, k)]
+    db.session.execute(sa.delete(Suggestion).where(
+        Suggestion.user_id.in_(user_ids)))
+    if rows:
+        db.session.execute(sa.insert(Suggestion), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def active_user_ids(days):
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    return db.session.scalars(sa.select(User.id).where(
+        User.last_seen >= since).order_by(User.id)).all()
+
+
+def refresh_all(chunk_size=None, days=None, progress=None):
+    """Recompute the suggestions of every active user, a chunk at a time."""
+    chunk_size = chunk_size or current_app.config['SUGGESTIONS_CHUNK_SIZE']
+    days = days or current_app.config['SUGGESTIONS_ACTIVE_DAYS']
+    user_ids = active_user_ids(days)
+    done = 0
+    for chunk in _chunks(user_ids, chunk_size):
+        refresh(chunk)
+        done += len(chunk)
+        if progress:
+            progress(done, len(user_ids))
+    return done
+
+
+def schedule_refresh(user):
+    """Queue a refresh of the suggestions of one user.
+
+    Nothing is queued while a refresh for the user is still waiting to
+    run, so a burst of follows recomputes the suggestions once.
+    """
+    queue = current_app.task_queues['indexing']
+    job_id = f'suggestions-{user.id}'
+    try:
+        with guarded('redis', 'enqueue'):
+            job = queue.fetch_job(job_id)
+            if job is None or not job.is_queued:
+                queue.enqueue('app.tasks.refresh_suggestions', [user.id],
+                              job_id=job_id)
+    except ServiceError as e:
+        current_app.logger.warning('Could not queue suggestions refresh for '
+                                   '%s: %s', user.username, e)
@@ -7,6 +7,8 @@ from rq import get_current_job
 from app import create_app, db
 from app.models import User, Post, Task
 from app.email import send_email
+from app.metrics import track_job
+from app import suggestions
 
 app = create_app()
 app.app_context().push()
@@ -25,6 +27,7 @@ def _set_task_progress(progress):
         db.session.commit()
 
 
+@track_job
 def export_posts(user_id):
     try:
         user = db.session.get(User, user_id)
@@ -54,3 +57,12 @@ def export_posts(user_id):
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
         _set_task_progress(100)
+
+
+@track_job
+def refresh_suggestions(user_ids=None):
+    """Recompute follow suggestions, for all active users by default."""
+    if user_ids is None:
+        suggestions.refresh_all()
+    else:
+        suggestions.refresh(user_ids)
@@ -1,21 +1,31 @@
-import requests
 from flask import current_app
 from flask_babel import _
+from app.circuit import ServiceError, guarded, timeout
+from app.metrics import record_error
 
 
 def translate(text, source_language, dest_language):
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
         return _('Error: the translation service is not configured.')
+    import requests
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'southafricanorth'
     }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
+    try:
+        with guarded('translator', 'translate'):
+            r = requests.post(
+                'https://api.cognitive.microsofttranslator.com'
+                '/translate?api-version=3.0&from={}&to={}'.format(
+                    source_language, dest_language), headers=auth, json=[
+                        {'Text': text}], timeout=timeout('translator'))
+            if r.status_code >= 500:
+                # count server errors as failures of the service
+                r.raise_for_status()
+    except ServiceError:
+        return _('Error: the translation service failed.')
     if r.status_code != 200:
+        record_error('translator', 'translate')
         return _('Error: the translation service failed.')
     return r.json()[0]['translations'][0]['text']
@@ -0,0 +1,293 @@
+"""Prefix index of the usernames, for the username typeahead.
+
+Each process keeps every username in memory, sorted by its lowercase form
+along with the user id and follower count. The usernames that start with a
+prefix are then found by two binary searches, and the most followed of them
+by a partial sort, without a query per keystroke. The short prefixes, which
+match the most users, are also cached.
+
+Registrations and username changes update the index of the process that
+commits them right away, and are added to a stream in Redis. The other
+processes read the stream at most every ``USERNAME_INDEX_CHECK_INTERVAL``
+seconds and apply the new changes to their index, which moves only the
+changed usernames. Every ``USERNAME_INDEX_TTL`` seconds the index is
+rebuilt from the database, to refresh the follower counts. Both run in a
+background thread while the old index keeps answering; only the first
+build of a process runs in a request.
+"""
+from bisect import bisect_left
+import heapq
+import threading
+from time import monotonic
+import sqlalchemy as sa
+from flask import current_app
+from app import db
+from app.circuit import CircuitOpenError, ServiceError, guarded
+
+CHANGES_KEY = 'usernames:changes'
+# changes kept in the stream; a process that falls further behind rebuilds
+MAX_CHANGES = 10000
+# prefixes up to this length are cached
+CACHED_PREFIX_LENGTH = 2
+
+
+class PrefixIndex:
+    """Usernames sorted for prefix searches. The index is not changed once
+    built, updates make a new one, so that it can be read without locks."""
+    def __init__(self, users):
+        users = sorted((username.lower(), username, id, followers)
+                       for id, username, followers in users)
+        self.keys = [user[0] for user in users]
+        self.users = [user[1:] for user in users]
+        self.usernames = {user[2]: user[1] for user in users}
+        self._cache = {}
+
+    def __len__(self):
+        return len(self.users)
+
+    def complete(self, prefix, limit):
+        """Return the (username, id, followers) of the most followed users
+        whose username starts with prefix, ignoring case."""
+        prefix = prefix.lower()
+        if not prefix:
+            return []
+        cached = len(prefix) <= CACHED_PREFIX_LENGTH
+        if cached and (prefix, limit) in self._cache:
+            return self._cache[prefix, limit]
+        start = bisect_left(self.keys, prefix)
+        stop = bisect_left(self.keys, prefix + '\U0010ffff', start)
+        # ties stay in alphabetical order
+        users = [self.users[i] for i in heapq.nlargest(
+            limit, range(start, stop), key=lambda i: self.users[i][2])]
+        if cached:
+            self._cache[prefix, limit] = users
+        return users
+
+    def updated(self, changes):
+        """Return a new index with the usernames of a {user_id: username}
+        dict, for new users and renamed ones.
+
+        The lists are copied and only the changed users are moved, which
+        costs a copy of the pointers rather than a sort."""
+        index = PrefixIndex(())
+        keys = index.keys = self.keys[:]
+        users = index.users = self.users[:]
+        index.usernames = dict(self.usernames)
+        changed = set()
+        for id, username in changes.items():
+            followers = 0
+            old = index.usernames.get(id)
+            if old is not None:
+                i = bisect_left(keys, old.lower())
+                while users[i][1] != id:
+                    i += 1
+                followers = users[i][2]
+                del keys[i], users[i]
+                changed.add(old.lower())
+            key = username.lower()
+            changed.add(key)
+            # keep the order of the sort in __init__ among equal keys
+            i = bisect_left(keys, key)
+            while i < len(keys) and keys[i] == key and \
+                    users[i][:2] < (username, id):
+                i += 1
+            keys.insert(i, key)
+            users.insert(i, (username, id, followers))
+            index.usernames[id] = username
+        index._cache = {
+            (prefix, limit): cached
+            for (prefix, limit), cached in self._cache.items()
+            if not any(key.startswith(prefix) for key in changed)}
+        return index
+
+
+def load_users():
+    from app.models import User, followers
+    return db.session.execute(
+        sa.select(User.id, User.username,
+                  sa.func.count(followers.c.follower_id))
+        .outerjoin(followers, followers.c.followed_id == User.id)
+        .group_by(User.id, User.username)).all()
+
+
+def _unavailable(e):
+    if not isinstance(e, CircuitOpenError):
+        current_app.logger.warning('Username index not synced: %s', e)
+
+
+def _stream_id(id):
+    return tuple(int(part) for part in id.split(b'-'))
+
+
+class UsernameIndex:
+    """The prefix index of this process, kept up to date.
+
+    Only the first build runs in a request. Later rebuilds, and the
+    changes made by other processes read from the stream in Redis, are
+    applied by a background thread while the old index keeps answering."""
+    def __init__(self):
+        self.index = None
+        # id of the latest change of the stream the index has, None if
+        # unknown
+        self.last_change = None
+        self.built = self.checked = 0
+        self.lock = threading.Lock()
+        # changes committed during a rebuild, None when not rebuilding
+        self.pending = None
+        # the thread of the latest rebuild or catch up
+        self.worker = None
+
+    def _redis(self):
+        if not current_app.config['USERNAME_INDEX_SYNC']:
+            return None
+        return current_app.redis
+
+    def _latest_change(self):
+        redis = self._redis()
+        if redis is None:
+            return None
+        try:
+            with guarded('redis', 'username_index'):
+                entries = redis.xrevrange(CHANGES_KEY, count=1)
+        except ServiceError as e:
+            _unavailable(e)
+            return None
+        return entries[0][0] if entries else b'0-0'
+
+    def _build(self):
+        # changes after this read are applied from the stream later
+        latest = self._latest_change()
+        return PrefixIndex(load_users()), latest
+
+    def get(self):
+        if self.index is None:
+            with self.lock:
+                if self.index is None:
+                    self.index, self.last_change = self._build()
+                    self.built = self.checked = monotonic()
+            return self.index
+        config = current_app.config
+        now = monotonic()
+        if now - self.built >= config['USERNAME_INDEX_TTL']:
+            self._in_background(self.rebuild)
+        elif now - self.checked >= config['USERNAME_INDEX_CHECK_INTERVAL']:
+            self.checked = now
+            self._in_background(self.catch_up)
+        return self.index
+
+    def _in_background(self, target):
+        """Run target in a thread with an app context, unless the thread
+        of an earlier one is still running."""
+        with self.lock:
+            if self.worker is not None and self.worker.is_alive():
+                return
+            self.worker = threading.Thread(
+                target=self._run,
+                args=(current_app._get_current_object(), target),
+                daemon=True, name='username-index')
+            self.worker.start()
+
+    def _run(self, app, target):
+        with app.app_context():
+            try:
+                target()
+            except Exception as e:
+                app.logger.error('Could not update the username index: %s',
+                                 e)
+            finally:
+                db.session.remove()
+
+    def catch_up(self):
+        """Apply the changes of the stream made since the last ones
+        applied, or rebuild if some are missing."""
+        redis = self._redis()
+        if redis is None:
+            return
+        if self.last_change is None:
+            # Redis was unavailable, changes may have been missed
+            self.rebuild()
+            return
+        try:
+            with guarded('redis', 'username_index'):
+                pipe = redis.pipeline(transaction=False)
+                pipe.xrange(CHANGES_KEY, count=1)
+                pipe.xrange(CHANGES_KEY, min=b'(' + self.last_change,
+                            count=MAX_CHANGES)
+                oldest, entries = pipe.execute()
+        except ServiceError as e:
+            _unavailable(e)
+            return
+        if oldest and self.last_change != b'0-0' and \
+                _stream_id(oldest[0][0]) > _stream_id(self.last_change):
+            # the changes after the last one applied were trimmed
+            self.rebuild()
+            return
+        if not entries:
+            return
+        changes = {}
+        for _, fields in entries:
+            changes.update({int(id): username.decode()
+                            for id, username in fields.items()})
+        with self.lock:
+            self.index = self.index.updated(changes)
+            self.last_change = entries[-1][0]
+
+    def rebuild(self):
+        with self.lock:
+            self.pending = {}
+        index = None
+        try:
+            index, latest = self._build()
+        finally:
+            with self.lock:
+                if index is not None:
+                    self.index = index.updated(self.pending)
+                    self.last_change = latest
+                # a failed rebuild is tried again after the TTL
+                self.built = self.checked = monotonic()
+                self.pending = None
+
+    def apply(self, changes):
+        with self.lock:
+            if self.index is not None:
+                self.index = self.index.updated(changes)
+            if self.pending is not None:
+                self.pending.update(changes)
+        redis = self._redis()
+        if redis is None:
+            return
+        # the other processes apply these from the stream, and so will
+        # this one, which does not change its index
+        try:
+            with guarded('redis', 'username_index'):
+                redis.xadd(CHANGES_KEY, {str(id): username for id, username
+                                         in changes.items()},
+                           maxlen=MAX_CHANGES, approximate=True)
+        except ServiceError as e:
+            _unavailable(e)
+
+
+def _index():
+    return current_app.extensions.setdefault('usernames', UsernameIndex())
+
+
+def complete(prefix, limit):
+    return _index().get().complete(prefix, limit)
+
+
+def record(session, user_id, username):
+    session.info.setdefault('usernames', {})[user_id] = username
+
+
+def after_commit(session):
+    changes = session.info.pop('usernames', None)
+    if changes:
+        _index().apply(changes)
+
+
+def after_rollback(session):
+    session.info.pop('usernames', None)
+
+
+db.event.listen(db.session, 'after_commit', after_commit)
+db.event.listen(db.session, 'after_rollback', after_rollback)
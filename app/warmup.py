@@ -0,0 +1,52 @@
+"""Warm-up of the app in the gunicorn master, before the workers fork.
+
+With ``preload_app`` gunicorn imports the app once in the master process
+and forks the workers from it. Work done before the fork is not repeated
+on the first request of every worker, and the memory it uses is shared
+between the workers until they write to it. See gunicorn.conf.py.
+"""
+import gc
+from importlib import import_module
+from flask_babel import get_translations
+from langdetect.detector_factory import init_factory
+import sqlalchemy.orm as so
+from app import db
+from app.search import LazyElasticsearch
+
+# packages the app imports on first use, to keep the startup of the CLI
+# and the workers short
+LAZY_IMPORTS = ('elasticsearch', 'jwt', 'langdetect', 'redis', 'requests',
+                'rq')
+
+
+def warm_up(app):
+    """Load everything the first requests would otherwise load."""
+    so.configure_mappers()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    for language in app.config['LANGUAGES']:
+        with app.test_request_context(
+                headers={'Accept-Language': language}):
+            get_translations()
+    for name in LAZY_IMPORTS:
+        import_module(name)
+    # language detection profiles, loaded by the first detect() otherwise
+    init_factory()
+    # move everything loaded so far out of the reach of the garbage
+    # collector, which would otherwise write to the shared pages when it
+    # scans them in the workers
+    gc.collect()
+    gc.freeze()
+
+
+def after_fork(app):
+    """Drop the connections a worker inherited from the master."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    for engine in app.extensions.get('replicas', []):
+        engine.dispose(close=False)
+    if 'redis' in app.__dict__:
+        app.redis.connection_pool.reset()
+    if isinstance(app.elasticsearch, LazyElasticsearch):
+        app.elasticsearch.reset()
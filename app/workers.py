@@ -0,0 +1,126 @@
+"""Background job queues and a pool of warm workers.
+
+Jobs go to one of three queues, which workers serve in priority order:
+
+- ``interactive``: quick jobs that a user is waiting for
+- ``indexing``: upkeep of search and precomputed data
+- ``bulk``: long jobs such as exports and batch refreshes
+
+``rq worker`` forks a new work horse for every job, which then has to set
+up its database and Redis connections again. The pool started by
+``flask worker`` instead loads the app once, forks a bounded number of
+processes that each run jobs in-process with ``SimpleWorker`` and keep
+their connection pools, and replaces processes that exit. Only some of
+the processes take bulk jobs, so a long export never holds up the quick
+jobs.
+"""
+import os
+import signal
+import time
+
+QUEUES = ('interactive', 'indexing', 'bulk')
+# queue of each task, tasks that are not listed are interactive
+TASK_QUEUES = {
+    'export_posts': 'bulk',
+    'refresh_suggestions': 'indexing',
+}
+# tasks of which a user can only have HEAVY_TASKS_PER_USER in progress
+HEAVY_TASKS = {name for name, queue in TASK_QUEUES.items()
+               if queue == 'bulk'}
+
+
+class TaskLimitError(Exception):
+    pass
+
+
+def queue_name(queue):
+    return f'microblog-{queue}'
+
+
+def make_queues(connection):
+    import rq
+    return {queue: rq.Queue(queue_name(queue), connection=connection)
+            for queue in QUEUES}
+
+
+def queue_for(task):
+    return TASK_QUEUES.get(task, 'interactive')
+
+
+def _work(app, queues, max_jobs):
+    from redis import Redis
+    import rq
+    from app import db
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # connections inherited from the parent must not be shared with it
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    connection = Redis.from_url(app.config['REDIS_URL'])
+    worker = rq.SimpleWorker(
+        [rq.Queue(queue_name(queue), connection=connection)
+         for queue in queues], connection=connection)
+    worker.work(max_jobs=max_jobs)
+
+
+def run_pool(processes=4, bulk_processes=1, max_jobs=None, logger=None):
+    """Run processes workers until SIGTERM or SIGINT.
+
+    bulk_processes of them take jobs from all the queues, the others only
+    from the interactive and indexing queues. With max_jobs, processes are
+    replaced after running that many jobs.
+    """
+    # the tasks module creates the app that runs the jobs, so importing it
+    # here loads the app, templates and database mappers once for all the
+    # processes
+    from app import logs, tasks
+    from sqlalchemy.orm import configure_mappers
+    configure_mappers()
+    children = {}
+    started = {}
+    stopping = False
+
+    def spawn(slot):
+        queues = QUEUES if slot < bulk_processes else QUEUES[:-1]
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                _work(tasks.app, queues, max_jobs)
+                status = 0
+            finally:
+                logs.stop()
+                os._exit(status)
+        children[pid] = slot
+        started[slot] = time.monotonic()
+        if logger:
+            logger.info('Worker %d started, queues %s', pid,
+                        ', '.join(queues))
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        # on Ctrl+C the terminal sends SIGINT to the workers as well
+        if signum == signal.SIGTERM:
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for slot in range(processes):
+        spawn(slot)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        slot = children.pop(pid, None)
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            from prometheus_client import multiprocess
+            multiprocess.mark_process_dead(pid)
+        if slot is not None and not stopping:
+            if time.monotonic() - started[slot] < 1:
+                # do not restart a failing process in a tight loop
+                time.sleep(1)
+            spawn(slot)
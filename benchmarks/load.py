@@ -0,0 +1,242 @@
+"""End-to-end load benchmark.
+
+Generates a synthetic dataset, then drives the real WSGI application
+in-process with concurrent clients and reports throughput and latency
+percentiles per endpoint. Results are written as JSON so that runs on
+different commits can be compared::
+
+    python -m benchmarks.load --users 2000 --clients 8 --output before.json
+    git checkout my-branch
+    python -m benchmarks.load --users 2000 --clients 8 --output after.json \\
+        --compare before.json
+"""
+import argparse
+from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, time
+import sqlalchemy as sa
+from app import create_app, db
+from app.models import User, followers
+from app.seed import PASSWORD, generate
+from config import Config
+
+
+def make_config(database_url):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        ELASTICSEARCH_URL = None
+        WTF_CSRF_ENABLED = False
+        METRICS_ENABLED = False
+        LOG_TO_STDOUT = True
+    return BenchmarkConfig
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1,
+                       int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def summarize(latencies, statuses, elapsed):
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': sum(1 for status in statuses if status >= 400),
+        'throughput': count / elapsed if elapsed else None,
+        'p50_ms': percentile(latencies, 0.50) * 1000 if count else None,
+        'p95_ms': percentile(latencies, 0.95) * 1000 if count else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if count else None,
+    }
+
+
+def popular_usernames(limit):
+    """Return the usernames with the most followers."""
+    query = (sa.select(User.username)
+             .join(followers, followers.c.followed_id == User.id)
+             .group_by(User.id)
+             .order_by(sa.func.count().desc())
+             .limit(limit))
+    return list(db.session.scalars(query))
+
+
+class Client:
+    """A logged in browser session plus an API token for one user."""
+    def __init__(self, app, username):
+        self.http = app.test_client()
+        self.username = username
+        response = self.http.post('/auth/login', data={
+            'username': username, 'password': PASSWORD})
+        if response.status_code != 302:
+            raise RuntimeError(f'could not log in as {username}')
+        credentials = b64encode(f'{username}:{PASSWORD}'.encode()).decode()
+        response = self.http.post('/api/tokens', headers={
+            'Authorization': f'Basic {credentials}'})
+        self.token = response.get_json()['token']
+
+    def get(self, url, api=False):
+        headers = {'Authorization': f'Bearer {self.token}'} if api else {}
+        start = perf_counter()
+        response = self.http.get(url, headers=headers)
+        response.close()
+        return perf_counter() - start, response.status_code
+
+
+def scenarios(rng, usernames, user_count):
+    """Return the (name, url, api) request mix, weighted by frequency."""
+    username = rng.choice(usernames)
+    user_id = rng.randint(1, user_count)
+    page = rng.choice([1, 1, 1, 2, 3])
+    return rng.choices([
+        ('index', f'/index?page={page}', False),
+        ('explore', f'/explore?page={page}', False),
+        ('user', f'/user/{username}', False),
+        ('user_popup', f'/user/{username}/popup', False),
+        ('notifications', '/notifications', False),
+        ('api_get_user', f'/api/users/{user_id}', True),
+        ('api_get_users', f'/api/users?page={page}', True),
+        ('api_get_followers', f'/api/users/{user_id}/followers', True),
+        ('api_get_following', f'/api/users/{user_id}/following', True),
+    ], weights=[25, 15, 15, 20, 15, 3, 3, 2, 2])[0]
+
+
+def run(app, clients, requests, seed, user_count):
+    usernames = popular_usernames(200)
+    with ThreadPoolExecutor(clients) as executor:
+        sessions = list(executor.map(
+            lambda name: Client(app, name), usernames[:clients]))
+    results = {}
+    lock = threading.Lock()
+    per_client = requests // clients
+
+    def worker(index):
+        rng = random.Random(seed + index)
+        client = sessions[index]
+        for _ in range(per_client):
+            name, url, api = scenarios(rng, usernames, user_count)
+            latency, status = client.get(url, api=api)
+            with lock:
+                latencies, statuses = results.setdefault(name, ([], []))
+                latencies.append(latency)
+                statuses.append(status)
+
+    start = perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(worker, range(clients)))
+    elapsed = perf_counter() - start
+
+    all_latencies = [lat for lats, _ in results.values() for lat in lats]
+    all_statuses = [st for _, sts in results.values() for st in sts]
+    return {
+        'elapsed_s': elapsed,
+        'total': summarize(all_latencies, all_statuses, elapsed),
+        'endpoints': {name: summarize(lats, sts, elapsed)
+                      for name, (lats, sts) in sorted(results.items())},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True,
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    print(f"{'endpoint':<20}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}"
+          f"{'p99 ms':>9}{'errors':>8}")
+    rows = [('total', report['total'])] + list(report['endpoints'].items())
+    for name, stats in rows:
+        line = (f"{name:<20}{stats['throughput']:>9.1f}"
+                f"{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}"
+                f"{stats['p99_ms']:>9.1f}{stats['errors']:>8}")
+        if baseline:
+            old = baseline['total'] if name == 'total' else \
+                baseline['endpoints'].get(name)
+            if old and old['p95_ms']:
+                change = (stats['p95_ms'] - old['p95_ms']) / old['p95_ms']
+                line += f'   p95 {change:+.1%} vs {baseline["revision"]}'
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database', help='SQLAlchemy URL of an empty '
+                        'database (default: temporary SQLite file)')
+    parser.add_argument('--reset', action='store_true',
+                        help='drop all the tables of --database first')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts-per-user', type=int, default=20)
+    parser.add_argument('--follows-per-user', type=int, default=30)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results here')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show application warnings such as N+1 reports')
+    args = parser.parse_args(argv)
+
+    tmpdir = None
+    database = args.database
+    if database is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        database = 'sqlite:///' + os.path.join(tmpdir.name, 'bench.db')
+    app = create_app(make_config(database))
+    if not args.verbose:
+        app.logger.setLevel(logging.ERROR)
+    with app.app_context():
+        tables = sa.inspect(db.engine).get_table_names()
+        if tables and not args.reset:
+            parser.error(f'{database} has tables ({", ".join(tables)}), '
+                         'use --reset to drop them')
+        db.drop_all()
+        db.create_all()
+        start = perf_counter()
+        rows = generate(users=args.users,
+                        posts_per_user=args.posts_per_user,
+                        follows_per_user=args.follows_per_user,
+                        seed=args.seed)
+        print(f'Generated {rows} in {perf_counter() - start:.1f}s',
+              file=sys.stderr)
+        results = run(app, args.clients, args.requests, args.seed, args.users)
+        db.session.remove()
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':')[0],
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'database',
+                                      'reset', 'verbose')},
+        'rows': rows,
+        **results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+
+if __name__ == '__main__':
+    main()
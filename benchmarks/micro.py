@@ -0,0 +1,169 @@
+"""Micro-benchmarks for the model code that every request depends on.
+
+Each benchmark runs against a fixed in-memory dataset, is warmed up, and
+is then timed over several rounds; the median time per call is reported.
+Results are compared against a stored baseline and the run fails when a
+tracked function is slower than the baseline by more than the threshold::
+
+    python -m benchmarks.micro --save-baseline   # on the reference commit
+    python -m benchmarks.micro --threshold 0.25  # on the commit under test
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+from time import perf_counter
+from flask import render_template_string
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import create_app, db, usernames
+from app.models import User, Post, SearchableMixin
+from app.seed import generate
+from config import Config
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+class MicroConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    SERVER_NAME = 'localhost'
+    # the timings must not depend on whether the services are reachable
+    ELASTICSEARCH_URL = None
+    FOLLOW_GRAPH_CACHE = False
+    EXPLORE_BUFFER_SIZE = 0
+    RATE_LIMITING = False
+    USERNAME_INDEX_SYNC = False
+
+
+def timeit(func, number, rounds, warmup):
+    for _ in range(warmup):
+        func()
+    times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    return statistics.median(times)
+
+
+def benchmarks():
+    """Return (name, callable, calls per round) for each tracked function.
+
+    Must be called inside a request context with the dataset loaded.
+    """
+    user = db.session.get(User, 1)
+    token = user.get_token()
+    db.session.commit()
+    posts = db.session.scalars(Post.explore_posts().limit(25)).all()
+    index = usernames._index().get()
+    template = "{% for post in posts %}{% include '_post.html' %}{% endfor %}"
+
+    def compile_following_posts():
+        str(user.following_posts().compile(db.engine))
+
+    def execute_following_posts():
+        db.paginate(user.following_posts(), page=1, per_page=25,
+                    error_out=False).items
+
+    def commit_hooks():
+        # a session of its own, rolled back, so that nothing piles up in
+        # the session of the other benchmarks
+        with so.Session(db.engine) as session:
+            session.add(Post(body='benchmark', user_id=user.id,
+                             language='en'))
+            SearchableMixin.before_commit(session)
+            SearchableMixin.after_commit(session)
+            session.rollback()
+
+    return [
+        ('User.following_posts.compile', compile_following_posts, 50),
+        ('User.following_posts.execute', execute_following_posts, 10),
+        ('User.to_dict', user.to_dict, 20),
+        ('PaginatedAPIMixin.to_collection_dict',
+         lambda: User.to_collection_dict(sa.select(User), 1, 10,
+                                         'api.get_users'), 5),
+        ('User.check_token', lambda: User.check_token(token), 50),
+        ('User.avatar', lambda: user.avatar(128), 5000),
+        ('SearchableMixin.commit_hooks', commit_hooks, 200),
+        ('usernames.complete', lambda: usernames.complete(
+            user.username[:3], 8), 1000),
+        ('usernames.PrefixIndex.updated', lambda: index.updated(
+            {user.id: 'renamed', 0: 'new user'}), 100),
+        ('_post.html', lambda: render_template_string(template,
+                                                       posts=posts), 10),
+    ]
+
+
+def run(rounds, warmup, only=None):
+    app = create_app(MicroConfig)
+    results = {}
+    with app.app_context():
+        db.create_all()
+        generate(users=500, posts_per_user=20, follows_per_user=30, seed=1)
+        with app.test_request_context():
+            app.preprocess_request()
+            for name, func, number in benchmarks():
+                if only and name not in only:
+                    continue
+                results[name] = timeit(func, number, rounds, warmup)
+        db.session.remove()
+    return results
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':<40}{'us/call':>12}{'baseline':>12}{'change':>9}")
+    for name, seconds in results.items():
+        old = baseline.get(name)
+        line = f'{name:<40}{seconds * 1e6:>12.1f}'
+        if old:
+            change = (seconds - old) / old
+            line += f'{old * 1e6:>12.1f}{change:>+9.1%}'
+            if change > threshold:
+                regressions.append(name)
+                line += '  REGRESSION'
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=float(
+        os.environ.get('BENCHMARK_THRESHOLD') or 0.2),
+        help='allowed slowdown against the baseline (default 0.2 = 20%%)')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--output', help='also write the results here')
+    parser.add_argument('benchmark', nargs='*',
+                        help='only run the named benchmarks')
+    args = parser.parse_args(argv)
+
+    results = run(args.rounds, args.warmup, args.benchmark)
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+
+    report = {'python': platform.python_version(), 'results': results}
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if regressions:
+        print('Regressed past {:.0%}: {}'.format(args.threshold,
+                                                ', '.join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
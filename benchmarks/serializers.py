@@ -0,0 +1,100 @@
+"""Throughput of the response serializers on API payloads.
+
+Serializes the same documents with each provider of app/serializers.py
+and with MessagePack, and reports documents and megabytes per second:
+
+- a page of the users collection, as sent by ``GET /api/users``
+- a ``/notifications`` response, with the stored payloads parsed and
+  dumped again (``get_data``) or spliced in unparsed (``raw_data``)
+
+::
+
+    python -m benchmarks.serializers
+"""
+import argparse
+import json
+import statistics
+from time import perf_counter
+import msgpack
+import sqlalchemy as sa
+from app import create_app, db, serializers
+from app.models import Notification, User
+from app.seed import generate
+from benchmarks.micro import MicroConfig
+
+
+class SerializerConfig(MicroConfig):
+    FOLLOW_GRAPH_CACHE = False
+    EXPLORE_BUFFER_SIZE = 0
+
+
+def throughput(func, number, rounds):
+    size = len(func())
+    times = []
+    for _ in range(rounds):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    seconds = statistics.median(times)
+    return 1 / seconds, size / seconds / 1e6
+
+
+def payloads():
+    users = User.to_collection_dict(sa.select(User), 1, 100, 'api.get_users')
+    notifications = db.session.scalars(sa.select(Notification).limit(100)).all()
+    return {
+        'users page': lambda: users,
+        'notifications, parsed': lambda: [
+            {'name': n.name, 'data': n.get_data(), 'timestamp': n.timestamp}
+            for n in notifications],
+        'notifications, raw': lambda: [
+            {'name': n.name, 'data': n.raw_data(), 'timestamp': n.timestamp}
+            for n in notifications],
+    }
+
+
+def run(number, rounds):
+    app = create_app(SerializerConfig)
+    results = {}
+    with app.app_context():
+        db.create_all()
+        generate(users=200, posts_per_user=1, follows_per_user=5, seed=1)
+        for user in db.session.scalars(sa.select(User).limit(100)):
+            user.add_notification('unread_message_count', {
+                'count': user.id, 'senders': list(range(20))})
+        db.session.commit()
+        providers = {name: provider(app) for name, provider
+                     in serializers.PROVIDERS.items()}
+        with app.test_request_context():
+            for payload, build in payloads().items():
+                for name, provider in providers.items():
+                    results[f'{payload} / {name}'] = throughput(
+                        lambda: provider.dumps(build()), number, rounds)
+                if 'raw' not in payload:
+                    results[f'{payload} / msgpack'] = throughput(
+                        lambda: msgpack.packb(
+                            build(), default=serializers.JSONProvider.default),
+                        number, rounds)
+        db.session.remove()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--number', type=int, default=50)
+    parser.add_argument('--rounds', type=int, default=7)
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.rounds)
+    print(f"{'payload / serializer':<40}{'docs/s':>12}{'MB/s':>10}")
+    for name, (docs, megabytes) in results.items():
+        print(f'{name:<40}{docs:>12.0f}{megabytes:>10.1f}')
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""Throughput of a SQLite database shared by several worker processes.
+
+Seeds a SQLite file, then runs the same workloads from ``--workers``
+processes at once, each with the app as gunicorn would run it, first with
+SQLite's defaults (``SQLITE_TUNING=0``) and then with the settings of
+app/pragmas.py. Reports operations per second and the operations that
+failed because the database was locked:
+
+- writes: one new post per transaction
+- reads: the latest posts of a user with their authors
+- mixed: one write for every nine reads
+
+::
+
+    python -m benchmarks.sqlite --workers 4 --seconds 5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+from time import perf_counter
+import sqlalchemy as sa
+import sqlalchemy.orm as so
+from app import create_app, db
+from app.models import Post, User
+from app.seed import generate
+from config import Config
+
+WORKLOADS = {'writes': 1.0, 'reads': 0.0, 'mixed': 0.1}
+
+
+def make_config(database_url, tuning):
+    class SQLiteConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        SQLITE_TUNING = tuning
+        ELASTICSEARCH_URL = None
+        METRICS_ENABLED = False
+        LOG_TO_STDOUT = True
+        EXPLORE_BUFFER_SIZE = 0
+    return SQLiteConfig
+
+
+def write(rng, user_ids):
+    db.session.add(Post(body=f'benchmark post {rng.random()}',
+                        user_id=rng.choice(user_ids), language='en'))
+    db.session.commit()
+
+
+def read(rng, user_ids):
+    db.session.scalars(
+        sa.select(Post).options(so.joinedload(Post.author))
+        .where(Post.user_id == rng.choice(user_ids))
+        .order_by(Post.timestamp.desc()).limit(20)).all()
+    db.session.commit()
+
+
+def worker(config, write_fraction, seconds, seed, start, results):
+    app = create_app(config)
+    rng = random.Random(seed)
+    ops = locked = 0
+    with app.app_context():
+        user_ids = db.session.scalars(sa.select(User.id)).all()
+        start.wait()
+        end = perf_counter() + seconds
+        while perf_counter() < end:
+            operation = write if rng.random() < write_fraction else read
+            try:
+                operation(rng, user_ids)
+                ops += 1
+            except sa.exc.OperationalError as e:
+                db.session.rollback()
+                if 'locked' not in str(e):
+                    raise
+                locked += 1
+        db.session.remove()
+    results.put((ops, locked))
+
+
+def run(database_url, tuning, workers, seconds):
+    config = make_config(database_url, tuning)
+    context = multiprocessing.get_context('fork')
+    report = {}
+    for workload, write_fraction in WORKLOADS.items():
+        start = context.Barrier(workers)
+        results = context.Queue()
+        processes = [context.Process(
+            target=worker, args=(config, write_fraction, seconds, seed, start,
+                                 results)) for seed in range(workers)]
+        for process in processes:
+            process.start()
+        counts = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        report[workload] = {
+            'ops_per_second': sum(ops for ops, _ in counts) / seconds,
+            'locked': sum(locked for _, locked in counts),
+        }
+    return report
+
+
+def seed_database(path, users):
+    app = create_app(make_config('sqlite:///' + path, True))
+    with app.app_context():
+        db.create_all()
+        generate(users=users, posts_per_user=10, follows_per_user=10, seed=1)
+        db.session.remove()
+        db.engine.dispose()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, tuning in (('stock', False), ('tuned', True)):
+            path = os.path.join(directory, f'{name}.db')
+            seed_database(path, args.users)
+            if not tuning:
+                # seeding went through the tuned engine, undo its WAL mode
+                with sa.create_engine('sqlite:///' + path).connect() as conn:
+                    conn.exec_driver_sql('PRAGMA journal_mode=DELETE')
+            results[name] = run('sqlite:///' + path, tuning, args.workers,
+                                args.seconds)
+
+    print(f'{args.workers} workers, {args.seconds:g} seconds per workload')
+    print(f"{'workload':<12}{'stock ops/s':>14}{'locked':>8}"
+          f"{'tuned ops/s':>14}{'locked':>8}")
+    for workload in WORKLOADS:
+        stock, tuned = results['stock'][workload], results['tuned'][workload]
+        print(f"{workload:<12}{stock['ops_per_second']:>14.0f}"
+              f"{stock['locked']:>8}{tuned['ops_per_second']:>14.0f}"
+              f"{tuned['locked']:>8}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
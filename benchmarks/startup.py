@@ -0,0 +1,119 @@
+"""Startup benchmark for gunicorn, with and without the pre-fork warm-up.
+
+Starts gunicorn with gunicorn.conf.py, once with ``preload_app`` and the
+warm-up of app/warmup.py and once without, and reports for each run:
+
+- the time from starting gunicorn to the first successful response
+- once all workers have booted, the slowest and the median latency of the
+  following requests; the slowest is a worker's first request
+- the resident (RSS) and proportional (PSS) memory of each worker; PSS
+  divides shared pages between the processes sharing them, so it shows
+  what copy-on-write saves
+
+Memory is read from /proc, so this only runs on Linux::
+
+    python -m benchmarks.startup --workers 4
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter, sleep
+from urllib.error import URLError
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get(url):
+    start = perf_counter()
+    with urlopen(url, timeout=10) as response:
+        response.read()
+    return perf_counter() - start
+
+
+def memory(pid):
+    """Return the RSS and PSS of a process, in kB."""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in ('Rss', 'Pss'):
+                values[key.lower()] = int(rest.split()[0])
+    return values
+
+
+def children(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def run(preload, workers, requests, settle, port, database_url):
+    env = dict(os.environ, GUNICORN_PRELOAD='1' if preload else '0',
+               DATABASE_URL=database_url, LOG_TO_STDOUT='1')
+    url = f'http://127.0.0.1:{port}/auth/login'
+    start = perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-w',
+         str(workers), '-b', f'127.0.0.1:{port}', 'microblog:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                get(url)
+                break
+            except (URLError, ConnectionError):
+                if server.poll() is not None:
+                    raise RuntimeError('gunicorn exited')
+                sleep(0.01)
+        time_to_first = perf_counter() - start
+        # let the other workers finish booting, then the first requests
+        # include the first request of most of them, as connections are
+        # spread over the workers
+        sleep(settle)
+        latencies = [get(url) for _ in range(requests)]
+        usage = [memory(pid) for pid in children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        'time_to_first_response_ms': time_to_first * 1000,
+        'slowest_request_ms': max(latencies) * 1000,
+        'median_request_ms': statistics.median(latencies) * 1000,
+        'worker_rss_kb': statistics.mean(u['rss'] for u in usage),
+        'worker_pss_kb': statistics.mean(u['pss'] for u in usage),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=20,
+                        help='requests sent after startup (default 20)')
+    parser.add_argument('--settle', type=float, default=3,
+                        help='seconds to wait for the workers to boot')
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = 'sqlite:///' + os.path.join(tmp, 'startup.db')
+        results = {
+            name: run(preload, args.workers, args.requests, args.settle,
+                      args.port, database_url)
+            for name, preload in [('cold', False), ('preload', True)]}
+    print('{:<28}{:>12}{:>12}'.format('', 'cold', 'preload'))
+    for metric in results['cold']:
+        print('{:<28}{:>12.1f}{:>12.1f}'.format(
+            metric, results['cold'][metric], results['preload'][metric]))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
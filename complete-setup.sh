@@ -240,7 +240,7 @@ echo "   ./start-worker.sh"
 echo ""
 echo "Or manually with:"
 echo "   source .venv/bin/activate"
-echo "   rq worker microblog-tasks"
+echo "   flask worker"
 echo ""
 
 # Automatically starting Flask application
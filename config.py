@@ -11,7 +11,25 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', '').replace(
         'postgres://', 'postgresql://') or \
         'sqlite:///' + os.path.join(basedir, 'app.db')
+    SQLALCHEMY_REPLICA_URIS = [
+        url.strip().replace('postgres://', 'postgresql://')
+        for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if url.strip()]
+    REPLICA_MAX_LAG = float(os.environ.get('REPLICA_MAX_LAG') or 5)
+    REPLICA_LAG_CHECK_INTERVAL = float(
+        os.environ.get('REPLICA_LAG_CHECK_INTERVAL') or 1)
+    REPLICA_LAG_QUERY = os.environ.get('REPLICA_LAG_QUERY')
+    SQLITE_TUNING = os.environ.get('SQLITE_TUNING', '1') != '0'
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)
+    SQLITE_CACHE_SIZE = int(
+        os.environ.get('SQLITE_CACHE_SIZE') or 64 * 1024 * 1024)
+    SQLITE_MMAP_SIZE = int(
+        os.environ.get('SQLITE_MMAP_SIZE') or 256 * 1024 * 1024)
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 5)
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'json'
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -19,8 +37,70 @@ class Config:
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = [MAIL_USERNAME]
     ADMIN_TO_COPY = os.environ.get('ADMIN_TO_COPY')
+    LOG_MAIL_INTERVAL = float(os.environ.get('LOG_MAIL_INTERVAL') or 60)
+    LOG_MAIL_MAX_PER_HOUR = int(os.environ.get('LOG_MAIL_MAX_PER_HOUR') or 10)
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    ELASTICSEARCH_PROBE_INTERVAL = float(
+        os.environ.get('ELASTICSEARCH_PROBE_INTERVAL') or 30)
+    ELASTICSEARCH_PROBE_TIMEOUT = float(
+        os.environ.get('ELASTICSEARCH_PROBE_TIMEOUT') or 2)
+    ELASTICSEARCH_TIMEOUT = float(os.environ.get('ELASTICSEARCH_TIMEOUT') or 2)
+    SEARCH_PIT_KEEP_ALIVE = os.environ.get('SEARCH_PIT_KEEP_ALIVE') or '5m'
+    SEARCH_FROM_SOURCE = os.environ.get('SEARCH_FROM_SOURCE') is not None
+    TRANSLATOR_TIMEOUT = float(os.environ.get('TRANSLATOR_TIMEOUT') or 5)
+    REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT') or 1)
+    CIRCUIT_FAILURE_THRESHOLD = int(
+        os.environ.get('CIRCUIT_FAILURE_THRESHOLD') or 5)
+    CIRCUIT_RESET_TIMEOUT = float(os.environ.get('CIRCUIT_RESET_TIMEOUT') or 30)
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    RATE_LIMITING = os.environ.get('RATE_LIMITING', '1') != '0'
+    # number of proxies in front of the app that add to X-Forwarded-For
+    PROXY_FIX_X_FOR = int(os.environ.get('PROXY_FIX_X_FOR') or 0)
+    RATE_LIMIT_STORAGE = os.environ.get('RATE_LIMIT_STORAGE') or 'redis'
+    # by endpoint or blueprint, the endpoint wins
+    RATE_LIMITS = {
+        'api': '300/minute',
+        'api.get_users': '60/minute',
+        'api.bulk_create_posts': '10/minute',
+        'main.search': '30/minute',
+        'main.translate_text': '20/minute',
+        'main.export_posts': '5/hour',
+    }
+    HEAVY_TASKS_PER_USER = int(os.environ.get('HEAVY_TASKS_PER_USER') or 1)
+    FOLLOW_GRAPH_CACHE = os.environ.get('FOLLOW_GRAPH_CACHE', '1') != '0'
+    FOLLOW_GRAPH_TTL = int(os.environ.get('FOLLOW_GRAPH_TTL') or 3600)
+    EXPLORE_BUFFER_SIZE = int(os.environ.get('EXPLORE_BUFFER_SIZE') or 1000)
+    EXPLORE_BUFFER_TTL = int(os.environ.get('EXPLORE_BUFFER_TTL') or 3600)
+    SUGGESTIONS_PER_USER = int(os.environ.get('SUGGESTIONS_PER_USER') or 10)
+    SUGGESTIONS_CHUNK_SIZE = int(
+        os.environ.get('SUGGESTIONS_CHUNK_SIZE') or 500)
+    SUGGESTIONS_ACTIVE_DAYS = int(
+        os.environ.get('SUGGESTIONS_ACTIVE_DAYS') or 30)
+    USERNAME_INDEX_SYNC = os.environ.get('USERNAME_INDEX_SYNC', '1') != '0'
+    USERNAME_INDEX_CHECK_INTERVAL = float(
+        os.environ.get('USERNAME_INDEX_CHECK_INTERVAL') or 5)
+    USERNAME_INDEX_TTL = float(os.environ.get('USERNAME_INDEX_TTL') or 600)
+    USERNAME_SUGGESTIONS = 8
     POSTS_PER_PAGE = 25
+    BULK_POSTS_BATCH_SIZE = int(os.environ.get('BULK_POSTS_BATCH_SIZE') or 500)
+    BULK_POSTS_MAX_ITEMS = int(os.environ.get('BULK_POSTS_MAX_ITEMS') or 10000)
+    BULK_POSTS_MAX_SIZE = int(
+        os.environ.get('BULK_POSTS_MAX_SIZE') or 16 * 1024 * 1024)
+    # a post body is at most 140 characters
+    BULK_POSTS_MAX_ITEM_SIZE = int(
+        os.environ.get('BULK_POSTS_MAX_ITEM_SIZE') or 4096)
+    JSON_PROVIDER = os.environ.get('JSON_PROVIDER') or 'orjson'
+    JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+    METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+    SERVER_TIMING = os.environ.get('SERVER_TIMING') is not None
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or \
+        os.path.join(basedir, 'profiles')
+    PROFILE_TOKEN_MAX_AGE = int(os.environ.get('PROFILE_TOKEN_MAX_AGE') or 3600)
+    SQL_INSTRUMENTATION = os.environ.get('SQL_INSTRUMENTATION', '1') != '0'
+    SQL_SLOW_QUERY_THRESHOLD = float(
+        os.environ.get('SQL_SLOW_QUERY_THRESHOLD') or 0.1)
+    SQL_N_PLUS_ONE_THRESHOLD = int(
+        os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 5)
+    SQL_DEBUG_HEADER = os.environ.get('SQL_DEBUG_HEADER') is not None
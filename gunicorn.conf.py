@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+
+# Gunicorn loads this file before importing the application, which is what
+# lets prometheus_client pick multi-process mode in every worker
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    tempfile.gettempdir(), 'microblog-metrics-web'))
+
+# load and warm up the app once in the master, see app/warmup.py
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') != '0'
+
+
+def on_starting(server):
+    # samples left behind by a previous run would be added to the new totals
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app.warmup import warm_up
+        warm_up(server.app.wsgi())
+
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from app.warmup import after_fork
+        after_fork(server.app.wsgi())
+
+
+def worker_exit(server, worker):
+    # write the log records still queued in the worker
+    from app import logs
+    logs.stop()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
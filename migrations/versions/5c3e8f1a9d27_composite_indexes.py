@@ -0,0 +1,60 @@
+"""composite indexes
+
+Revision ID: 5c3e8f1a9d27
+Revises: 834b1a697901
+Create Date: 2026-10-19 09:12:31.402115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c3e8f1a9d27'
+down_revision = '834b1a697901'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.create_index('ix_followers_followed_id_follower_id', ['followed_id', 'follower_id'], unique=False)
+
+    # the composite indexes start with the same column, so they replace the
+    # single column ones
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_post_user_id')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id_timestamp', ['recipient_id', 'timestamp'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+        batch_op.create_index('ix_notification_user_id_name', ['user_id', 'name'], unique=False)
+        batch_op.drop_index('ix_notification_user_id')
+
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.create_index('ix_task_user_id_complete', ['user_id', 'complete'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('task', schema=None) as batch_op:
+        batch_op.drop_index('ix_task_user_id_complete')
+
+    with op.batch_alter_table('notification', schema=None) as batch_op:
+        batch_op.create_index('ix_notification_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_notification_user_id_name')
+        batch_op.drop_index('ix_notification_user_id_timestamp')
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_recipient_id', ['recipient_id'], unique=False)
+        batch_op.drop_index('ix_message_recipient_id_timestamp')
+
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.create_index('ix_post_user_id', ['user_id'], unique=False)
+        batch_op.drop_index('ix_post_user_id_timestamp')
+
+    with op.batch_alter_table('followers', schema=None) as batch_op:
+        batch_op.drop_index('ix_followers_followed_id_follower_id')
@@ -0,0 +1,37 @@
+"""suggestions
+
+Revision ID: 9b4d2e7c6a10
+Revises: 5c3e8f1a9d27
+Create Date: 2026-10-19 14:05:48.211704
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4d2e7c6a10'
+down_revision = '5c3e8f1a9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('suggestion',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('suggested_id', sa.Integer(), nullable=False),
+    sa.Column('score', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['suggested_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'suggested_id')
+    )
+
+    with op.batch_alter_table('suggestion', schema=None) as batch_op:
+        batch_op.create_index('ix_suggestion_user_id_score', ['user_id', 'score'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('suggestion', schema=None) as batch_op:
+        batch_op.drop_index('ix_suggestion_user_id_score')
+
+    op.drop_table('suggestion')
@@ -24,9 +24,9 @@ if ! redis-cli ping | grep -q "PONG"; then
 fi
 
 echo "Starting RQ worker..."
-echo "Worker will process tasks from the 'microblog-tasks' queue"
+echo "Workers will process tasks from the interactive, indexing and bulk queues"
 echo "Press Ctrl+C to stop the worker"
 echo ""
 
-# Start the RQ worker
-rq worker microblog-tasks
\ No newline at end of file
+# Start a pool of warm RQ workers
+flask worker
\ No newline at end of file
@@ -1,8 +1,34 @@
 #!/usr/bin/env python
 from datetime import datetime, timezone, timedelta
+import gc
+import secrets
+import json
+import logging
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import tempfile
+import time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+import msgpack
+import sqlalchemy as sa
+from flask import render_template
+from app import create_app, db, explorefeed, followgraph, logs, mail, \
+    replicas, serializers, suggestions, usernames
+from app.circuit import CircuitBreaker, CircuitOpenError, ServiceError, \
+    guarded
+from app.instrumentation import query_budget, recording, statement_shape
+from app.profiling import generate_profile_token
+from app.ratelimit import LocalBuckets
+from app.search import decode_cursor, encode_cursor, query_index
+from app.seed import generate
+from app.serializers import RawJSON
+from app.warmup import LAZY_IMPORTS, warm_up
+from app.workers import TaskLimitError
+from app.models import User, Post, Message, Notification, Task, \
+    SearchableMixin
 from config import Config
 
 
@@ -10,6 +36,11 @@ class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    WTF_CSRF_ENABLED = False
+    FOLLOW_GRAPH_CACHE = False
+    EXPLORE_BUFFER_SIZE = 0
+    RATE_LIMITING = False
+    USERNAME_INDEX_SYNC = False
 
 
 class UserModelCase(unittest.TestCase):
@@ -63,6 +94,36 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.following_count(), 0)
         self.assertEqual(u2.followers_count(), 0)
 
+    def test_follow_is_idempotent(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertTrue(u1.follow(u2))
+        self.assertFalse(u1.follow(u2))
+        self.assertTrue(u1.is_following(u2))
+        db.session.commit()
+        self.assertEqual(u2.followers_count(), 1)
+        self.assertTrue(u1.unfollow(u2))
+        self.assertFalse(u1.unfollow(u2))
+        db.session.rollback()
+        self.assertTrue(u1.is_following(u2))
+
+    def test_known_followers(self):
+        users = [User(username=name, email=f'{name}@example.com')
+                 for name in ['john', 'susan', 'mary', 'david']]
+        john, susan, mary, david = users
+        db.session.add_all(users)
+        db.session.commit()
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        db.session.commit()
+        self.assertEqual(john.known_followers(david), [mary, susan])
+        self.assertEqual(john.known_followers(david, limit=1), [mary])
+        self.assertEqual(david.known_followers(john), [])
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username='john', email='john@example.com')
@@ -102,5 +163,1315 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+@unittest.skipUnless(os.environ.get('TEST_REDIS_URL'),
+                     'TEST_REDIS_URL is not set')
+class FollowGraphCacheCase(unittest.TestCase):
+    def setUp(self):
+        class CacheConfig(TestConfig):
+            REDIS_URL = os.environ.get('TEST_REDIS_URL')
+            FOLLOW_GRAPH_CACHE = True
+
+        self.app = create_app(CacheConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis.flushdb()
+        self.users = [User(username=name, email=f'{name}@example.com')
+                      for name in ['john', 'susan', 'mary']]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.redis.flushdb()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_sets_follow_commits(self):
+        john, susan, mary = self.users
+        self.assertFalse(john.is_following(susan))
+        self.assertTrue(self.app.redis.exists(f'following:{john.id}'))
+        john.follow(susan)
+        mary.follow(susan)
+        db.session.commit()
+        self.assertEqual(self.app.redis.scard(f'following:{john.id}'), 2)
+        self.assertTrue(john.is_following(susan))
+        self.assertEqual(susan.followers_count(), 2)
+        john.follow(mary)
+        db.session.rollback()
+        self.assertFalse(john.is_following(mary))
+        self.assertEqual(john.known_followers(susan), [])
+        john.follow(mary)
+        db.session.commit()
+        self.assertEqual(john.known_followers(susan), [mary])
+
+    def test_uncommitted_follows_are_not_cached(self):
+        john, susan, mary = self.users
+        john.follow(susan)
+        self.assertEqual(susan.followers_count(), 1)
+        self.assertEqual(john.following_count(), 1)
+        self.assertFalse(self.app.redis.exists(f'followers:{susan.id}'))
+        db.session.rollback()
+        self.assertEqual(susan.followers_count(), 0)
+        self.assertEqual(self.app.redis.smembers(f'followers:{susan.id}'),
+                         {b'0'})
+
+    def test_load_after_change_is_dropped(self):
+        john, susan, mary = self.users
+        key = f'followers:{susan.id}'
+        counter = self.app.redis.get(key + ':changes')
+        john.follow(susan)
+        db.session.commit()
+        # a load that read the database before the follow was committed
+        self.app.redis.register_script(followgraph._LOAD_SCRIPT)(
+            keys=[key, key + ':changes'],
+            args=[counter or b'', 60, followgraph.SENTINEL])
+        self.assertFalse(self.app.redis.exists(key))
+        self.assertEqual(susan.followers_count(), 1)
+
+
+class SuggestionCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_rank(self):
+        following = {1: {2, 3}, 2: {1, 4, 5}, 3: {4, 6}}
+        self.assertEqual(suggestions.rank(1, following, 2), [(4, 2), (5, 1)])
+
+    def test_refresh(self):
+        users = [User(username=name, email=f'{name}@example.com')
+                 for name in ['john', 'susan', 'mary', 'david', 'anne']]
+        john, susan, mary, david, anne = users
+        db.session.add_all(users)
+        db.session.commit()
+        john.follow(susan)
+        john.follow(mary)
+        susan.follow(david)
+        mary.follow(david)
+        mary.follow(anne)
+        db.session.commit()
+        self.assertEqual(suggestions.refresh_all(chunk_size=2), 5)
+        self.assertEqual(john.follow_suggestions(), [david, anne])
+        self.assertEqual(susan.follow_suggestions(), [])
+        john.follow(david)
+        db.session.commit()
+        self.assertEqual(john.follow_suggestions(), [anne])
+
+
+class ExploreFeedCase(unittest.TestCase):
+    redis_url = os.environ.get('TEST_REDIS_URL')
+
+    def setUp(self):
+        class FeedConfig(TestConfig):
+            REDIS_URL = self.redis_url or 'redis://localhost:1'
+            EXPLORE_BUFFER_SIZE = 5
+
+        self.app = create_app(FeedConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        if self.redis_url:
+            self.app.redis.delete(explorefeed.KEY)
+        author = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        self.posts = [Post(body=f'post {i}', author=author,
+                           timestamp=now + timedelta(seconds=i))
+                      for i in range(4)]
+        db.session.add_all(self.posts)
+        db.session.commit()
+        self.posts.reverse()
+
+    def tearDown(self):
+        if self.redis_url:
+            self.app.redis.delete(explorefeed.KEY)
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_pages(self):
+        page = explorefeed.explore_page(1, 3)
+        self.assertEqual(page.items, self.posts[:3])
+        self.assertTrue(page.has_next)
+        page = explorefeed.explore_page(2, 3)
+        self.assertEqual(page.items, self.posts[3:])
+        self.assertFalse(page.has_next)
+
+    @unittest.skipUnless(redis_url, 'TEST_REDIS_URL is not set')
+    def test_buffer(self):
+        explorefeed.explore_page(1, 3)
+        now = datetime.now(timezone.utc)
+        new = [Post(body=f'new {i}', author=self.posts[0].author,
+                    timestamp=now + timedelta(minutes=i)) for i in range(2)]
+        db.session.add_all(new)
+        db.session.commit()
+        self.assertEqual(self.app.redis.llen(explorefeed.KEY), 5)
+        with recording() as recorder:
+            page = explorefeed.explore_page(1, 3)
+        self.assertEqual(page.items, new[::-1] + self.posts[:1])
+        self.assertEqual(recorder.count, 2)
+        # beyond the buffer the database is used
+        page = explorefeed.explore_page(2, 3)
+        self.assertEqual(page.items, self.posts[1:])
+        self.assertEqual(page.total, 6)
+
+    @unittest.skipUnless(redis_url, 'TEST_REDIS_URL is not set')
+    def test_backdated_bulk_posts(self):
+        author = self.posts[0].author
+        token = author.get_token()
+        db.session.commit()
+        explorefeed.explore_page(1, 3)
+        old = self.posts[1].timestamp - timedelta(milliseconds=1)
+        new = self.posts[0].timestamp + timedelta(seconds=1)
+        self.app.test_client().post(
+            '/api/posts/bulk', headers={'Authorization': f'Bearer {token}'},
+            json=[{'body': 'old', 'timestamp': old.isoformat()},
+                  {'body': 'new', 'timestamp': new.isoformat()}])
+        # the buffer is rebuilt in timestamp order
+        self.assertEqual(self.app.redis.llen(explorefeed.KEY), 0)
+        page = explorefeed.explore_page(1, 3)
+        self.assertEqual([post.body for post in page.items],
+                         ['new', 'post 3', 'post 2'])
+        page = explorefeed.explore_page(2, 3)
+        self.assertEqual([post.body for post in page.items],
+                         ['old', 'post 1', 'post 0'])
+
+
+class SearchClientCase(unittest.TestCase):
+    def setUp(self):
+        class SearchConfig(TestConfig):
+            ELASTICSEARCH_URL = 'http://localhost:1'
+            ELASTICSEARCH_PROBE_TIMEOUT = 0.5
+
+        start = time.perf_counter()
+        self.app = create_app(SearchConfig)
+        self.startup = time.perf_counter() - start
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_lazy_client(self):
+        es = self.app.elasticsearch
+        self.assertIsNone(es._client)
+        self.assertLess(self.startup, 1)
+        es.client
+        self.assertFalse(es.probe())
+        self.assertFalse(es)
+        self.assertEqual(query_index('post', 'hello', 1, 10), ([], 0))
+        posts, total, cursor = Post.search_page('hello', 10)
+        self.assertEqual((list(posts), total, cursor), ([], 0, None))
+
+
+class UsernameIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = {name: User(username=name, email=f'{name}@example.com')
+                      for name in ('Susan', 'sam', 'sandra', 'david')}
+        db.session.add_all(self.users.values())
+        self.users['sam'].follow(self.users['david'])
+        self.users['sandra'].follow(self.users['sam'])
+        self.users['david'].follow(self.users['sam'])
+        self.users['david'].follow(self.users['sandra'])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def names(self, prefix, limit=8):
+        return [user[0] for user in usernames.complete(prefix, limit)]
+
+    def test_ranked_by_followers(self):
+        self.assertEqual(self.names('s'), ['sam', 'sandra', 'Susan'])
+        self.assertEqual(self.names('SA'), ['sam', 'sandra'])
+        self.assertEqual(self.names('s', limit=1), ['sam'])
+        self.assertEqual(self.names('x'), [])
+        self.assertEqual(self.names(''), [])
+
+    def test_registration_and_rename(self):
+        self.assertEqual(self.names('d'), ['david'])
+        db.session.add(User(username='dan', email='dan@example.com'))
+        self.users['david'].username = 'sven'
+        db.session.commit()
+        self.assertEqual(self.names('d'), ['dan'])
+        self.assertEqual(self.names('sv'), ['sven'])
+        self.users['sam'].username = 'dave'
+        db.session.rollback()
+        self.assertEqual(self.names('da'), ['dan'])
+
+    def test_endpoint_and_message_form(self):
+        self.users['Susan'].set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'Susan',
+                                         'password': 'cat'})
+        response = client.get('/usernames?prefix=sa&limit=1')
+        self.assertEqual(response.json, {'users': [
+            {'username': 'sam', 'followers': 2, 'url': '/user/sam'}]})
+        response = client.get('/send_message/sam')
+        self.assertIn(b'value="sam"', response.data)
+        self.assertEqual(client.get('/send_message/nobody').status_code, 404)
+        response = client.post('/send_message', data={
+            'recipient': 'nobody', 'message': 'hi'})
+        self.assertIn(b'User nobody not found.', response.data)
+        client.post('/send_message', data={'recipient': 'sandra',
+                                           'message': 'hi'})
+        self.assertEqual(self.users['sandra'].unread_message_count(), 1)
+
+    def test_incremental_update(self):
+        users = [(1, 'sam', 3), (2, 'Sam', 1), (3, 'sandra', 2),
+                 (4, 'bob', 0)]
+        index = usernames.PrefixIndex(users)
+        self.assertEqual(index.complete('s', 8)[0][0], 'sam')
+        changes = {1: 'zed', 5: 'Samuel', 6: 'sam'}
+        updated = index.updated(changes)
+        expected = usernames.PrefixIndex(
+            [(1, 'zed', 3), (2, 'Sam', 1), (3, 'sandra', 2), (4, 'bob', 0),
+             (5, 'Samuel', 0), (6, 'sam', 0)])
+        self.assertEqual((updated.keys, updated.users),
+                         (expected.keys, expected.users))
+        self.assertEqual(updated.usernames, expected.usernames)
+        self.assertEqual(updated.complete('s', 8), expected.complete('s', 8))
+        self.assertEqual(updated.complete('z', 8), [('zed', 1, 3)])
+        # the old index is unchanged
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.complete('s', 8)[0][0], 'sam')
+
+    def test_rebuild_in_background(self):
+        self.assertEqual(self.names('s'), ['sam', 'sandra', 'Susan'])
+        for name in ('sam', 'david'):
+            self.users[name].follow(self.users['Susan'])
+        db.session.commit()
+        self.app.config['USERNAME_INDEX_TTL'] = 0
+        # the old index answers while the new one is built
+        with recording() as recorder:
+            self.assertEqual(self.names('s'), ['sam', 'sandra', 'Susan'])
+        self.assertEqual(recorder.count, 0)
+        index = usernames._index()
+        index.worker.join()
+        self.app.config['USERNAME_INDEX_TTL'] = 600
+        self.assertEqual(self.names('s'), ['sam', 'Susan', 'sandra'])
+        self.assertIsNone(index.pending)
+
+    @unittest.skipUnless(os.environ.get('TEST_REDIS_URL'),
+                         'TEST_REDIS_URL is not set')
+    def test_changes_from_other_processes(self):
+        self.app.config.update(REDIS_URL=os.environ['TEST_REDIS_URL'],
+                               USERNAME_INDEX_SYNC=True,
+                               USERNAME_INDEX_CHECK_INTERVAL=0)
+        self.app.redis.delete(usernames.CHANGES_KEY)
+        other = usernames.UsernameIndex()
+        self.assertEqual(self.names('d'), ['david'])
+        other.apply({self.users['david'].id: 'sven', 1000: 'dan'})
+        # the changes are read in the background
+        with recording() as recorder:
+            self.assertEqual(self.names('d'), ['david'])
+        self.assertEqual(recorder.count, 0)
+        usernames._index().worker.join()
+        self.assertEqual(self.names('d'), ['dan'])
+        self.assertEqual(self.names('sv'), ['sven'])
+
+
+class SearchDocumentCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='susan', email='susan@example.com')
+        self.post = Post(body='hello <world>', author=self.user,
+                         language='en',
+                         timestamp=datetime(2024, 1, 2, 3, 4, 5))
+        db.session.add_all([self.user, self.post])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_cursor(self):
+        cursor = encode_cursor('pit==', [1.5, 42])
+        self.assertNotIn('=', cursor)
+        self.assertEqual(decode_cursor(cursor), ('pit==', [1.5, 42], None))
+        # the first page does not open a point in time
+        self.assertEqual(decode_cursor(encode_cursor(None, None, 25)),
+                         (None, None, 25))
+        self.assertIsNone(decode_cursor('not a cursor'))
+        self.assertIsNone(decode_cursor(encode_cursor(1, 2)))
+        self.assertIsNone(decode_cursor(encode_cursor(None, None, -1)))
+
+    def test_render_from_document(self):
+        document = self.post.search_document()
+        self.assertEqual(document['timestamp'], '2024-01-02T03:04:05+00:00')
+        self.assertEqual(document['author']['username'], 'susan')
+        post = Post.from_document(self.post.id, document, {
+            'body': ['hello &lt;<mark>world</mark>&gt;']})
+        self.assertEqual(post.author.avatar(50), self.user.avatar(50))
+        with self.app.test_request_context():
+            html = render_template('_post.html', post=post)
+            self.assertIn('hello &lt;<mark>world</mark>&gt;', html)
+            plain = render_template('_post.html', post=self.post)
+            self.assertIn('hello &lt;world&gt;', plain)
+
+    def test_from_source_needs_from_document(self):
+        class Note(SearchableMixin):
+            __tablename__ = 'note'
+            __searchable__ = ['body']
+
+        with self.assertRaises(TypeError):
+            Note.search_page('hello', 10, from_source=True)
+
+    def test_author_changes(self):
+        self.assertFalse(self.user.author_changed())
+        self.user.username = 'sue'
+        self.assertTrue(self.user.author_changed())
+
+
+class _StalledHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # accept the connection and never answer, like an overloaded server
+        time.sleep(1)
+
+
+class CircuitBreakerCase(unittest.TestCase):
+    def test_opens_after_failures_and_recovers(self):
+        breaker = CircuitBreaker('test', failure_threshold=2,
+                                 reset_timeout=0.05, exceptions=(IOError,))
+        for i in range(2):
+            with self.assertRaises(IOError):
+                with breaker.call():
+                    raise IOError()
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            with breaker.call():
+                self.fail('called while the circuit is open')
+        time.sleep(0.06)
+        with breaker.call():
+            # only the trial call is let through while half-open
+            self.assertEqual(breaker.state, 'half_open')
+            self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_elasticsearch_error_responses(self):
+        from elastic_transport import ApiResponseMeta, HttpHeaders, NodeConfig
+        from elasticsearch import ApiError, NotFoundError
+
+        def error(cls, status):
+            meta = ApiResponseMeta(status, '1.1', HttpHeaders(), 0.01,
+                                   NodeConfig('http', 'localhost', 9200))
+            return cls('error', meta, {})
+
+        app = create_app(TestConfig)
+        breaker = app.extensions['circuit_breakers']['elasticsearch']
+        with app.app_context():
+            for _ in range(app.config['CIRCUIT_FAILURE_THRESHOLD']):
+                with self.assertRaises(NotFoundError):
+                    with guarded('elasticsearch', 'search'):
+                        raise error(NotFoundError, 404)
+            self.assertEqual(breaker.state, 'closed')
+            for status in (429, 503, 503, 503, 503):
+                with self.assertRaises(ServiceError):
+                    with guarded('elasticsearch', 'search'):
+                        raise error(ApiError, status)
+            self.assertEqual(breaker.state, 'open')
+
+    def test_slow_calls_are_failures(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, timeout=0.01)
+        with breaker.call():
+            time.sleep(0.02)
+        self.assertEqual(breaker.state, 'open')
+
+    def test_stalled_redis(self):
+        server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                 _StalledHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+
+        class StalledRedisConfig(TestConfig):
+            REDIS_URL = 'redis://127.0.0.1:{}'.format(server.server_address[1])
+            REDIS_TIMEOUT = 0.1
+            CIRCUIT_FAILURE_THRESHOLD = 2
+
+        app = create_app(StalledRedisConfig)
+        task = Task(id='job-id', name='export_posts')
+        with app.app_context():
+            for i in range(2):
+                start = time.perf_counter()
+                self.assertIsNone(task.get_rq_job())
+                self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+            start = time.perf_counter()
+            self.assertIsNone(task.get_rq_job())
+            self.assertLess(time.perf_counter() - start, 0.05)
+            breaker = app.extensions['circuit_breakers']['redis']
+            self.assertEqual(breaker.state, 'open')
+
+
+class WorkerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_heavy_task_limit(self):
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.add(Task(id='job-id', name='export_posts', user=user))
+        db.session.commit()
+        self.assertEqual(user.heavy_tasks_in_progress(), 1)
+        with self.assertRaises(TaskLimitError):
+            user.launch_task('export_posts', 'Exporting posts...')
+
+    def test_warm_up(self):
+        warm_up(self.app)
+        gc.unfreeze()
+        self.assertIn('index.html', [
+            name for (loader, name) in self.app.jinja_env.cache])
+
+
+class SerializerCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username='john', email='john@example.com')
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_providers_agree(self):
+        self.user.last_seen = datetime(2024, 1, 2, 3, 4, 5)
+        with self.app.test_request_context():
+            data = {'user': self.user.to_dict(),
+                    'when': self.user.last_seen,
+                    'raw': RawJSON('{"a": [1, 2]}')}
+        stdlib = serializers.JSONProvider(self.app)
+        self.assertIsInstance(self.app.json, serializers.OrjsonProvider)
+        self.assertEqual(self.app.json.loads(self.app.json.dumps(data)),
+                         stdlib.loads(stdlib.dumps(data)))
+        self.assertEqual(stdlib.loads(stdlib.dumps(data))['raw'],
+                         {'a': [1, 2]})
+
+    def test_notifications(self):
+        self.user.set_password('cat')
+        self.user.add_notification('unread_message_count', {'count': 3})
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'john',
+                                         'password': 'cat'})
+        response = client.get('/notifications')
+        self.assertEqual(response.json[0]['data'], {'count': 3})
+        self.assertIn('Accept', response.vary)
+        response = client.get('/notifications',
+                              headers={'Accept': 'application/msgpack'})
+        self.assertEqual(response.mimetype, 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.data)[0]['data'],
+                         {'count': 3})
+
+
+class UserAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {users[0].get_token()}'}
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_batch_lookup(self):
+        client = self.app.test_client()
+        with query_budget(2):
+            response = client.get('/api/users?ids=3,1,99,3&fields=username',
+                                  headers=self.headers)
+        self.assertEqual(response.json['items'], [
+            {'id': 3, 'username': 'user2'}, {'id': 1, 'username': 'user0'}])
+        response = client.get('/api/users?ids=1,x', headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_sparse_fieldsets(self):
+        client = self.app.test_client()
+        response = client.get('/api/users/2?fields=username,follower_count',
+                              headers=self.headers)
+        self.assertEqual(response.json, {'id': 2, 'username': 'user1',
+                                         'follower_count': 0})
+        response = client.get('/api/users?per_page=2&fields=_links',
+                              headers=self.headers)
+        self.assertEqual(set(response.json['items'][0]), {'id', '_links'})
+        self.assertIn('fields=_links', response.json['_links']['next'])
+        response = client.get('/api/users/2', headers=self.headers)
+        self.assertIn('post_count', response.json)
+
+
+class BulkPostsCase(unittest.TestCase):
+    def setUp(self):
+        class BulkConfig(TestConfig):
+            BULK_POSTS_BATCH_SIZE = 2
+
+        self.app = create_app(BulkConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username='john', email='john@example.com')
+        db.session.add(user)
+        db.session.commit()
+        self.headers = {'Authorization': f'Bearer {user.get_token()}'}
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_ndjson(self):
+        lines = ['{"body": "one", "language": "en"}', '{"body": ""}',
+                 'not json', '',
+                 '{"body": "two", "timestamp": "2024-01-02T03:04:05Z"}',
+                 '{"body": "three"}', '{"body": "four"}', '{"body": "five"}']
+        response = self.app.test_client().post(
+            '/api/posts/bulk', data='\n'.join(lines),
+            headers=dict(self.headers,
+                         **{'Content-Type': 'application/x-ndjson'}))
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         [201, 400, 400, 201, 201, 201, 201])
+        self.assertEqual(response.json['created'], 5)
+        self.assertTrue(response.json['errors'])
+        posts = db.session.scalars(sa.select(Post).order_by(Post.id)).all()
+        self.assertEqual([item['id'] for item in response.json['items']
+                          if item['status'] == 201],
+                         [post.id for post in posts])
+        self.assertEqual([post.body for post in posts],
+                         ['one', 'two', 'three', 'four', 'five'])
+        self.assertEqual(posts[1].timestamp, datetime(2024, 1, 2, 3, 4, 5))
+        self.assertTrue(all(post.language is not None for post in posts))
+
+    def test_json_array(self):
+        client = self.app.test_client()
+        response = client.post('/api/posts/bulk', headers=self.headers,
+                               json=[{'body': 'one'}, 7, {'body': 'two'}])
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         [201, 400, 201])
+        response = client.post('/api/posts/bulk', headers=self.headers,
+                               data='[{"body": "three"}, {"bo',
+                               content_type='application/json')
+        self.assertEqual(response.json['items'], [
+            {'index': 0, 'status': 201, 'id': 3},
+            {'index': 1, 'status': 400, 'error': 'invalid JSON'}])
+        response = client.post('/api/posts/bulk', headers=self.headers,
+                               data='one', content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+
+    def test_future_timestamps(self):
+        now = datetime.now(timezone.utc)
+        response = self.app.test_client().post(
+            '/api/posts/bulk', headers=self.headers, json=[
+                {'body': 'soon', 'timestamp': (
+                    now + timedelta(minutes=1)).isoformat()},
+                {'body': 'later', 'timestamp': (
+                    now + timedelta(days=1)).isoformat()}])
+        self.assertEqual(response.json['items'][1], {
+            'index': 1, 'status': 400,
+            'error': 'timestamp must not be in the future'})
+        self.assertEqual(response.json['created'], 1)
+
+    def test_size_limits(self):
+        self.app.config['BULK_POSTS_MAX_ITEM_SIZE'] = 100
+        self.app.config['BULK_POSTS_MAX_SIZE'] = 1000
+        client = self.app.test_client()
+        ndjson = dict(self.headers, **{'Content-Type': 'application/x-ndjson'})
+        big = '{"body": "' + 'x' * 200 + '"}'
+        response = client.post('/api/posts/bulk', headers=ndjson,
+                               data='\n'.join([big, '{"body": "one"}']))
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         [400, 201])
+        response = client.post('/api/posts/bulk', headers=self.headers,
+                               data=f'[{{"body": "two"}}, {big}]',
+                               content_type='application/json')
+        self.assertEqual([item['status'] for item in response.json['items']],
+                         [201, 400])
+        response = client.post('/api/posts/bulk', headers=ndjson,
+                               data='{"body": "three"}\n' * 100)
+        self.assertEqual(response.status_code, 413)
+
+
+class RateLimitCase(unittest.TestCase):
+    redis_url = os.environ.get('TEST_REDIS_URL')
+
+    def setUp(self, redis_url='redis://localhost:1', proxies=0):
+        class RateLimitConfig(TestConfig):
+            RATE_LIMITING = True
+            REDIS_URL = redis_url
+            PROXY_FIX_X_FOR = proxies
+            RATE_LIMITS = {'api': '3/minute', 'api.get_users': '1/minute'}
+
+        self.app = create_app(RateLimitConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(2)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.headers = [{'Authorization': f'Bearer {user.get_token()}'}
+                        for user in users]
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def check_limits(self):
+        client = self.app.test_client()
+        responses = [client.get('/api/users/1', headers=self.headers[0])
+                     for _ in range(4)]
+        self.assertEqual([r.status_code for r in responses],
+                         [200, 200, 200, 429])
+        self.assertEqual(responses[0].headers['RateLimit-Limit'], '3')
+        self.assertEqual(responses[1].headers['RateLimit-Remaining'], '1')
+        self.assertEqual(responses[3].json['error'], 'Too Many Requests')
+        self.assertGreater(int(responses[3].headers['Retry-After']), 0)
+        # other clients and endpoints have buckets of their own
+        self.assertEqual(client.get('/api/users/1', headers=self.headers[1])
+                         .status_code, 200)
+        self.assertEqual([client.get('/api/users', headers=self.headers[0])
+                          .status_code for _ in range(2)], [200, 429])
+        self.assertNotIn('RateLimit-Limit', client.get('/auth/login').headers)
+
+    def test_local_fallback(self):
+        self.check_limits()
+
+    def test_token_is_looked_up_once(self):
+        client = self.app.test_client()
+        with recording() as recorder:
+            client.get('/api/users/1', headers=self.headers[0])
+        self.assertEqual(len([statement for statement in recorder.statements
+                              if 'user.token =' in statement]), 1)
+
+    def test_forwarded_for_is_ignored_by_default(self):
+        client = self.app.test_client()
+        self.assertEqual([client.get('/api/users/1', headers={
+            'X-Forwarded-For': f'10.0.0.{i}'}).status_code for i in range(4)],
+            [401, 401, 401, 429])
+
+    def test_clients_behind_proxy(self):
+        self.tearDown()
+        self.setUp(proxies=1)
+        client = self.app.test_client()
+
+        def status(address, token=None):
+            headers = {'X-Forwarded-For': address}
+            if token:
+                headers['Authorization'] = f'Bearer {token}'
+            return client.get('/api/users/1', headers=headers).status_code
+
+        self.assertEqual([status('10.0.0.1') for _ in range(4)],
+                         [401, 401, 401, 429])
+        self.assertEqual(status('10.0.0.2'), 401)
+        # made up tokens do not get buckets of their own
+        self.assertEqual(status('10.0.0.1', secrets.token_hex(16)), 429)
+
+    @unittest.skipUnless(redis_url, 'TEST_REDIS_URL is not set')
+    def test_redis(self):
+        self.tearDown()
+        self.setUp(self.redis_url)
+        self.app.redis.flushdb()
+        self.check_limits()
+        self.assertEqual(self.app.extensions['circuit_breakers']['redis']
+                         .failures, 0)
+
+    def test_refill(self):
+        buckets = LocalBuckets()
+        self.assertEqual(buckets.take('key', 1, 20), (True, 0))
+        self.assertFalse(buckets.take('key', 1, 20)[0])
+        time.sleep(0.06)
+        self.assertTrue(buckets.take('key', 1, 20)[0])
+
+
+class LogPipelineCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.log_file = tempfile.NamedTemporaryFile(suffix='.log')
+        handler = logging.FileHandler(self.log_file.name)
+        handler.setFormatter(logs.JSONFormatter())
+        self.pipeline = logs.LogPipeline([handler])
+        self.pipeline.start()
+        self.app.logger.addHandler(self.pipeline.handler)
+
+    def tearDown(self):
+        self.pipeline.stop()
+        self.app.logger.removeHandler(self.pipeline.handler)
+        self.log_file.close()
+
+    def entries(self):
+        self.pipeline.stop()
+        with open(self.log_file.name) as f:
+            return [json.loads(line) for line in f]
+
+    def test_app_logs_through_pipeline_only(self):
+        class ProductionConfig(TestConfig):
+            TESTING = False
+            LOG_TO_STDOUT = True
+            MAIL_SERVER = None
+
+        # Flask adds its stderr handler to a logger without handlers
+        root = logging.getLogger()
+        root_handlers, root.handlers = root.handlers, []
+        self.app.logger.removeHandler(self.pipeline.handler)
+        try:
+            app = create_app(ProductionConfig)
+        finally:
+            root.handlers = root_handlers
+        pipeline = app.extensions['log_pipeline']
+        try:
+            self.assertEqual(app.logger.handlers, [pipeline.handler])
+        finally:
+            pipeline.stop()
+            app.logger.removeHandler(pipeline.handler)
+
+    def test_json_lines(self):
+        with self.app.test_request_context(headers={'X-Request-ID': 'abc'}):
+            logs.set_request_id()
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                self.app.logger.exception('failed %s', 'here')
+        self.app.logger.warning('outside')
+        first, second = self.entries()
+        self.assertEqual((first['message'], first['request_id']),
+                         ('failed here', 'abc'))
+        self.assertIn('ZeroDivisionError', first['exception'])
+        self.assertEqual((second['level'], second['request_id']),
+                         ('WARNING', None))
+
+    def test_request_id_header(self):
+        response = self.app.test_client().get(
+            '/auth/login', headers={'X-Request-ID': 'abc'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc')
+
+    def test_forked_process(self):
+        pid = os.fork()
+        if pid == 0:
+            self.app.logger.warning('from the child')
+            logs.stop()
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.app.logger.warning('from the parent')
+        self.assertEqual(sorted(entry['message'] for entry in self.entries()),
+                         ['from the child', 'from the parent'])
+
+
+class DigestMailCase(unittest.TestCase):
+    def setUp(self):
+        class MailConfig(TestConfig):
+            MAIL_SERVER = 'localhost'
+            ADMINS = ['admin@example.com']
+
+        self.app = create_app(MailConfig)
+        self.handler = logs.DigestMailHandler(self.app, interval=3600,
+                                              max_per_hour=1, max_kinds=2)
+
+    def log(self, message, lineno=10):
+        self.handler.handle(logging.makeLogRecord({
+            'name': 'app', 'levelno': logging.ERROR, 'levelname': 'ERROR',
+            'msg': message, 'pathname': 'app/search.py', 'lineno': lineno}))
+
+    def test_digest(self):
+        for i in range(3):
+            self.log(f'search failed {i}')
+        self.log('translation failed', lineno=20)
+        self.log('other failure', lineno=30)
+        with mail.record_messages() as outbox:
+            self.handler.flush()
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].subject, 'Microblog Failure: 5 errors')
+        self.assertEqual(outbox[0].recipients, ['admin@example.com'])
+        self.assertIn('3 times', outbox[0].body)
+        self.assertIn('search failed 2', outbox[0].body)
+        self.assertNotIn('search failed 1', outbox[0].body)
+        self.assertIn('1 more errors of other kinds', outbox[0].body)
+
+    def test_hourly_cap(self):
+        self.log('first')
+        with mail.record_messages() as outbox:
+            self.handler.flush()
+            self.log('second')
+            self.handler.flush()
+            self.assertEqual(len(outbox), 1)
+            # held back errors are sent when the handler is closed
+            self.handler.close()
+            self.assertEqual(len(outbox), 2)
+        self.assertIn('second', outbox[1].body)
+
+    def test_pending_errors_are_sent_when_pipeline_stops(self):
+        pipeline = logs.LogPipeline([self.handler])
+        pipeline.start()
+        with mail.record_messages() as outbox:
+            pipeline.handler.handle(logging.makeLogRecord({
+                'name': 'app', 'levelno': logging.ERROR,
+                'levelname': 'ERROR', 'msg': 'job failed'}))
+            pipeline.stop()
+        self.assertEqual(len(outbox), 1)
+        self.assertIn('job failed', outbox[0].body)
+
+
+class StartupImportCase(unittest.TestCase):
+    # seconds, generous so that slow machines do not fail it
+    budget = float(os.environ.get('IMPORT_TIME_BUDGET', '1.5'))
+
+    def test_import_time(self):
+        env = dict(os.environ, DATABASE_URL='sqlite://', LOG_TO_STDOUT='1')
+        env.pop('ELASTICSEARCH_URL', None)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'from app import create_app; create_app(); import app.cli'],
+            capture_output=True, text=True, env=env, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        imported = {}
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    imported[name.strip()] = int(cumulative) / 1e6
+        self.assertFalse(set(LAZY_IMPORTS) & set(imported))
+        self.assertLess(imported['app'], self.budget)
+
+
+class FeedQueryCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.reader = User(username='reader', email='reader@example.com')
+        authors = [User(username=f'author{i}', email=f'author{i}@example.com')
+                   for i in range(25)]
+        db.session.add(self.reader)
+        db.session.add_all(authors)
+        now = datetime.now(timezone.utc)
+        for i, author in enumerate(authors):
+            self.reader.follow(author)
+            db.session.add(Post(body=f'post {i}', author=author,
+                                timestamp=now + timedelta(seconds=i)))
+        db.session.commit()
+        self.reader_id = self.reader.id
+        db.session.close()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def render_page(self, query):
+        with recording() as recorder:
+            posts = db.paginate(query, page=1, per_page=25, error_out=False)
+            cards = [(post.author.username, post.author.avatar(50))
+                     for post in posts.items]
+        self.assertEqual(len(cards), 25)
+        return recorder.count
+
+    def test_explore_page_query_count(self):
+        # count + page of posts + one batch of authors
+        self.assertEqual(self.render_page(Post.explore_posts()), 3)
+
+    def test_following_posts_page_query_count(self):
+        reader = db.session.get(User, self.reader_id)
+        self.assertEqual(self.render_page(reader.following_posts()), 3)
+
+    def test_endpoint_query_budgets(self):
+        reader = db.session.get(User, self.reader_id)
+        reader.set_password('cat')
+        db.session.commit()
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'reader',
+                                         'password': 'cat'})
+        budgets = {'/index': 8, '/explore': 7, '/user/author1': 11,
+                   '/user/author1/popup': 8}
+        for url, budget in budgets.items():
+            with query_budget(budget):
+                response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_repeated_statements_flagged(self):
+        with self.app.test_request_context():
+            with recording() as recorder:
+                for user in db.session.scalars(sa.select(User).limit(6)):
+                    user.to_dict()
+        repeated = recorder.repeated(6)
+        self.assertEqual(len(repeated), 3)
+        self.assertEqual(
+            statement_shape('SELECT * FROM user WHERE id IN (?, ?,\n ?)'),
+            'SELECT * FROM user WHERE id IN (?)')
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_endpoint(self):
+        client = self.app.test_client()
+        client.get('/auth/login')
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.get_data(as_text=True)
+        self.assertIn('microblog_request_duration_seconds_count{'
+                      'endpoint="auth.login",method="GET",status="200"}',
+                      text)
+        self.assertIn('microblog_db_pool_checkout_seconds', text)
+        self.assertIn('microblog_rq_queue_depth', text)
+
+
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+
+        class ProfilingConfig(TestConfig):
+            SERVER_TIMING = True
+            PROFILE_DIR = self.profile_dir.name
+
+        self.app = create_app(ProfilingConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.profile_dir.cleanup()
+
+    def test_server_timing_header(self):
+        response = self.app.test_client().get('/auth/login')
+        timing = response.headers['Server-Timing']
+        self.assertIn('db;dur=', timing)
+        self.assertIn('template;dur=', timing)
+        self.assertIn('total;dur=', timing)
+
+    def test_profile_requires_signed_token(self):
+        client = self.app.test_client()
+        client.get('/auth/login?_profile=forged')
+        self.assertEqual(os.listdir(self.profile_dir.name), [])
+        token = generate_profile_token(self.app, 'admin')
+        response = client.get('/auth/login',
+                              headers={'X-Profile-Token': token})
+        self.assertEqual(response.status_code, 200)
+        profiles = os.listdir(self.profile_dir.name)
+        self.assertEqual(len(profiles), 1)
+        self.assertTrue(profiles[0].endswith('.prof'))
+
+
+class SeedCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_seed_is_deterministic(self):
+        first = generate(seed=7, batch_size=50, users=30)
+        edges = db.session.execute(sa.text(
+            'SELECT follower_id, followed_id FROM followers')).all()
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(generate(seed=7, batch_size=50, users=30), first)
+        self.assertEqual(db.session.execute(sa.text(
+            'SELECT follower_id, followed_id FROM followers')).all(), edges)
+        self.assertEqual(first['user'], 30)
+        user = db.session.get(User, 1)
+        self.assertTrue(user.check_password('password'))
+
+    def test_orm_inserts_after_seeding(self):
+        generate(seed=7, batch_size=50, users=30, index=True)
+        user = User(username='susan', email='susan@example.com')
+        post = Post(body='hello', author=user)
+        db.session.add_all([user, post])
+        db.session.commit()
+        self.assertEqual(user.id, 31)
+        self.assertEqual(post.id, db.session.scalar(
+            sa.select(sa.func.count(Post.id))))
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+        class ReplicaConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir.name, 'primary.db')
+            SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + os.path.join(
+                self.tmpdir.name, 'replica.db')]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        replicas._lag_checks.clear()
+        self.replica = self.app.extensions['replicas'][0]
+        db.create_all()
+        db.metadata.create_all(self.replica)
+        # a user that only exists on the replica shows where reads go
+        with self.replica.begin() as conn:
+            conn.execute(sa.insert(User).values(
+                username='replicated', email='replicated@example.com'))
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.metadata.drop_all(self.replica)
+        self.replica.dispose()
+        self.app_context.pop()
+        replicas._lag_checks.clear()
+        self.tmpdir.cleanup()
+
+    def usernames(self):
+        return db.session.scalars(sa.select(User.username)).all()
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.usernames(), ['replicated'])
+
+    def test_reads_after_write_go_to_primary(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        self.assertEqual(self.usernames(), ['john'])
+
+    def test_use_primary(self):
+        view = replicas.use_primary(self.usernames)
+        self.assertEqual(view(), [])
+
+    def test_use_replica_after_write(self):
+        db.session.add(User(username='john', email='john@example.com'))
+        db.session.commit()
+        view = replicas.use_replica(self.usernames)
+        self.assertEqual(view(), ['replicated'])
+
+    def test_lagging_replica_is_skipped(self):
+        self.app.config['REPLICA_LAG_QUERY'] = 'SELECT 100'
+        self.assertEqual(self.usernames(), [])
+
+    @unittest.skipUnless(os.environ.get('TEST_REDIS_URL'),
+                         'TEST_REDIS_URL is not set')
+    def test_explore_buffer_is_rebuilt_from_primary(self):
+        self.app.config.update(REDIS_URL=os.environ['TEST_REDIS_URL'],
+                               EXPLORE_BUFFER_SIZE=5)
+        self.app.redis.delete(explorefeed.KEY)
+        user = User(username='john', email='john@example.com')
+        post = Post(body='not replicated yet', author=user)
+        db.session.add_all([user, post])
+        db.session.commit()
+        view = replicas.use_replica(lambda: explorefeed.explore_page(1, 5))
+        try:
+            view()
+            self.assertEqual(self.app.redis.lrange(explorefeed.KEY, 0, -1),
+                             [str(post.id).encode()])
+        finally:
+            self.app.redis.delete(explorefeed.KEY)
+
+
+class SQLitePragmaCase(unittest.TestCase):
+    def make_app(self, tuning):
+        class SQLiteConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(
+                self.tmpdir.name, 'app.db')
+            SQLITE_TUNING = tuning
+        return create_app(SQLiteConfig)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def pragmas(self, app):
+        with app.app_context():
+            with db.engine.connect() as conn:
+                values = {name: conn.exec_driver_sql(
+                    f'PRAGMA {name}').scalar() for name in (
+                        'journal_mode', 'synchronous', 'busy_timeout',
+                        'cache_size', 'mmap_size', 'temp_store')}
+            db.engine.dispose()
+        return values
+
+    def test_connections_are_tuned(self):
+        app = self.make_app(True)
+        self.assertEqual(self.pragmas(app), {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000,
+            'cache_size': -65536, 'mmap_size': 256 * 1024 * 1024,
+            'temp_store': 2})
+        options = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+        self.assertEqual(options['pool_size'], 5)
+        self.assertEqual(options['connect_args'], {'timeout': 5})
+
+    def test_tuning_can_be_disabled(self):
+        values = self.pragmas(self.make_app(False))
+        self.assertEqual(values['journal_mode'], 'delete')
+        self.assertEqual(values['synchronous'], 2)
+
+    def test_memory_database_is_left_alone(self):
+        app = create_app(TestConfig)
+        self.assertNotIn('pool_size',
+                         app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+
+
+class QueryPlanCase(unittest.TestCase):
+    """Check the query plans of the hot queries for full scans and sorts."""
+    database_url = 'sqlite://'
+
+    # the home feed merges posts from many authors, so no index can return
+    # them in timestamp order
+    allow_sort = {'home feed'}
+
+    def setUp(self):
+        class PlanConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = self.database_url
+
+        self.app = create_app(PlanConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.drop_all()
+        db.create_all()
+        self.u1 = User(username='john', email='john@example.com')
+        self.u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def hot_queries(self):
+        u1, u2 = self.u1, self.u2
+        page = {'page': 1, 'per_page': 25, 'error_out': False}
+        return {
+            'home feed': lambda: db.paginate(u1.following_posts(), **page),
+            'explore': lambda: db.paginate(Post.explore_posts(), **page),
+            'profile posts': lambda: db.paginate(u1.user_posts(), **page),
+            'post count': u1.posts_count,
+            'follower count': u1.followers_count,
+            'following count': u1.following_count,
+            'is following': lambda: u1.is_following(u2),
+            'inbox': lambda: db.paginate(
+                u1.messages_received.select().order_by(
+                    Message.timestamp.desc()), **page),
+            'unread count': u1.unread_message_count,
+            'notifications': lambda: db.session.scalars(
+                u1.notifications.select().where(
+                    Notification.timestamp > 0).order_by(
+                    Notification.timestamp.asc())).all(),
+            'add notification': lambda: u1.add_notification('test', 1),
+            'tasks in progress': lambda: u1.get_tasks_in_progress().all(),
+            'check token': lambda: User.check_token('token'),
+            'username lookup': lambda: db.session.scalar(
+                sa.select(User).where(User.username == 'susan')),
+        }
+
+    def capture(self, query):
+        statements = []
+
+        def capture_statement(conn, cursor, statement, parameters, context,
+                              executemany):
+            if not executemany:
+                statements.append((statement, parameters))
+
+        sa.event.listen(db.engine, 'before_cursor_execute', capture_statement)
+        try:
+            query()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute',
+                            capture_statement)
+        return statements
+
+    def explain(self, statement, parameters):
+        rows = db.session.connection().exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + statement, parameters).all()
+        return [row[-1] for row in rows]
+
+    def problems(self, plan):
+        for line in plan:
+            if line.startswith('SCAN ') and 'INDEX' not in line and \
+                    not line.startswith(('SCAN anon_', 'SCAN CONSTANT')):
+                yield 'full scan', line
+            elif line.startswith('USE TEMP B-TREE'):
+                yield 'sort', line
+
+    def test_hot_query_plans(self):
+        for name, query in self.hot_queries().items():
+            for statement, parameters in self.capture(query):
+                plan = self.explain(statement, parameters)
+                for kind, line in self.problems(plan):
+                    if kind == 'sort' and name in self.allow_sort:
+                        continue
+                    self.fail('{} for {!r}: {}\n{}\n{}'.format(
+                        kind, name, line, statement, '\n'.join(plan)))
+
+
+@unittest.skipUnless(os.environ.get('TEST_POSTGRES_URL'),
+                     'TEST_POSTGRES_URL is not set')
+class PostgresQueryPlanCase(QueryPlanCase):
+    database_url = os.environ.get('TEST_POSTGRES_URL')
+
+    def explain(self, statement, parameters):
+        conn = db.session.connection()
+        # tiny test tables make sequential scans cheapest, so only allow
+        # them when there is no index the planner could use instead
+        conn.exec_driver_sql('SET LOCAL enable_seqscan = off')
+        conn.exec_driver_sql('SET LOCAL enable_sort = off')
+        rows = conn.exec_driver_sql('EXPLAIN ' + statement, parameters).all()
+        return [row[0].strip(' ->') for row in rows]
+
+    def problems(self, plan):
+        for line in plan:
+            if line.startswith('Seq Scan'):
+                yield 'full scan', line
+            elif line.startswith(('Sort ', 'Incremental Sort')):
+                yield 'sort', line
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)